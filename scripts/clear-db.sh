@@ -1,2 +1,2 @@
 #!/bin/bash
-docker-compose exec db mongo creepy --eval "db.tiles.drop()"
+docker-compose exec db mongo creepy --eval "db.tiles.drop(); db.floor_tiles.drop(); db.edges.drop(); db.session_events.drop(); db.session_snapshots.drop(); db.explored.drop()"
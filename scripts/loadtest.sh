@@ -0,0 +1,4 @@
+#!/bin/bash
+# Usage: ./scripts/loadtest.sh --url http://localhost:5000 --scenario scenario.json
+# Runs locally, after `pip install -r requirements.txt -r requirements-dev.txt`
+cd "$(dirname "$0")/../server" && python loadtest.py "$@"
@@ -0,0 +1,2 @@
+#!/bin/bash
+docker-compose exec server python migrate.py
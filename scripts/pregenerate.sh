@@ -0,0 +1,3 @@
+#!/bin/bash
+# Usage: ./scripts/pregenerate.sh --min-floor 0 --max-floor 2 --radius 10
+docker-compose exec server python pregenerate.py "$@"
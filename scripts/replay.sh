@@ -0,0 +1,5 @@
+#!/bin/bash
+# Usage: ./scripts/replay.sh run --recording traffic.jsonl --output report.json
+#        ./scripts/replay.sh compare before.json after.json
+# Runs locally, after `pip install -r requirements.txt -r requirements-dev.txt`
+cd "$(dirname "$0")/../server" && python replay.py "$@"
@@ -0,0 +1,3 @@
+#!/bin/bash
+# Usage: ./scripts/restore-db.sh creepy.archive
+docker-compose exec -T db mongorestore --drop --archive < "$1"
@@ -0,0 +1,3 @@
+#!/bin/bash
+# Usage: ./scripts/snapshot-db.sh creepy.archive
+docker-compose exec -T db mongodump --db creepy --archive > "$1"
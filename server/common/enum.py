@@ -3,11 +3,14 @@ from enum import Enum
 
 class ClientAction(Enum):
     NAVIGATE = "navigate"
+    TRAVEL = "travel"
 
     REFRESH_ALL = "refresh_all"
     REFRESH_CURRENT = "refresh_current"
     REFRESH_FLOOR = "refresh_floor"
 
+    SUBSCRIBE_VIEWPORT = "subscribe_viewport"
+
     @classmethod
     def all(cls):
         return list(cls)
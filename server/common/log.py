@@ -0,0 +1,126 @@
+"""
+Non-blocking log pipeline. Records are put on a bounded queue by the thread that logs
+them, and formatted (as JSON, by default) and written by a real OS thread, so logging
+never waits on stdout. Messages are only formatted once they reach that thread, and
+high-volume events can be sampled before they are queued.
+
+"""
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import datetime
+import logging.handlers
+from typing import Dict
+
+from eventlet import patcher
+
+from common import metrics
+
+
+# Attributes every record has, so anything else was passed in `extra`
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object, including any `extra` fields"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.datetime.utcfromtimestamp(record.created).isoformat()
+            + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, val in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                data[key] = val
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a fraction of the records of some event types. A record's event type
+    is its `event` attribute (passed in `extra`), or else its logger's name.
+
+    :param rates: Dict mapping from event type to the fraction of records to keep.
+
+    """
+
+    def __init__(self, rates: Dict[str, float]) -> None:
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(getattr(record, "event", record.name))
+        if rate is None or rate >= 1 or random.random() < rate:
+            return True
+        _SAMPLED_OUT.inc()
+        return False
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Unlike the default, leaves formatting to the listener
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DROPPED.inc()
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def start(self) -> None:
+        # Unlike the default, a real thread even when monkey patched, as writing to
+        # stdout would otherwise block every greenthread
+        self._thread = patcher.original("threading").Thread(
+            target=self._monitor, daemon=True
+        )
+        self._thread.start()
+
+
+def configure(
+    level: str, is_json: bool, queue_size: int, sample_rates: Dict[str, float]
+) -> None:
+    """Routes the root logger through the queue.
+
+    :param level: Name of the lowest level logged.
+    :param is_json: Whether to format records as JSON, rather than plain text.
+    :param queue_size: Records waiting to be written, beyond which more are dropped.
+    :param sample_rates: See `SamplingFilter`.
+
+    """
+    channel = logging.StreamHandler(sys.stdout)
+    if is_json:
+        channel.setFormatter(JsonFormatter())
+    else:
+        channel.setFormatter(
+            logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        )
+
+    records = patcher.original("queue").Queue(queue_size)
+    handler = _QueueHandler(records)
+    handler.addFilter(SamplingFilter(sample_rates))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(handler)
+
+    listener = _QueueListener(records, channel)
+    listener.start()
+    # Write out whatever is still queued
+    atexit.register(listener.stop)
+
+
+_DROPPED = metrics.Counter(
+    "creepy_log_records_dropped_total", "Log records dropped as the queue was full"
+)
+_SAMPLED_OUT = metrics.Counter(
+    "creepy_log_records_sampled_out_total", "Log records dropped by sampling"
+)
@@ -0,0 +1,136 @@
+"""In-process metrics, rendered in the Prometheus text exposition format"""
+import time
+import bisect
+import threading
+import contextlib
+from typing import Callable, Dict, List, Sequence, Tuple
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, description: str) -> None:
+        self.name = name
+        self.description = description
+        self._lock = threading.Lock()
+        _REGISTRY.append(self)
+
+    def samples(self) -> List[Tuple[str, dict, float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Monotonically increasing value, optionally split by labels"""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, description: str) -> None:
+        super().__init__(name, description)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        return [(self.name, dict(k), v) for k, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    """Value which is read from a function whenever metrics are collected"""
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, description: str, func: Callable[[], float]) -> None:
+        super().__init__(name, description)
+        self._func = func
+
+    def samples(self):
+        return [(self.name, {}, self._func())]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, counted into cumulative buckets and optionally
+    split by labels.
+
+    :param buckets: Upper bounds of the buckets, ascending. An unbounded bucket is
+    always added.
+
+    """
+
+    type_name = "histogram"
+
+    def __init__(
+        self, name: str, description: str, buckets: Sequence[float] = None
+    ) -> None:
+        super().__init__(name, description)
+        self.buckets = list(buckets or DEFAULT_BUCKETS)
+        # Per label set: count in each bucket (not yet cumulative), then sum
+        self._values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observes how long the body takes, in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            values = {k: list(v) for k, v in self._values.items()}
+        for key, counts in values.items():
+            labels = dict(key)
+            cumulative = 0
+            for upper, count in zip(self.buckets + ["+Inf"], counts):
+                cumulative += count
+                bucket_labels = {**labels, "le": upper}
+                samples.append((f"{self.name}_bucket", bucket_labels, cumulative))
+            samples.append((f"{self.name}_sum", labels, counts[-1]))
+            samples.append((f"{self.name}_count", labels, cumulative))
+        return samples
+
+
+# Suited to latencies, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+_REGISTRY: List[_Metric] = []
+
+Gauge(
+    "creepy_process_cpu_seconds",
+    "CPU time used by the server process, across all threads",
+    time.process_time,
+)
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in _REGISTRY) + "\n"
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+    return "{" + pairs + "}"
@@ -0,0 +1,170 @@
+"""
+Live diagnostics: a sampling CPU profiler and memory snapshots.
+
+Greenthreads all run on the OS thread of the eventlet hub, so the profiler samples that
+thread from a real (unpatched) OS thread. Whichever greenthread is running is what is
+using the CPU, and the server carries on serving while it is sampled.
+
+"""
+import os
+import sys
+import logging
+import collections
+import tracemalloc
+from typing import Dict, List
+
+import eventlet
+from eventlet import patcher
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Unpatched, so the sampler is a real thread which keeps running while greenthreads do
+_threading = patcher.original("threading")
+_time = patcher.original("time")
+
+# Deepest stack recorded by the profiler
+_MAX_DEPTH = 64
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread at a fixed interval, counting identical stacks.
+    Only one profile runs at a time.
+
+    """
+
+    def __init__(self) -> None:
+        self._lock = _threading.Lock()
+        self._is_running = False
+
+    def profile(self, duration_secs: float, interval_secs: float) -> str:
+        """Profiles the calling OS thread, yielding to other greenthreads until done.
+
+        :param duration_secs: How long to sample for.
+        :param interval_secs: Time between samples.
+        :returns: Sampled stacks in the collapsed format used by flame graph tools,
+        one `frame;frame;frame count` line per distinct stack.
+        :raises ProfilerBusy: If a profile is already running.
+
+        """
+        with self._lock:
+            if self._is_running:
+                raise ProfilerBusy()
+            self._is_running = True
+
+        try:
+            counts = collections.Counter()
+            sampler = _threading.Thread(
+                target=self._sample,
+                args=(_threading.get_ident(), duration_secs, interval_secs, counts),
+                daemon=True,
+            )
+            sampler.start()
+            while sampler.is_alive():
+                eventlet.sleep(min(interval_secs * 10, duration_secs))
+        finally:
+            with self._lock:
+                self._is_running = False
+
+        return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+    # pylint: disable=no-self-use,protected-access
+    def _sample(
+        self,
+        thread_id: int,
+        duration_secs: float,
+        interval_secs: float,
+        counts: collections.Counter,
+    ) -> None:
+        deadline = _time.monotonic() + duration_secs
+        while _time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                counts[_collapse(frame)] += 1
+            _time.sleep(interval_secs)
+
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None and len(names) < _MAX_DEPTH:
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        names.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class MemorySnapshots:
+    """Numbered `tracemalloc` snapshots, which can be compared with each other. Tracing
+    starts with the first snapshot, and costs memory and CPU until stopped.
+
+    :param max_snapshots: Older snapshots are forgotten beyond this many.
+
+    """
+
+    def __init__(self, max_snapshots: int) -> None:
+        self.max_snapshots = max_snapshots
+        self._snapshots: Dict[int, tracemalloc.Snapshot] = collections.OrderedDict()
+        self._next_id = 1
+
+    def take(self) -> int:
+        """Takes a snapshot, starting tracing first if needed.
+
+        :returns: ID of the snapshot.
+
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            LOGGER.info("Started tracing memory allocations")
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        snapshot_id = self._next_id
+        self._next_id += 1
+
+        self._snapshots[snapshot_id] = snapshot
+        while len(self._snapshots) > self.max_snapshots:
+            self._snapshots.popitem(last=False)
+        return snapshot_id
+
+    def top(self, snapshot_id: int, limit: int) -> List[dict]:
+        """Returns the lines which allocated the most memory still held in a snapshot.
+
+        :raises KeyError: If there is no snapshot with that ID.
+
+        """
+        stats = self._snapshots[snapshot_id].statistics("lineno")
+        return [
+            {"location": str(s.traceback), "size": s.size, "count": s.count}
+            for s in stats[:limit]
+        ]
+
+    def diff(self, from_id: int, to_id: int, limit: int) -> List[dict]:
+        """Returns the lines whose held memory grew (or shrank) the most between two
+        snapshots.
+
+        :raises KeyError: If there is no snapshot with either ID.
+
+        """
+        stats = self._snapshots[to_id].compare_to(self._snapshots[from_id], "lineno")
+        return [
+            {
+                "location": str(s.traceback),
+                "size": s.size,
+                "size_diff": s.size_diff,
+                "count": s.count,
+                "count_diff": s.count_diff,
+            }
+            for s in stats[:limit]
+        ]
+
+    def stop(self) -> None:
+        """Stops tracing and forgets all snapshots"""
+        tracemalloc.stop()
+        self._snapshots.clear()
+        LOGGER.info("Stopped tracing memory allocations")
@@ -1,34 +1,152 @@
 import os
-import sys
-import logging
-from pathlib import Path
 
-from common import file_utils
+
+def _parse_sample_rates(value: str) -> dict:
+    """
+    :raises ValueError: If an entry isn't an event type and a rate between 0 and 1.
+
+    """
+    rates = {}
+    for pair in filter(None, value.split(",")):
+        event, _, rate = pair.partition("=")
+        try:
+            rate = float(rate)
+        except ValueError:
+            rate = None
+        if not event or rate is None or not 0 <= rate <= 1:
+            raise ValueError(
+                f"Invalid LOG_SAMPLE_RATES entry {pair!r}, expected <event>=<rate> "
+                "with a rate between 0 and 1"
+            )
+        rates[event] = rate
+    return rates
+
+
+def _parse_level(name: str, default: int, lowest: int, highest: int) -> int:
+    """
+    :raises ValueError: If the setting isn't an integer between `lowest` and `highest`.
+
+    """
+    level = int(os.getenv(name, str(default)))
+    if not lowest <= level <= highest:
+        raise ValueError(f"{name} must be between {lowest} and {highest}, not {level}")
+    return level
 
 
 FLASK_HOST = os.getenv("FLASK_HOST", "0.0.0.0")
 FLASK_PORT = int(os.getenv("FLASK_PORT", "5000"))
 FLASK_DEBUG = os.getenv("FLASK_DEBUG") != "false"
 
+# Where the world and the session are stored: "mongo", "memory" (lost on restart) or
+# "sqlite" (in the file at SQLITE_PATH)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongo")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "creepy.sqlite3")
+
 MONGO_HOST = os.getenv("MONGO_HOST", "db")
 MONGO_PORT = int(os.getenv("MONGO_PORT", "27017"))
 MONGO_DEFAULT_DB = os.getenv("MONGO_DEFAULT_DB", "db")
+# Whether MONGO_HOST is a mongos router, in which case collections are sharded by
+# session when indexes are created
+MONGO_SHARDED = os.getenv("MONGO_SHARDED") == "true"
+# Queries slower than this are logged, along with their query plan
+SLOW_QUERY_SECS = float(os.getenv("SLOW_QUERY_SECS", "0.1"))
+# Fraction of tile documents and MongoDB replies whose size is recorded. Each sampled
+# one is encoded again just to measure it, so keep this low.
+SIZE_SAMPLE_RATE = float(os.getenv("SIZE_SAMPLE_RATE", "0.01"))
+
+# When set, tiles are generated deterministically from this seed and their coordinates,
+# and only visited tiles are stored
+WORLD_SEED = int(os.environ["WORLD_SEED"]) if os.getenv("WORLD_SEED") else None
+
+# gzip level (1-9) used for backgrounds stored in the database. A brotli copy, at
+# BROTLI_QUALITY, is stored alongside to be served as is.
+BACKGROUND_COMPRESSION_LEVEL = _parse_level("BACKGROUND_COMPRESSION_LEVEL", 9, 1, 9)
+
+# Tiles sent to clients reference their background by a URL serving the copy compressed
+# when the tile was stored, rather than embedding the SVG. Set to "true" to embed it as
+# well, for clients which predate that.
+INLINE_BACKGROUNDS = os.getenv("INLINE_BACKGROUNDS") == "true"
+
+# Responses smaller than this (in bytes) are sent uncompressed
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+# Compression level of gzip (1-9) and quality of brotli (0-11) responses
+GZIP_LEVEL = _parse_level("GZIP_LEVEL", 6, 1, 9)
+BROTLI_QUALITY = _parse_level("BROTLI_QUALITY", 6, 0, 11)
+
+# Tiles generated at once, and how many more may queue (for up to the timeout)
+GENERATION_MAX_CONCURRENCY = int(os.getenv("GENERATION_MAX_CONCURRENCY", "4"))
+GENERATION_MAX_QUEUE = int(os.getenv("GENERATION_MAX_QUEUE", "16"))
+GENERATION_TIMEOUT_SECS = float(os.getenv("GENERATION_TIMEOUT_SECS", "5"))
 
-TILE_OUTPUT_DIR = os.getenv(
-    "TILE_OUTPUT_DIR", file_utils.get_data_path("renderer/output")
+# When no generation slot is free, return a placeholder background straight away and
+# render the real one in the background (for up to the timeout)
+PLACEHOLDER_ON_BUSY = os.getenv("PLACEHOLDER_ON_BUSY") == "true"
+PLACEHOLDER_RENDER_TIMEOUT_SECS = float(
+    os.getenv("PLACEHOLDER_RENDER_TIMEOUT_SECS", "60")
 )
-# Ensure exists
-Path(TILE_OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
+
+# Actions submitted within this window are applied together and persisted in one batch.
+# Zero applies and persists each action as soon as it arrives.
+TICK_SECS = float(os.getenv("TICK_SECS", "0.05"))
+# "buffered" keeps each session's latest position in memory, and writes it at most
+# POSITION_FLUSH_SECS later, when a client disconnects, or on shutdown. "immediate"
+# writes it with each tick, so it survives a crash.
+POSITION_DURABILITY = os.getenv("POSITION_DURABILITY", "buffered")
+POSITION_FLUSH_SECS = float(os.getenv("POSITION_FLUSH_SECS", "1"))
+
+# Each session's position, explored tiles and routes are cached in memory by the server
+# handling it, so every client of a session must be routed to the same server (e.g. by
+# hashing the `session` query argument at the load balancer). A session's cache is
+# dropped when its last client disconnects, and beyond this many sessions (or players,
+# for explored tiles and routes) the least recently used are dropped.
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "1000"))
+
+# Events kept in the session's event log
+HISTORY_MAX_LENGTH = int(os.getenv("HISTORY_MAX_LENGTH", "1000"))
+# The session is snapshotted every this many events. Keep well below
+# HISTORY_MAX_LENGTH, so the events after the latest snapshot are still in the log.
+HISTORY_SNAPSHOT_INTERVAL = int(os.getenv("HISTORY_SNAPSHOT_INTERVAL", "100"))
+
+# Events for the same client within this window are coalesced into one frame. Zero
+# sends each event immediately.
+OUTBOX_WINDOW_SECS = float(os.getenv("OUTBOX_WINDOW_SECS", "0.02"))
+
+# Width and height, in tiles, of the buckets used to index client viewports
+VIEWPORT_BUCKET_SIZE = int(os.getenv("VIEWPORT_BUCKET_SIZE", "16"))
+# Largest viewport, in tiles along each axis, a client may subscribe to
+VIEWPORT_MAX_SPAN = int(os.getenv("VIEWPORT_MAX_SPAN", "64"))
+
+# Time spent in each layer while handling an action is recorded as nested spans, and
+# traces slower than the threshold are kept (the most recent, up to the buffer size)
+TRACING_ENABLED = os.getenv("TRACING_ENABLED") != "false"
+TRACE_SLOW_SECS = float(os.getenv("TRACE_SLOW_SECS", "0.25"))
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "100"))
+# When set, slow traces are also appended to this file, one JSON object per line
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH")
+
+# Lowest level logged, and whether records are formatted as "json" or "text"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Records waiting to be written, beyond which more are dropped rather than blocking
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Fraction of records kept, by event type or logger name, e.g.
+# "socket.message=0.01,game.actions=0.5"
+LOG_SAMPLE_RATES = _parse_sample_rates(os.getenv("LOG_SAMPLE_RATES", ""))
+# Logs every engineio packet, which is very verbose
+ENGINEIO_LOGGER = os.getenv("ENGINEIO_LOGGER") == "true"
+
+# When set, incoming socket traffic is appended to this file, for replay.py
+RECORD_PATH = os.getenv("RECORD_PATH")
+
+# Required as a bearer token by the /debug endpoints, which are disabled when unset
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN")
+# Longest CPU profile which may be requested
+PROFILE_MAX_SECS = float(os.getenv("PROFILE_MAX_SECS", "30"))
+# Memory snapshots kept for comparison
+MEMORY_MAX_SNAPSHOTS = int(os.getenv("MEMORY_MAX_SNAPSHOTS", "5"))
 
 
 def configure_logger():
-    root = logging.getLogger()
-    root.setLevel(logging.DEBUG)
-
-    channel = logging.StreamHandler(sys.stdout)
-    channel.setLevel(logging.DEBUG)
-    formatter = logging.Formatter(
-        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-    )
-    channel.setFormatter(formatter)
-    root.addHandler(channel)
+    from common import log
+
+    log.configure(LOG_LEVEL, LOG_FORMAT == "json", LOG_QUEUE_SIZE, LOG_SAMPLE_RATES)
@@ -0,0 +1,137 @@
+"""
+Lightweight nested timing spans. The innermost open span is tracked per thread (per
+greenthread when monkey patched), so spans opened while it is open become its children.
+Finished traces slower than a threshold are kept in a ring buffer, and optionally
+appended to a file.
+
+"""
+import json
+import time
+import logging
+import functools
+import threading
+import contextlib
+import collections
+from typing import List
+
+from common import settings
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Span:
+    """A timed operation, and the operations timed while it was open.
+
+    :param name: What was timed.
+    :param attributes: Details to help tell spans of the same name apart.
+
+    """
+
+    __slots__ = ["name", "attributes", "started_at", "_start", "duration", "children"]
+
+    def __init__(self, name: str, **attributes) -> None:
+        self.name = name
+        self.attributes = attributes
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.duration: float = None
+        self.children: List[Span] = []
+
+    def end(self) -> None:
+        self.duration = time.perf_counter() - self._start
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "attributes": self.attributes,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 3)
+            if self.duration is not None
+            else None,
+            "children": [child.as_dict() for child in self.children],
+        }
+
+
+# Used as the default `parent` of a span, to nest it under the current span
+_CURRENT = object()
+
+
+@contextlib.contextmanager
+def span(name: str, parent=_CURRENT, **attributes):
+    """Times the body as a span.
+
+    :param name: What is being timed.
+    :param parent: Optionally, the span to nest under, e.g. one captured in another
+    thread by `current`. None starts a new trace. Defaults to the current span.
+    :param attributes: Details to help tell spans of the same name apart.
+
+    """
+    if not settings.TRACING_ENABLED:
+        yield None
+        return
+
+    previous = current()
+    if parent is _CURRENT:
+        parent = previous
+
+    new_span = Span(name, **attributes)
+    if parent is not None:
+        parent.children.append(new_span)
+
+    _LOCAL.span = new_span
+    try:
+        yield new_span
+    finally:
+        new_span.end()
+        _LOCAL.span = previous
+        if parent is None:
+            _finish(new_span)
+
+
+def traced(name: str = None):
+    """Decorator which times each call to a function as a span.
+
+    :param name: Name of the span. Defaults to the function's module and name.
+
+    """
+
+    def decorator(func):
+        span_name = name or f"{func.__module__}.{func.__name__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def current() -> Span:
+    """Returns the innermost open span, or None if there isn't one"""
+    return getattr(_LOCAL, "span", None)
+
+
+def get_slow_traces() -> List[dict]:
+    """Returns the most recent traces slower than the threshold, newest first"""
+    return [trace.as_dict() for trace in reversed(_SLOW_TRACES)]
+
+
+def _finish(trace: Span) -> None:
+    if trace.duration < settings.TRACE_SLOW_SECS:
+        return
+
+    _SLOW_TRACES.append(trace)
+    if settings.TRACE_EXPORT_PATH:
+        try:
+            with open(settings.TRACE_EXPORT_PATH, "a") as export_file:
+                export_file.write(json.dumps(trace.as_dict()) + "\n")
+        except OSError:
+            LOGGER.exception("Failed to export trace: name=%s", trace.name)
+
+
+_LOCAL = threading.local()
+
+_SLOW_TRACES = collections.deque(maxlen=settings.TRACE_BUFFER_SIZE)
@@ -1,29 +1,55 @@
 """Available client actions"""
 import logging
+import functools
+from typing import List
 
+from common import tracing
 from common.point import Point
 from common.enum import ClientAction
 from common.enum import Direction
 from game import database
-from game import creator, errors as game_errors
+from game import creator, explored, pathfinder, positions, scheduler
+from game import errors as game_errors
+from game.state import SessionState
 
 
 LOGGER = logging.getLogger(__name__)
 
 
-def get_or_update_current_position():
-    current_pos = database.get_current_position()
+def get_or_update_current_position(session_id: str):
+    current_pos = positions.get(session_id)
     if current_pos:
         return current_pos
 
     default_pos = Point(0, 0, 0)
-    database.update_current_position(default_pos)
+    positions.update(session_id, default_pos)
     return default_pos
 
 
-def get_available_actions():
-    current_pos = get_or_update_current_position()
-    current_tile = creator.get_or_create_tile(current_pos)
+def flush_current_position(session_id: str):
+    """Writes the session's position, if a change to it is still buffered"""
+    positions.flush(session_id)
+
+
+def evict_session(session_id: str):
+    """Writes the session's buffered position, then forgets everything cached about
+    the session, once the actions already submitted to it have been applied. Called
+    when its last client disconnects.
+
+    """
+    scheduler.run(session_id, _evict_session)
+
+
+def _evict_session(state: SessionState):
+    positions.evict(state.session_id)
+    explored.evict(state.session_id)
+    pathfinder.evict(state.session_id)
+    LOGGER.info("Evicted session: session_id=%s", state.session_id)
+
+
+def get_available_actions(session_id: str):
+    current_pos = get_or_update_current_position(session_id)
+    current_tile = creator.get_or_create_tile(session_id, current_pos)
 
     actions = []
     for _side, vals in current_tile["sides"].items():
@@ -43,23 +69,145 @@ def get_target_dir(current_pos: Point, target_pos):
     return None
 
 
-def get_all_visited_tiles():
-    return database.get_all_visited_tiles()
+@tracing.traced()
+def get_all_visited_tiles(session_id: str, player_id: str, fields: List[str] = None):
+    """
+    Returns a dict mapping from floor to a list of tiles the player has visited
+    """
+    floor_to_tiles = {}
+    for z in database.get_explored_floors(session_id, player_id):
+        floor_to_tiles[str(z)] = get_visited_tiles_on_floor(
+            session_id, player_id, z, fields
+        )
+
+    if not floor_to_tiles:
+        return None
+    return floor_to_tiles
+
+
+@tracing.traced()
+def get_visited_tiles_on_floor(
+    session_id: str, player_id: str, z: int, fields: List[str] = None
+):
+    positions = explored.positions(session_id, player_id, z)
+    return database.get_tiles(session_id, positions, fields)
+
+
+def get_current_tile(session_id: str, fields: List[str] = None):
+    current_pos = get_or_update_current_position(session_id)
+    return database.get_tile(session_id, current_pos, fields)
+
+
+def get_tile(session_id: str, pos: Point, fields: List[str] = None):
+    return database.get_tile(session_id, pos, fields)
+
+
+def get_encoded_background(session_id: str, pos: Point, encoding: str):
+    return database.get_encoded_background(session_id, pos, encoding)
 
 
-def create_initial_tile():
-    current_pos = get_or_update_current_position()
-    LOGGER.info("Received request to create initial tile: current_pos= %s", current_pos)
-    tile = creator.get_or_create_tile(current_pos)
-    tile["is_visited"] = True
-    database.insert_or_update_tile(current_pos, tile)
-    database.update_current_position(current_pos)
+def complete_placeholder(session_id: str, target_pos: Point):
+    return creator.complete_placeholder(session_id, target_pos)
+
+
+@tracing.traced()
+def get_visited_tiles_in_range(
+    session_id: str,
+    player_id: str,
+    z: int,
+    x0: int,
+    x1: int,
+    y0: int,
+    y1: int,
+    after: Point = None,
+    limit: int = 100,
+):
+    """Returns visited tiles on a floor within a bounding box, ordered by x then y.
+
+    :param after: Optionally, the position of the last tile on the previous page.
+    :param limit: Maximum number of tiles to return.
+    :returns: Tuple of the tiles, and the position to pass as `after` to fetch the
+    next page (or None if this is the last page).
+
+    """
+    positions = explored.positions(session_id, player_id, z, x0, x1, y0, y1)
+    if after:
+        positions = [p for p in positions if (p.x, p.y) > (after.x, after.y)]
+
+    tiles = database.get_tiles(session_id, positions[:limit])
+    tiles.sort(key=lambda t: (t["position"].x, t["position"].y))
+    next_after = positions[limit - 1] if len(positions) > limit else None
+    return tiles, next_after
+
+
+def get_visited_tiles_in_range_version(
+    session_id: str, player_id: str, z: int, x0: int, x1: int, y0: int, y1: int
+):
+    """Returns a tuple of the newest tile version and the number of visited tiles on a
+    floor within a bounding box. Changes whenever a tile in the range does, or another
+    tile in it is visited.
+
+    """
+    version, _count = database.get_tiles_in_range_version(session_id, z, x0, x1, y0, y1)
+    return version, len(explored.positions(session_id, player_id, z, x0, x1, y0, y1))
+
+
+def get_session_log(session_id: str, since: int = None, limit: int = 100):
+    return database.get_session_log(session_id, since, limit)
+
+
+def get_query_stats():
+    return database.get_query_stats()
+
+
+@tracing.traced()
+def create_initial_tile(session_id: str, player_id: str):
+    current_pos = get_or_update_current_position(session_id)
+    LOGGER.info(
+        "Received request to create initial tile: session_id=%s, current_pos=%s",
+        session_id,
+        current_pos,
+    )
+    # Rendered before the tick, like the targets of navigate
+    tile = creator.get_or_create_tile(session_id, current_pos)
+    visit = functools.partial(_visit_initial_tile, player_id, current_pos, tile)
+    scheduler.run(session_id, visit)
     LOGGER.info("Successfully created initial tile: current_pos=%s", current_pos)
     return tile
 
 
-def navigate(target_pos: Point):
-    current_pos = get_or_update_current_position()
+def _visit_initial_tile(player_id: str, pos: Point, tile: dict, state: SessionState):
+    state.mark_visited(player_id, pos, tile)
+
+
+@tracing.traced()
+def prepare_navigate(session_id: str, target_pos: Point):
+    """Creates the tile a navigate would move to, before the action is submitted, so
+    it is rendered concurrently with other sessions' actions rather than during a
+    tick. Nothing is created for targets which aren't adjacent to the current
+    position, which `navigate` rejects anyway.
+
+    :returns: The target tile, or None.
+    :raises game_errors.GenerationBusy: If no generation slot became available in
+    time.
+
+    """
+    current_pos = get_or_update_current_position(session_id)
+    if not get_target_dir(current_pos, target_pos):
+        return None
+    return creator.get_or_create_tile(session_id, target_pos)
+
+
+@tracing.traced()
+def navigate(
+    player_id: str, target_pos: Point, state: SessionState, target_tile: dict = None
+):
+    """
+    :param player_id: Player whose explored tiles to add the target to.
+    :param target_tile: Optionally, the target tile returned by `prepare_navigate`.
+
+    """
+    current_pos = state.get_current_position()
     LOGGER.info(
         "Received request to navigate: current_pos=%s, target_pos=%s",
         current_pos,
@@ -67,8 +215,8 @@ def navigate(target_pos: Point):
     )
 
     # Validate this action is possible
-    available_actions = get_available_actions()
-    if ClientAction.NAVIGATE not in available_actions:
+    current_tile = state.get_or_create_tile(current_pos)
+    if not any(not side["is_blocked"] for side in current_tile["sides"].values()):
         raise game_errors.InvalidAction("You can't navigate from where you are")
 
     if current_pos == target_pos:
@@ -79,8 +227,8 @@ def navigate(target_pos: Point):
     if not target_dir:
         raise game_errors.InvalidAction("That tile is too far away")
 
-    current_tile = creator.get_or_create_tile(current_pos)
-    target_tile = creator.get_or_create_tile(target_pos)
+    if target_tile is None:
+        target_tile = state.get_or_create_tile(target_pos)
     if target_dir in Direction.all_nesw():
         # Validate current tile is not blocked on this side
         if current_tile["sides"][target_dir.value]["is_blocked"]:
@@ -94,10 +242,57 @@ def navigate(target_pos: Point):
 
     # Mark tile as visited (prevents user from refreshing and seeing adjacent tiles
     # which exist in the database but they have not accessed)
-    target_tile["is_visited"] = True
-    database.insert_or_update_tile(target_pos, target_tile)
-
-    database.update_current_position(target_pos)
+    state.mark_visited(player_id, target_pos, target_tile)
+    state.set_current_position(target_pos)
+    state.record(
+        ClientAction.NAVIGATE.value, player=player_id, target_pos=target_pos.serialize()
+    )
 
     LOGGER.info("Successfully navigated: target_pos=%s", target_pos)
     return target_tile
+
+
+@tracing.traced()
+def travel(player_id: str, target_pos: Point, state: SessionState):
+    """Moves to a distant tile the player has visited, along the shortest route they
+    know.
+
+    :returns: Tuple of the target tile, and the positions passed through.
+
+    """
+    current_pos = state.get_current_position()
+    LOGGER.info(
+        "Received request to travel: current_pos=%s, target_pos=%s",
+        current_pos,
+        target_pos,
+    )
+
+    if current_pos == target_pos:
+        raise game_errors.InvalidAction("You're already on that tile")
+
+    if not state.is_explored(player_id, target_pos):
+        raise game_errors.InvalidAction("You haven't been there yet")
+
+    # The party may have been moved here by another player, but this one can see where
+    # they stand, so can travel from it
+    current_tile = None
+    if not state.is_explored(player_id, current_pos):
+        current_tile = state.get_or_create_tile(current_pos)
+
+    extra = [(current_pos, current_tile)] if current_tile else None
+    path = state.shortest_path(player_id, current_pos, target_pos, extra=extra)
+    if not path:
+        raise game_errors.InvalidAction("You don't know the way there")
+
+    if current_tile:
+        state.mark_visited(player_id, current_pos, current_tile)
+
+    state.set_current_position(target_pos)
+    state.record(
+        ClientAction.TRAVEL.value, player=player_id, target_pos=target_pos.serialize()
+    )
+
+    LOGGER.info(
+        "Successfully travelled: target_pos=%s, num_steps=%d", target_pos, len(path) - 1
+    )
+    return state.get_or_create_tile(target_pos), path
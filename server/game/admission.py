@@ -0,0 +1,119 @@
+"""
+Limits how many tiles are generated at once. Requests beyond the limit wait in a
+bounded queue until a slot frees up or their deadline passes, and are rejected
+immediately once the queue is full, so a burst of exploration degrades into fast
+`GenerationBusy` errors rather than unbounded latency for everyone.
+
+"""
+import time
+import logging
+import threading
+import contextlib
+
+from common import metrics, settings
+from game import errors
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AdmissionController:
+    """
+    :param max_concurrency: Maximum number of admitted callers at once.
+    :param max_queue: Maximum number of callers waiting for a slot.
+    :param timeout_secs: How long a caller may wait for a slot.
+
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int, timeout_secs: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout_secs = timeout_secs
+
+        self.num_active = 0
+        self.num_waiting = 0
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def admit(self, timeout_secs: float = None):
+        """Holds a slot for the duration of the block.
+
+        :param timeout_secs: Optionally, override how long to wait for a slot. Zero
+        means don't wait at all.
+        :raises errors.GenerationBusy: If the queue is full, or no slot frees up
+        before the deadline.
+
+        """
+        self._acquire(self.timeout_secs if timeout_secs is None else timeout_secs)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.num_active -= 1
+                self._cond.notify()
+
+    def _acquire(self, timeout_secs: float):
+        start = time.monotonic()
+        deadline = start + timeout_secs
+
+        with self._cond:
+            if self.num_active >= self.max_concurrency:
+                if self.num_waiting >= self.max_queue:
+                    _REJECTED.inc(reason="queue_full")
+                    raise errors.GenerationBusy("Too many tiles are being generated")
+
+                self.num_waiting += 1
+                try:
+                    while self.num_active >= self.max_concurrency:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            _REJECTED.inc(reason="deadline")
+                            _WAIT_SECS.observe(
+                                time.monotonic() - start, outcome="deadline"
+                            )
+                            raise errors.GenerationBusy(
+                                "Timed out waiting to generate tile"
+                            )
+                        self._cond.wait(remaining)
+                finally:
+                    self.num_waiting -= 1
+
+            self.num_active += 1
+
+        wait_secs = time.monotonic() - start
+        _ADMITTED.inc()
+        _WAIT_SECS.observe(wait_secs, outcome="admitted")
+        if wait_secs > 0.1:
+            LOGGER.info("Waited for tile generation slot: secs=%.3f", wait_secs)
+
+
+_CONTROLLER = AdmissionController(
+    settings.GENERATION_MAX_CONCURRENCY,
+    settings.GENERATION_MAX_QUEUE,
+    settings.GENERATION_TIMEOUT_SECS,
+)
+
+_ADMITTED = metrics.Counter(
+    "creepy_generation_admitted_total", "Tile generations admitted"
+)
+_REJECTED = metrics.Counter(
+    "creepy_generation_rejected_total", "Tile generations rejected, by reason"
+)
+_WAIT_SECS = metrics.Histogram(
+    "creepy_generation_wait_seconds",
+    "Time tile generations spent queued for a slot, by outcome",
+)
+metrics.Gauge(
+    "creepy_generation_active",
+    "Tile generations in progress",
+    lambda: _CONTROLLER.num_active,
+)
+metrics.Gauge(
+    "creepy_generation_queue_depth",
+    "Tile generations waiting for a slot",
+    lambda: _CONTROLLER.num_waiting,
+)
+
+
+def admit(timeout_secs: float = None):
+    return _CONTROLLER.admit(timeout_secs)
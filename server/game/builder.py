@@ -3,92 +3,196 @@ Low-level abstraction over building tiles. Cares about retries and interfacing w
 the underlying tile generating logic.
 
 """
+import math
 import random
 import logging
-from typing import Dict
+from typing import Dict, List, Set
 
 import renderer
+from renderer import placeholder
 from renderer.common.exit_config import ExitConfig
-from game import database
-from common import file_utils
+from game import database, procedural
+from common import metrics, tracing
 from common.point import Point
 from common.enum import TileType, Direction
 
 LOGGER = logging.getLogger(__name__)
 
+_MAX_BLOCKED_SIDES = 2
+
 
 class TileBuilder:
-    def __init__(self, target: Point, tile_type: TileType, prob_blockage: float):
+    """Builds a tile's sides and background.
+
+    :param session_id: Session the tile belongs to, whose stored edges it shares.
+    :param target: Position of the tile.
+    :param tile_type: Which renderer to use.
+    :param prob_blockage: Probability of each side being blocked.
+    :param world_seed: Optionally, derive all randomness from this seed and `target`
+    instead, so the tile can be regenerated identically without being stored.
+
+    """
+
+    def __init__(
+        self,
+        session_id: str,
+        target: Point,
+        tile_type: TileType,
+        prob_blockage: float,
+        world_seed: int = None,
+    ):
+        self.session_id = session_id
         self.target = target
         self.tile_type = tile_type
         self.prob_blockage = prob_blockage
-
-    def __call__(self):
+        self.world_seed = world_seed
+        self.rng = (
+            random
+            if world_seed is None
+            else procedural.rng(world_seed, target, "builder")
+        )
+
+    def __call__(self, sides: dict = None):
+        """
+        :param sides: Optionally, reuse the sides of an existing (e.g. placeholder)
+        tile rather than creating them.
+
+        """
         tile = {}
-        tile["is_visited"] = False
-        tile["sides"] = self._create_sides()
+        with tracing.span("builder.create_sides"):
+            tile["sides"] = sides if sides else self._create_sides()
 
-        exit_configs = []
-        for _, direction_str in enumerate(side for side in tile["sides"]):
-            is_blocked = tile["sides"][direction_str]["is_blocked"]
-            edge_position = tile["sides"][direction_str]["edge_position"]
-            direction = Direction.from_string(direction_str)
-            exit_configs.append(ExitConfig(direction, edge_position, is_blocked))
+        exit_configs = _exit_configs(tile["sides"])
 
         render_mod = renderer.get_renderer(self.tile_type)
 
         num_attempts = 0
         while True:
             try:
-                resp = render_mod.render_tile(exit_configs)
+                with _RENDER_SECS.time(tile_type=self.tile_type.value), tracing.span(
+                    "builder.render",
+                    tile_type=self.tile_type.value,
+                    attempt=num_attempts,
+                ):
+                    resp = self._render(render_mod, exit_configs, num_attempts)
                 break
             except ValueError:
                 # TODO: Fix root cause
                 num_attempts += 1
+                _RENDER_RETRIES.inc(tile_type=self.tile_type.value)
                 if num_attempts >= 10:
                     raise Exception(
                         "Unexpected problem rendering tile: "
                         + f"exit_configs={exit_configs}"
                     )
-                LOGGER.warning("Failed to render tile: exit_configs={exit_configs}")
+                LOGGER.warning("Failed to render tile: exit_configs=%s", exit_configs)
 
-        file_dir, entities, exits_pos, filename = resp
+        entities, exits_pos, background = resp
         tile["entity_candidates"] = [p.serialize() for p in entities]
         tile["exits_pos"] = {d.value: e for d, e in exits_pos.items()}
-        tile["background"] = file_utils.load_text_file(file_dir, filename)
+        tile["background"] = background
 
         return tile
 
-    def _create_sides(self) -> Dict[Direction, dict]:
-        sides = {}
-
-        for direction in Direction.all_nesw():
-            side = {"is_blocked": self._random_is_blocked()}
+    def placeholder(self):
+        """Builds a tile with a cheap placeholder background, derived from its sides"""
+        tile = {}
+        tile["is_placeholder"] = True
+        tile["sides"] = self._create_sides()
 
-            adjacent_tile = database.get_tile(self.target.translate(direction))
-            if adjacent_tile:
-                opposite_dir = Direction.mirror_of(direction)
-                opposite_edge_pos = adjacent_tile["sides"][opposite_dir.value][
-                    "edge_position"
-                ]
-                side["edge_position"] = opposite_edge_pos
-            else:
-                side["edge_position"] = self._random_edge_position(direction)
+        exits_pos, background = placeholder.render_tile(_exit_configs(tile["sides"]))
+        tile["entity_candidates"] = []
+        tile["exits_pos"] = {d.value: e for d, e in exits_pos.items()}
+        tile["background"] = background
 
-            sides[direction.value] = side
+        return tile
 
-        # Retry on 3+ blocked exits
-        num_blocked = sum([s["is_blocked"] for s in sides.values()])
-        if num_blocked >= 3:
-            return self._create_sides()
+    def _render(self, render_mod, exit_configs, num_attempts: int):
+        if self.world_seed is None:
+            return render_mod.render_tile(exit_configs)
 
-        return sides
+        # Retries need a different seed, or they would fail in the same way
+        render_seed = procedural.rng(
+            self.world_seed, self.target, f"render_{num_attempts}"
+        ).getrandbits(64)
+        with procedural.seeded_global_random(render_seed):
+            return render_mod.render_tile(exit_configs)
 
-    def _random_is_blocked(self) -> bool:
-        return random.randint(1, 10) <= (self.prob_blockage * 10)
+    def _create_sides(self) -> Dict[Direction, dict]:
+        directions = Direction.all_nesw()
+        blocked = self._random_blocked_sides()
+
+        if self.world_seed is not None:
+            return {
+                d.value: {
+                    "is_blocked": d in blocked,
+                    "edge_position": procedural.edge_position(
+                        self.world_seed, self.target, d
+                    ),
+                }
+                for d in directions
+            }
+
+        # Edges are shared with adjacent tiles, so fetch any which already exist
+        keys = {
+            d: database.edge_key(self.target, self.target.translate(d))
+            for d in directions
+        }
+        edge_positions = database.get_edge_positions(
+            self.session_id, list(keys.values())
+        )
+
+        missing = {
+            keys[d]: self._random_edge_position(d)
+            for d in directions
+            if keys[d] not in edge_positions
+        }
+        if missing:
+            edge_positions.update(
+                database.insert_edge_positions(self.session_id, missing)
+            )
+
+        return {
+            d.value: {
+                "is_blocked": d in blocked,
+                "edge_position": edge_positions[keys[d]],
+            }
+            for d in directions
+        }
+
+    def _random_blocked_sides(self) -> Set[Direction]:
+        """Each side is blocked with probability `prob_blockage`, conditioned on at
+        most two sides being blocked. Samples the number of blocked sides first, rather
+        than rejecting and resampling.
+
+        """
+        prob = self.prob_blockage
+        weights = [
+            math.comb(4, k) * (prob ** k) * ((1 - prob) ** (4 - k))
+            for k in range(_MAX_BLOCKED_SIDES + 1)
+        ]
+        num_blocked = self.rng.choices(range(_MAX_BLOCKED_SIDES + 1), weights)[0]
+        return set(self.rng.sample(Direction.all_nesw(), num_blocked))
 
-    # pylint: disable=no-self-use
     def _random_edge_position(self, direction: Direction) -> int:
         if direction in {Direction.UP, Direction.DOWN}:
-            return random.randint(1, 4)
-        return random.randint(1, 3)
+            return self.rng.randint(1, 4)
+        return self.rng.randint(1, 3)
+
+
+def _exit_configs(sides: dict) -> List[ExitConfig]:
+    exit_configs = []
+    for direction_str, side in sides.items():
+        direction = Direction.from_string(direction_str)
+        exit_configs.append(
+            ExitConfig(direction, side["edge_position"], side["is_blocked"])
+        )
+    return exit_configs
+
+
+_RENDER_SECS = metrics.Histogram(
+    "creepy_tile_render_seconds", "Time taken to render a tile, by tile type"
+)
+_RENDER_RETRIES = metrics.Counter(
+    "creepy_tile_render_retries_total", "Tile renders which failed and were retried"
+)
@@ -5,43 +5,132 @@ High-level abstraction over tile generation. Cares about "balancing" the game.
 import random
 import logging
 
+from common import settings, tracing
 from common.point import Point
 from common.enum import TileType, EntityType
+from game import admission
 from game import builder
 from game import database
+from game import errors
+from game import procedural
 
 
 LOGGER = logging.getLogger(__name__)
 
 
-def get_or_create_tile(target: Point) -> dict:
-    existing_tile = database.get_tile(target)
+@tracing.traced()
+def get_or_create_tile(session_id: str, target: Point) -> dict:
+    existing_tile = database.get_tile(session_id, target)
     if existing_tile:
         return existing_tile
 
-    return _create_tile(target)
+    return _create_tile(session_id, target)
 
 
-def _create_tile(target) -> dict:
-    new_tile = builder.TileBuilder(target, _tile_type(), _prob_blockage())()
-    new_tile = _add_entities(new_tile, target)
-    new_tile = _add_cards(new_tile)
+@tracing.traced()
+def build_tile(session_id: str, target: Point, sides: dict = None) -> dict:
+    """Generates a tile without storing it.
 
-    database.insert_or_update_tile(target, new_tile)
+    :param session_id: Session the tile belongs to, whose edges it shares.
+    :param target: Position of the tile.
+    :param sides: Optionally, reuse the sides of an existing (e.g. placeholder) tile.
+
+    """
+    tile_builder, rng = _tile_builder(session_id, target)
+    new_tile = tile_builder(sides)
+    new_tile = _add_entities(new_tile, target, rng)
+    return _add_cards(new_tile)
+
+
+@tracing.traced()
+def complete_placeholder(session_id: str, target: Point) -> dict:
+    """Renders the full background of a placeholder tile and stores it.
+
+    :returns: The completed tile, or None if there was no stored placeholder to
+    complete (or it is already being completed).
+    :raises errors.GenerationBusy: If no generation slot became available in time.
+
+    """
+    key = (session_id, target.serialize())
+    if key in _COMPLETING:
+        return None
+
+    _COMPLETING.add(key)
+    try:
+        tile = database.get_tile(session_id, target)
+        if not tile or not tile.get("is_placeholder"):
+            return None
+
+        with admission.admit(settings.PLACEHOLDER_RENDER_TIMEOUT_SECS):
+            rendered = build_tile(session_id, target, sides=tile["sides"])
+
+        updates = {k: rendered[k] for k in _RENDERED_FIELDS}
+        database.update_tile_render(session_id, target, updates)
+    finally:
+        _COMPLETING.discard(key)
+
+    tile.pop("is_placeholder")
+    tile.update(updates)
+    LOGGER.info(
+        "Completed placeholder tile: session_id=%s, target=%s", session_id, target
+    )
+    return tile
+
+
+# Sessions and positions of placeholder tiles currently being completed. Each is
+# removed once its completion ends, so this only grows with the work in flight.
+_COMPLETING = set()
+
+# Fields which differ between a placeholder and the fully rendered tile
+_RENDERED_FIELDS = ["background", "exits_pos", "entity_candidates", "entities"]
+
+
+def _create_tile(session_id: str, target: Point) -> dict:
+    if settings.PLACEHOLDER_ON_BUSY:
+        # Rather than queueing, fall back to a placeholder which can be completed later
+        try:
+            with admission.admit(timeout_secs=0):
+                new_tile = build_tile(session_id, target)
+        except errors.GenerationBusy:
+            LOGGER.info("Generating placeholder tile: target=%s", target)
+            new_tile = _tile_builder(session_id, target)[0].placeholder()
+            new_tile["entities"] = {}
+    else:
+        with admission.admit():
+            new_tile = build_tile(session_id, target)
+
+    if settings.WORLD_SEED is None and not database.insert_tiles(
+        session_id, [(target, new_tile)]
+    ):
+        # Created concurrently, e.g. by another player of the session, whose tile wins
+        return database.get_tile(session_id, target)
+    # With a seed, the tile can be regenerated identically, so is stored once visited
     return new_tile
 
 
-def _add_entities(tile, target) -> dict:
+def _tile_builder(session_id: str, target: Point):
+    world_seed = settings.WORLD_SEED
+    rng = (
+        random if world_seed is None else procedural.rng(world_seed, target, "creator")
+    )
+
+    tile_builder = builder.TileBuilder(
+        session_id, target, _tile_type(rng), _prob_blockage(), world_seed=world_seed
+    )
+    return tile_builder, rng
+
+
+def _add_entities(tile, target, rng=random) -> dict:
     used = set()
     tile["entities"] = {}
     candidates = tile["entity_candidates"][:]
-    random.shuffle(candidates)
+    rng.shuffle(candidates)
     valid_entities = _get_valid_entities(target)
     for pos in [Point.deserialize(c) for c in candidates]:
         unused = [e for e in valid_entities if e not in used]
-        random.shuffle(unused)
+        rng.shuffle(unused)
         for entity in unused:
-            if random.uniform(0, 1) > _ENTITY_PROBS[entity]:
+            if rng.uniform(0, 1) > _ENTITY_PROBS[entity]:
                 continue
             tile["entities"][entity.value] = {"pos": pos}
             used.add(entity)
@@ -70,9 +159,9 @@ _ENTITY_PROBS = {
 }
 
 
-def _tile_type() -> TileType:
+def _tile_type(rng=random) -> TileType:
     prob_cavern = 0.3
-    return TileType.CAVERN if random.uniform(0, 1) <= prob_cavern else TileType.TUNNEL
+    return TileType.CAVERN if rng.uniform(0, 1) <= prob_cavern else TileType.TUNNEL
 
 
 _TILE_PROBS = {TileType.CAVERN: 0.3, TileType.TUNNEL: 0.7}
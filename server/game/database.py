@@ -1,89 +1,560 @@
 import copy
+import gzip
+import time
+import random
+import datetime
+import zlib
 import logging
+import functools
 import collections
+from typing import Dict, List
 
-import pymongo
+import bson
+import brotli
+from bson.binary import Binary
 
-from common import settings
+from common import metrics, settings, tracing
 from common.point import Point
+from common.enum import Direction
+from game import storage
 
 LOGGER = logging.getLogger(__name__)
 
-_CLIENT = pymongo.MongoClient(settings.MONGO_HOST, settings.MONGO_PORT)
+# Where everything is stored. Tiles are serialized, and events numbered, before they
+# are handed to it.
+_STORAGE = storage.create(settings.STORAGE_BACKEND)
 
+# Prefixed to stored backgrounds to identify how they were compressed
+_BACKGROUND_FORMAT_ZLIB = b"\x01"
+_BACKGROUND_FORMAT_GZIP = b"\x02"
 
-def get_current_position() -> Point:
-    creepy_db = _CLIENT["creepy"]
-    collection = creepy_db["tiles"]
+# Explored bitmaps are split into square chunks of this width, so each row of a chunk
+# is one bitmask which fits in a (non-negative) 64-bit integer
+EXPLORED_CHUNK_SIZE = 32
 
-    doc = collection.find_one({}, {"session.current_position": 1})
+_OP_SECS = metrics.Histogram(
+    "creepy_db_operation_seconds", "Latency of database operations, by operation"
+)
+_DOCUMENT_BYTES = metrics.Histogram(
+    "creepy_db_document_bytes",
+    "Size of a sample of tile documents read and written, by direction",
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576),
+)
+
+
+def _timed(func):
+    """Records the latency of a database operation, labelled with its name, and traces
+    it
+
+    """
+    span_name = f"database.{func.__name__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with _OP_SECS.time(operation=func.__name__), tracing.span(span_name):
+            return func(*args, **kwargs)
+
+    return wrapper
 
-    if doc:
-        return Point.deserialize(doc["session"]["current_position"])
-    return None
 
+@_timed
+def get_current_position(session_id: str) -> Point:
+    return _STORAGE.get_current_position(session_id)
 
-def update_current_position(new_pos: Point) -> Point:
-    creepy_db = _CLIENT["creepy"]
-    collection = creepy_db["tiles"]
 
-    updates = {"session.current_position": new_pos.serialize()}
-    return collection.update_one({}, {"$set": updates}, upsert=True)
+@_timed
+def update_current_position(session_id: str, new_pos: Point):
+    _STORAGE.set_current_position(session_id, new_pos)
+
+
+def ensure_indexes():
+    _STORAGE.ensure_indexes()
+
+
+@_timed
+def get_tiles_in_range_version(
+    session_id: str, z: int, x0: int, x1: int, y0: int, y1: int
+):
+    """Returns a tuple of the newest tile version and the number of tiles on a floor
+    within a bounding box. Changes whenever a tile in the range does.
+
+    """
+    return _STORAGE.get_tiles_in_range_version(session_id, z, x0, x1, y0, y1)
+
 
+@_timed
+def get_tile_positions_in_range(
+    session_id: str, z: int, x0: int, x1: int, y0: int, y1: int
+) -> List[Point]:
+    """Returns the positions of all created tiles, visited or not, on a floor within a
+    bounding box.
 
-def get_all_visited_tiles():
     """
-    Returns a dict mapping from floor to a list of visited tiles
+    return _STORAGE.get_tile_positions_in_range(session_id, z, x0, x1, y0, y1)
+
+
+@_timed
+def get_tiles(
+    session_id: str, points: List[Point], fields: List[str] = None
+) -> List[dict]:
+    """Returns the tiles which have been created at the given positions, in no
+    particular order.
+
+    :param session_id: Session the tiles belong to.
+    :param points: Positions of the tiles.
+    :param fields: Optionally, the tile fields to fetch. Defaults to all fields.
+
     """
-    creepy_db = _CLIENT["creepy"]
-    collection = creepy_db["tiles"]
+    docs = _STORAGE.get_tiles(session_id, points, fields)
+    return [_deserialize_doc(doc) for doc in docs]
+
+
+@_timed
+def get_tile(session_id: str, point: Point, fields: List[str] = None):
+    """Returns the tile at a position, or None if it has not been created.
+
+    :param session_id: Session the tile belongs to.
+    :param point: Position of the tile.
+    :param fields: Optionally, the tile fields to fetch. Defaults to all fields.
 
-    doc = collection.find_one({f"session.floors": {"$exists": True}})
+    """
+    doc = _STORAGE.get_tile(session_id, point, fields)
     if not doc:
         return None
 
-    floor_to_tiles = collections.defaultdict(list)
-    floors = doc["session"]["floors"]
-    for floor, val in floors.items():
-        for pos, tile in val["tiles"].items():
-            if not tile["is_visited"]:
+    return _deserialize_doc(doc)
+
+
+@_timed
+def apply_session_changes(
+    session_id: str,
+    visited: List[tuple],
+    current_pos: Point = None,
+    events: List[dict] = None,
+    write_position: bool = True,
+):
+    """Persists the changes made to a session during one tick, with one batched write
+    to the tiles, one to the session and one append to the session's event log.
+
+    :param session_id: Session the changes were made to.
+    :param visited: List of `(player_id, Point, tile)` tuples for tiles which were
+    visited. Tiles which are not stored yet are inserted, and each is marked explored
+    by the player who visited it.
+    :param current_pos: Optionally, the new current position.
+    :param events: Optionally, events to append to the session's event log. An event
+    is also logged for each visited tile which had to be inserted.
+    :param write_position: Whether to write `current_pos` with the session. If not
+    (when it is written behind by `game.positions`), it is only used for snapshots.
+
+    """
+    events = list(events or [])
+
+    if visited:
+        tiles = {}
+        explored = collections.defaultdict(list)
+        for player_id, point, tile in visited:
+            explored[player_id].append(point)
+            if point.serialize() in tiles:
                 continue
+            tile_cpy = copy.deepcopy(tile)
+            tile_cpy.pop("position", None)
+            tiles[point.serialize()] = (point, _serialize_tile(tile_cpy))
+        tiles = list(tiles.values())
+        inserted = _STORAGE.insert_tiles(session_id, tiles, time.time_ns())
+        for player_id, points in explored.items():
+            mark_explored(session_id, player_id, points)
+
+        # Tiles are created before they are visited, so log their creation first
+        events[:0] = [
+            _event("tile_created", pos=tiles[index][0].serialize())
+            for index in inserted
+        ]
+
+    session = _STORAGE.advance_session(
+        session_id, len(events), current_pos if write_position else None
+    )
+    if current_pos:
+        session["current_position"] = current_pos.serialize()
+
+    if events:
+        _append_events(session_id, session, events)
+
+
+@_timed
+def get_session_log(session_id: str, since: int = None, limit: int = 100):
+    """Returns the session's events after a sequence number. If they are no longer all
+    in the log (or no sequence number is given), starts from the latest snapshot
+    instead.
 
-            point = Point.deserialize(pos)
-            point.z = int(floor)
-            tile["position"] = point
-            floor_to_tiles[floor].append(_deserialize_pos(tile))
+    :param since: Optionally, sequence number of the last event already seen.
+    :param limit: Maximum number of events to return.
+    :returns: Tuple of the snapshot the events follow (or None if they follow
+    `since`), and the events ordered by sequence number.
 
-    return floor_to_tiles
+    """
+    snapshot = None
+    oldest_seq = _STORAGE.get_oldest_event_seq(session_id)
+    if since is None or (oldest_seq is not None and since + 1 < oldest_seq):
+        snapshot = _STORAGE.get_latest_snapshot(session_id)
+        since = snapshot["seq"] if snapshot else 0
+
+    return snapshot, _STORAGE.get_events(session_id, since, limit)
 
 
-def get_tile(point: Point):
-    creepy_db = _CLIENT["creepy"]
-    collection = creepy_db["tiles"]
+@_timed
+def update_tile_render(session_id: str, point: Point, updates: dict):
+    """Replaces the rendered fields of a stored (placeholder) tile, leaving the rest of
+    the tile as it is.
 
-    str_floor = str(point.z)
-    str_point = point.serialize(strip_z=True)
+    :param point: Position of the tile.
+    :param updates: Dict mapping from tile field to its new value.
 
-    doc = collection.find_one(
-        {f"session.floors.{str_floor}.tiles.{str_point}": {"$exists": True}}
+    """
+    fields = _serialize_tile(copy.deepcopy(updates))
+    _STORAGE.set_tile_fields(
+        session_id, point, fields, time.time_ns(), unset=["is_placeholder"]
     )
+
+
+@_timed
+def insert_tiles(session_id: str, tiles: List[tuple]) -> int:
+    """Inserts tiles in one unordered batch, and logs the creation of each to the
+    session's event log. Tiles which already exist are left as they are.
+
+    :param tiles: List of `(Point, tile)` tuples.
+    :returns: Number of tiles inserted.
+
+    """
+    serialized = []
+    for point, tile in tiles:
+        tile_cpy = copy.deepcopy(tile)
+        # Implied by the coordinates
+        tile_cpy.pop("position", None)
+        serialized.append((point, _serialize_tile(tile_cpy)))
+    inserted = _STORAGE.insert_tiles(session_id, serialized, time.time_ns())
+
+    if inserted:
+        events = [
+            _event("tile_created", pos=tiles[index][0].serialize())
+            for index in inserted
+        ]
+        session = _STORAGE.advance_session(session_id, len(events), num_ticks=0)
+        _append_events(session_id, session, events)
+    return len(inserted)
+
+
+@_timed
+def get_explored_chunks(
+    session_id: str, player_id: str, z: int
+) -> Dict[tuple, Dict[int, int]]:
+    """Returns the bitmap of tiles a player has explored on a floor.
+
+    :param session_id: Session the player is playing in.
+    :param player_id: Player.
+    :param z: Floor.
+    :returns: Dict mapping from `(cx, cy)` chunk coordinates to the chunk's non-empty
+    rows, as a dict mapping from row to bitmask. See `EXPLORED_CHUNK_SIZE`.
+
+    """
+    return _STORAGE.get_explored_chunks(session_id, player_id, z)
+
+
+@_timed
+def get_explored_floors(session_id: str, player_id: str) -> List[int]:
+    """Returns the floors on which a player has explored at least one tile"""
+    return _STORAGE.get_explored_floors(session_id, player_id)
+
+
+@_timed
+def mark_explored(session_id: str, player_id: str, points: List[Point]):
+    """Sets the bits of the given positions in a player's explored bitmap, with one
+    update per chunk touched.
+
+    """
+    chunks = collections.defaultdict(lambda: collections.defaultdict(int))
+    for point in points:
+        cx, bit = divmod(point.x, EXPLORED_CHUNK_SIZE)
+        cy, row = divmod(point.y, EXPLORED_CHUNK_SIZE)
+        chunks[(point.z, cx, cy)][row] |= 1 << bit
+
+    if chunks:
+        _STORAGE.mark_explored(session_id, player_id, chunks)
+
+
+def edge_key(p1: Point, p2: Point) -> str:
+    """Identifies the edge shared by two adjacent tiles on the same floor, regardless
+    of the order they are given in.
+
+    """
+    first, second = sorted([(p1.x, p1.y), (p2.x, p2.y)])
+    return f"z={p1.z}:x={first[0]},y={first[1]}:x={second[0]},y={second[1]}"
+
+
+@_timed
+def get_edge_positions(session_id: str, keys: List[str]) -> Dict[str, int]:
+    """Returns a dict mapping from edge key to edge position, for the edges which have
+    been created.
+
+    """
+    return _STORAGE.get_edge_positions(session_id, keys)
+
+
+@_timed
+def insert_edge_positions(session_id: str, positions: Dict[str, int]) -> Dict[str, int]:
+    """Creates edges which do not exist yet. If an edge was created concurrently, its
+    existing position wins.
+
+    :param positions: Dict mapping from edge key to edge position.
+    :returns: Dict mapping from edge key to the stored edge position.
+
+    """
+    inserted = set(_STORAGE.insert_edge_positions(session_id, positions))
+    stored = {key: positions[key] for key in inserted}
+    if len(stored) < len(positions):
+        missing = [k for k in positions if k not in inserted]
+        stored.update(get_edge_positions(session_id, missing))
+    return stored
+
+
+def migrate_legacy_sessions(session_id: str) -> int:
+    """Assigns everything stored before there were sessions to a session. Must run
+    before the other migrations, which only see what belongs to their session.
+
+    :returns: Number of documents assigned.
+
+    """
+    return _STORAGE.migrate_legacy_sessions(session_id)
+
+
+def migrate_legacy_edges(session_id: str) -> int:
+    """Registers the edges of tiles created before edges were stored separately.
+
+    :returns: Number of edges registered.
+
+    """
+    positions = {}
+    for doc in _STORAGE.iter_tiles(session_id, fields=["sides"]):
+        point = Point(doc["x"], doc["y"], doc["z"])
+        for direction, side in doc["tile"]["sides"].items():
+            adjacent = point.translate(Direction.from_string(direction))
+            positions[edge_key(point, adjacent)] = side["edge_position"]
+
+    if not positions:
+        return 0
+    return len(insert_edge_positions(session_id, positions))
+
+
+def migrate_legacy_tiles(session_id: str) -> int:
+    """Moves tiles nested in the session document into their own documents.
+
+    :returns: Number of tiles moved.
+
+    """
+    return _STORAGE.migrate_legacy_tiles(session_id)
+
+
+def migrate_legacy_visited(session_id: str, player_id: str) -> int:
+    """Moves the visited flag stored on each tile into a player's explored bitmap.
+
+    :returns: Number of visited tiles moved.
+
+    """
+    points = _STORAGE.pop_legacy_visited(session_id)
+    mark_explored(session_id, player_id, points)
+    return len(points)
+
+
+def migrate_legacy_history(session_id: str) -> int:
+    """Moves history entries embedded in the session document into the event log.
+
+    :returns: Number of entries moved.
+
+    """
+    events = _STORAGE.pop_legacy_history(session_id)
+    if events:
+        session = _STORAGE.advance_session(session_id, len(events), num_ticks=0)
+        _append_events(session_id, session, events)
+    return len(events)
+
+
+def compress_all_backgrounds(session_id: str) -> int:
+    """Compresses backgrounds which were stored before compression was introduced.
+
+    :returns: Number of backgrounds compressed.
+
+    """
+    num_compressed = 0
+    for doc in _STORAGE.iter_tiles(session_id, fields=["background"]):
+        background = doc["tile"].get("background")
+        if not isinstance(background, str):
+            continue
+        point = Point(doc["x"], doc["y"], doc["z"])
+        updates = _serialize_tile({"background": background})
+        _STORAGE.set_tile_fields(session_id, point, updates, time.time_ns())
+        num_compressed += 1
+
+    return num_compressed
+
+
+@_timed
+def get_encoded_background(session_id: str, point: Point, encoding: str) -> bytes:
+    """Returns the stored background of a tile compressed with an HTTP content coding,
+    so it can be served without compressing it again.
+
+    :param encoding: "gzip" or "br".
+    :returns: The compressed background, or None if there is no tile at the position
+    or no copy stored in that coding (e.g. it was stored by an older version).
+
+    """
+    doc = _STORAGE.get_tile(session_id, point, fields=["background", "background_br"])
     if not doc:
         return None
 
-    return _deserialize_pos(doc["session"]["floors"][str_floor]["tiles"][str_point])
+    if encoding == "br":
+        background = doc["tile"].get("background_br")
+        return bytes(background) if background is not None else None
+    if encoding == "gzip":
+        background = doc["tile"].get("background")
+        if isinstance(background, str):
+            return None
+        fmt, data = bytes(background[:1]), bytes(background[1:])
+        return data if fmt == _BACKGROUND_FORMAT_GZIP else None
+    return None
+
+
+def get_background_stats() -> dict:
+    """Returns compression ratio and decode cost of backgrounds handled so far"""
+    return _BACKGROUND_STATS.as_dict()
 
 
-def insert_or_update_tile(point: Point, tile: dict):
-    creepy_db = _CLIENT["creepy"]
-    collection = creepy_db["tiles"]
+def get_query_stats() -> List[dict]:
+    """Returns latency and reply size of the queries sent so far, by query shape. Only
+    the Mongo backend monitors its queries.
+
+    """
+    return _STORAGE.get_query_stats()
+
+
+class _BackgroundStats:
+    def __init__(self):
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.num_decoded = 0
+        self.decode_secs = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "raw_bytes": self.raw_bytes,
+            "stored_bytes": self.stored_bytes,
+            "compression_ratio": (
+                self.raw_bytes / self.stored_bytes if self.stored_bytes else None
+            ),
+            "num_decoded": self.num_decoded,
+            "decode_secs_per_tile": (
+                self.decode_secs / self.num_decoded if self.num_decoded else None
+            ),
+        }
+
+
+_BACKGROUND_STATS = _BackgroundStats()
+
+
+def _compress_background(background: str) -> Binary:
+    """Compresses a background with gzip, which is also an HTTP content coding"""
+    raw = background.encode("utf-8")
+    compressed = _BACKGROUND_FORMAT_GZIP + gzip.compress(
+        raw, compresslevel=settings.BACKGROUND_COMPRESSION_LEVEL, mtime=0
+    )
+
+    _BACKGROUND_STATS.raw_bytes += len(raw)
+    _BACKGROUND_STATS.stored_bytes += len(compressed)
+    return Binary(compressed)
+
+
+def _compress_background_br(background: str) -> Binary:
+    compressed = brotli.compress(
+        background.encode("utf-8"), quality=settings.BROTLI_QUALITY
+    )
+    return Binary(compressed)
 
-    str_floor = str(point.z)
-    str_point = point.serialize(strip_z=True)
 
-    tile_cpy = _serialize_pos(copy.deepcopy(tile))
-    updates = {f"session.floors.{str_floor}.tiles.{str_point}": tile_cpy}
+def _decompress_background(background) -> str:
+    if isinstance(background, str):
+        # Stored before compression was introduced
+        return background
 
-    return collection.update_one({}, {"$set": updates}, upsert=True)
+    start = time.perf_counter()
+    fmt, data = bytes(background[:1]), bytes(background[1:])
+    if fmt == _BACKGROUND_FORMAT_GZIP:
+        decompressed = gzip.decompress(data).decode("utf-8")
+    elif fmt == _BACKGROUND_FORMAT_ZLIB:
+        decompressed = zlib.decompress(data).decode("utf-8")
+    else:
+        raise ValueError(f"Unsupported background format: {fmt}")
+
+    _BACKGROUND_STATS.num_decoded += 1
+    _BACKGROUND_STATS.decode_secs += time.perf_counter() - start
+    return decompressed
+
+
+def _event(event_type: str, **details) -> dict:
+    event = {
+        "time": datetime.datetime.utcnow().isoformat() + "Z",
+        "type": event_type,
+    }
+    event.update(details)
+    return event
+
+
+def _append_events(session_id: str, session: dict, events: List[dict]):
+    """Numbers events, ending at the session's last sequence number, and logs them.
+    Snapshots the session whenever a multiple of the snapshot interval is passed.
+
+    """
+    last_seq = session["last_seq"]
+    first_seq = last_seq - len(events) + 1
+    for seq, event in enumerate(events, start=first_seq):
+        event["seq"] = seq
+
+    snapshot = None
+    interval = settings.HISTORY_SNAPSHOT_INTERVAL
+    if last_seq // interval > (first_seq - 1) // interval:
+        snapshot = {
+            "seq": last_seq,
+            "time": datetime.datetime.utcnow().isoformat() + "Z",
+            "current_position": session.get("current_position"),
+            "current_tick": session.get("current_tick", 0),
+        }
+    _STORAGE.append_events(session_id, events, snapshot)
+
+
+def _deserialize_doc(doc: dict) -> dict:
+    if random.random() < settings.SIZE_SAMPLE_RATE:
+        _DOCUMENT_BYTES.observe(len(bson.encode(doc)), direction="read")
+    tile = _deserialize_tile(doc["tile"])
+    tile["position"] = Point(doc["x"], doc["y"], doc["z"])
+    return tile
+
+
+def _serialize_tile(tile: dict) -> dict:
+    if "background" in tile:
+        # Stored alongside, to be served to clients which accept brotli
+        tile["background_br"] = _compress_background_br(tile["background"])
+        tile["background"] = _compress_background(tile["background"])
+    tile = _serialize_pos(tile)
+    if random.random() < settings.SIZE_SAMPLE_RATE:
+        _DOCUMENT_BYTES.observe(len(bson.encode(tile)), direction="write")
+    return tile
+
+
+def _deserialize_tile(tile: dict) -> dict:
+    # Decompress last, so the background is not mistaken for a serialized `Point`
+    tile = _deserialize_pos(tile)
+    # Only served by `get_encoded_background`
+    tile.pop("background_br", None)
+    if "background" in tile:
+        tile["background"] = _decompress_background(tile["background"])
+    return tile
 
 
 def _serialize_pos(obj: dict) -> dict:
@@ -1,2 +1,6 @@
 class InvalidAction(Exception):
     pass
+
+
+class GenerationBusy(Exception):
+    pass
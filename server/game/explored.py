@@ -0,0 +1,142 @@
+"""
+Tiles explored by each player of each session, as in-memory bitmaps mirroring those in
+the database.
+A floor is loaded the first time it is needed, after which lookups are O(1) and
+listing a floor only scans its bitmap. A session's sets are forgotten when it is
+evicted, as are the least recently used beyond `settings.SESSION_CACHE_SIZE`.
+
+"""
+import logging
+import functools
+import collections
+from typing import Callable, Dict, List
+
+from common import settings
+from common.point import Point
+from game import database
+
+
+LOGGER = logging.getLogger(__name__)
+
+_CHUNK_SIZE = database.EXPLORED_CHUNK_SIZE
+
+
+class ExploredSet:
+    """Bitmap of the tiles explored by one player, grouped by floor then chunk.
+
+    :param load_floor: Returns the stored chunks of a floor, in the format of
+    `database.get_explored_chunks`. Called the first time a floor is needed.
+
+    """
+
+    def __init__(self, load_floor: Callable[[int], Dict[tuple, dict]]) -> None:
+        self._load_floor = load_floor
+        self._floors: Dict[int, Dict[tuple, Dict[int, int]]] = {}
+
+    def add(self, point: Point) -> None:
+        cx, bit = divmod(point.x, _CHUNK_SIZE)
+        cy, row = divmod(point.y, _CHUNK_SIZE)
+        rows = self._floor(point.z).setdefault((cx, cy), {})
+        rows[row] = rows.get(row, 0) | 1 << bit
+
+    def contains(self, point: Point) -> bool:
+        cx, bit = divmod(point.x, _CHUNK_SIZE)
+        cy, row = divmod(point.y, _CHUNK_SIZE)
+        rows = self._floor(point.z).get((cx, cy))
+        return bool(rows and rows.get(row, 0) >> bit & 1)
+
+    def positions(
+        self, z: int, x0: int = None, x1: int = None, y0: int = None, y1: int = None
+    ) -> List[Point]:
+        """Returns explored positions on a floor, ordered by x then y.
+
+        :param z: Floor.
+        :param x0: Optionally, lower x bound, inclusive.
+        :param x1: Optionally, upper x bound, inclusive.
+        :param y0: Optionally, lower y bound, inclusive.
+        :param y1: Optionally, upper y bound, inclusive.
+
+        """
+        positions = []
+        for (cx, cy), rows in self._floor(z).items():
+            left, bottom = cx * _CHUNK_SIZE, cy * _CHUNK_SIZE
+            if not _overlaps(left, left + _CHUNK_SIZE - 1, x0, x1):
+                continue
+            if not _overlaps(bottom, bottom + _CHUNK_SIZE - 1, y0, y1):
+                continue
+
+            for row, mask in rows.items():
+                y = bottom + row
+                if not _overlaps(y, y, y0, y1):
+                    continue
+                while mask:
+                    low_bit = mask & -mask
+                    x = left + low_bit.bit_length() - 1
+                    if _overlaps(x, x, x0, x1):
+                        positions.append(Point(x, y, z))
+                    mask ^= low_bit
+
+        positions.sort(key=lambda p: (p.x, p.y))
+        return positions
+
+    def _floor(self, z: int) -> Dict[tuple, Dict[int, int]]:
+        if z not in self._floors:
+            self._floors[z] = self._load_floor(z)
+            LOGGER.info(
+                "Loaded explored bitmap: z=%s, num_chunks=%d", z, len(self._floors[z])
+            )
+        return self._floors[z]
+
+
+def _overlaps(lower: int, upper: int, bound_lower: int, bound_upper: int) -> bool:
+    if bound_lower is not None and upper < bound_lower:
+        return False
+    if bound_upper is not None and lower > bound_upper:
+        return False
+    return True
+
+
+# Dict mapping from `(session_id, player_id)` to the player's explored set, ordered
+# from least to most recently used
+_SETS: Dict[tuple, ExploredSet] = collections.OrderedDict()
+
+
+def _explored(session_id: str, player_id: str) -> ExploredSet:
+    key = (session_id, player_id)
+    if key in _SETS:
+        _SETS.move_to_end(key)
+        return _SETS[key]
+
+    _SETS[key] = ExploredSet(
+        functools.partial(database.get_explored_chunks, session_id, player_id)
+    )
+    while len(_SETS) > settings.SESSION_CACHE_SIZE:
+        _SETS.popitem(last=False)
+    return _SETS[key]
+
+
+def evict(session_id: str) -> None:
+    """Forgets a session's explored sets, which are reloaded when next needed"""
+    for key in [key for key in _SETS if key[0] == session_id]:
+        del _SETS[key]
+
+
+def add(session_id: str, player_id: str, point: Point) -> None:
+    """Marks a position explored in memory. Persisted by `database.mark_explored`."""
+    _explored(session_id, player_id).add(point)
+
+
+def contains(session_id: str, player_id: str, point: Point) -> bool:
+    return _explored(session_id, player_id).contains(point)
+
+
+def positions(
+    session_id: str,
+    player_id: str,
+    z: int,
+    x0: int = None,
+    x1: int = None,
+    y0: int = None,
+    y1: int = None,
+) -> List[Point]:
+    return _explored(session_id, player_id).positions(z, x0, x1, y0, y1)
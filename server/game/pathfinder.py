@@ -0,0 +1,187 @@
+"""
+Finds routes over the graph of tiles each player has visited. Keeps a per-floor
+adjacency index per player in memory, which is loaded from the database on first use
+and kept up to date as tiles are visited. A session's indexes are forgotten when it is
+evicted, as are the least recently used beyond `settings.SESSION_CACHE_SIZE`.
+
+"""
+import logging
+import functools
+import collections
+from typing import Callable, Dict, List, Set
+
+from common import settings
+from common.point import Point
+from common.enum import Direction, EntityType
+from game import database, explored
+
+
+LOGGER = logging.getLogger(__name__)
+
+_STAIRS = {
+    EntityType.STAIRS_UP.value: Direction.ABOVE,
+    EntityType.STAIRS_UP_SECRET.value: Direction.ABOVE,
+    EntityType.STAIRS_DOWN.value: Direction.BELOW,
+    EntityType.STAIRS_DOWN_SECRET.value: Direction.BELOW,
+}
+
+
+class _Node:
+    """Ways out of a single visited tile"""
+
+    def __init__(self, open_sides: Set[Direction], stairs: Set[Direction]) -> None:
+        self.open_sides = open_sides
+        self.stairs = stairs
+
+    @classmethod
+    def from_tile(cls, tile: dict):
+        open_sides = {
+            Direction.from_string(direction)
+            for direction, side in tile["sides"].items()
+            if not side["is_blocked"]
+        }
+        stairs = {_STAIRS[e] for e in tile.get("entities", {}) if e in _STAIRS}
+        return cls(open_sides, stairs)
+
+
+class AdjacencyIndex:
+    """Visited tiles, grouped by floor, along with the ways out of each.
+
+    :param load_floor: Returns the visited tiles on a floor. Called the first time a
+    floor is needed.
+
+    """
+
+    def __init__(self, load_floor: Callable[[int], List[dict]]) -> None:
+        self._load_floor = load_floor
+        self._floors: Dict[int, Dict[tuple, _Node]] = {}
+
+    def add_tile(self, point: Point, tile: dict) -> None:
+        self._floor(point.z)[(point.x, point.y)] = _Node.from_tile(tile)
+
+    def contains(self, point: Point) -> bool:
+        return (point.x, point.y) in self._floor(point.z)
+
+    def neighbours(self, point: Point, extra: Dict[tuple, _Node] = None) -> List[Point]:
+        """Returns visited tiles reachable in one step, honouring blocked sides on both
+        tiles and following stairs between floors.
+
+        :param extra: Optionally, nodes of tiles visited but not added yet, by `(x, y,
+        z)` position.
+
+        """
+        node = self._node(point, extra)
+        if not node:
+            return []
+
+        neighbours = []
+        for direction in node.open_sides:
+            adjacent = point.translate(direction)
+            adjacent_node = self._node(adjacent, extra)
+            if not adjacent_node:
+                continue
+            if Direction.mirror_of(direction) in adjacent_node.open_sides:
+                neighbours.append(adjacent)
+
+        for direction in node.stairs:
+            adjacent = point.translate(direction)
+            if adjacent.z >= 0 and self._node(adjacent, extra):
+                neighbours.append(adjacent)
+
+        return neighbours
+
+    def _node(self, point: Point, extra: Dict[tuple, _Node] = None) -> _Node:
+        if extra and (point.x, point.y, point.z) in extra:
+            return extra[(point.x, point.y, point.z)]
+        return self._floor(point.z).get((point.x, point.y))
+
+    def _floor(self, z: int) -> Dict[tuple, _Node]:
+        if z not in self._floors:
+            floor = {}
+            for tile in self._load_floor(z):
+                floor[(tile["position"].x, tile["position"].y)] = _Node.from_tile(tile)
+            self._floors[z] = floor
+            LOGGER.info("Loaded adjacency index: z=%s, num_tiles=%d", z, len(floor))
+        return self._floors[z]
+
+
+def _load_floor(session_id: str, player_id: str, z: int) -> List[dict]:
+    positions = explored.positions(session_id, player_id, z)
+    return database.get_tiles(session_id, positions, fields=["sides", "entities"])
+
+
+# Dict mapping from `(session_id, player_id)` to the player's adjacency index, ordered
+# from least to most recently used
+_INDEXES: Dict[tuple, AdjacencyIndex] = collections.OrderedDict()
+
+
+def _index(session_id: str, player_id: str) -> AdjacencyIndex:
+    key = (session_id, player_id)
+    if key in _INDEXES:
+        _INDEXES.move_to_end(key)
+        return _INDEXES[key]
+
+    _INDEXES[key] = AdjacencyIndex(
+        functools.partial(_load_floor, session_id, player_id)
+    )
+    while len(_INDEXES) > settings.SESSION_CACHE_SIZE:
+        _INDEXES.popitem(last=False)
+    return _INDEXES[key]
+
+
+def evict(session_id: str) -> None:
+    """Forgets a session's adjacency indexes, which are rebuilt when next needed"""
+    for key in [key for key in _INDEXES if key[0] == session_id]:
+        del _INDEXES[key]
+
+
+def add_visited_tile(session_id: str, player_id: str, point: Point, tile: dict) -> None:
+    _index(session_id, player_id).add_tile(point, tile)
+
+
+def shortest_path(
+    session_id: str,
+    player_id: str,
+    start: Point,
+    target: Point,
+    pending: List[tuple] = None,
+) -> List[Point]:
+    """Breadth-first search over the tiles a player has visited.
+
+    :param session_id: Session the player is playing in.
+    :param player_id: Player whose visited tiles to search.
+    :param start: Position to start from.
+    :param target: Position to reach.
+    :param pending: Optionally, `(Point, tile)` tuples of tiles the player has visited
+    which aren't persisted, so aren't in the index yet.
+    :returns: Positions from `start` to `target` inclusive, or None if there is no
+    route.
+
+    """
+    start_key = (start.x, start.y, start.z)
+    target_key = (target.x, target.y, target.z)
+
+    index = _index(session_id, player_id)
+    extra = {(p.x, p.y, p.z): _Node.from_tile(tile) for p, tile in pending or []}
+    previous = {start_key: None}
+    queue = collections.deque([start])
+    while queue:
+        current = queue.popleft()
+        if (current.x, current.y, current.z) == target_key:
+            break
+
+        for neighbour in index.neighbours(current, extra):
+            key = (neighbour.x, neighbour.y, neighbour.z)
+            if key in previous:
+                continue
+            previous[key] = current
+            queue.append(neighbour)
+
+    if target_key not in previous:
+        return None
+
+    path = [target]
+    while path[-1] != start:
+        prev = previous[(path[-1].x, path[-1].y, path[-1].z)]
+        path.append(prev)
+    return list(reversed(path))
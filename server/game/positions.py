@@ -0,0 +1,187 @@
+"""
+Write-behind cache of each session's current position. Once loaded, positions are read
+from memory. Changes are buffered, so only the latest is written, at most
+`settings.POSITION_FLUSH_SECS` later, when a client of the session disconnects, or on
+shutdown. With "immediate" durability, each change is written as it is made instead.
+Positions are forgotten once written, when the session is evicted or is the least
+recently used beyond `settings.SESSION_CACHE_SIZE`.
+
+"""
+import atexit
+import logging
+import threading
+import collections
+from typing import Callable, Dict, Set
+
+from common import metrics, settings
+from common.point import Point
+from game import database
+
+
+LOGGER = logging.getLogger(__name__)
+
+DURABILITY_BUFFERED = "buffered"
+DURABILITY_IMMEDIATE = "immediate"
+
+
+class PositionBuffer:
+    """
+    :param load: Called with a session id to read its position from the database.
+    :param store: Called with a session id and a position to write it to the database.
+    :param flush_secs: Longest a change is buffered for.
+    :param is_immediate: Whether to write changes as they are made instead.
+    :param max_sessions: Beyond this many, the positions of the least recently used
+    sessions are forgotten, once written.
+
+    """
+
+    def __init__(
+        self,
+        load: Callable[[str], Point],
+        store: Callable[[str, Point], None],
+        flush_secs: float,
+        is_immediate: bool,
+        max_sessions: int,
+    ) -> None:
+        self.load = load
+        self.store = store
+        self.flush_secs = flush_secs
+        self.is_immediate = is_immediate
+        self.max_sessions = max_sessions
+
+        # Ordered from least to most recently used
+        self._positions: Dict[str, Point] = collections.OrderedDict()
+        self._dirty: Set[str] = set()
+        self._flush_timer: threading.Timer = None
+        # Held while writing, so an older position can't overwrite a newer one
+        self._lock = threading.RLock()
+
+    def get(self, session_id: str) -> Point:
+        """Returns a session's position, including changes not written yet, or None if
+        it doesn't have one
+
+        """
+        with self._lock:
+            if session_id not in self._positions:
+                self._cache(session_id, self.load(session_id))
+            else:
+                self._positions.move_to_end(session_id)
+            return self._positions[session_id]
+
+    def set(self, session_id: str, point: Point) -> None:
+        with self._lock:
+            self._cache(session_id, point)
+            if self.is_immediate:
+                self.store(session_id, point)
+                _WRITTEN.inc()
+                return
+
+            if session_id in self._dirty:
+                _COALESCED.inc()
+            self._dirty.add(session_id)
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.flush_secs, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def remember(self, session_id: str, point: Point) -> None:
+        """Caches a position which has already been written"""
+        with self._lock:
+            self._dirty.discard(session_id)
+            self._cache(session_id, point)
+
+    def evict(self, session_id: str) -> None:
+        """Writes a session's buffered change, if any, then forgets its position"""
+        with self._lock:
+            self.flush(session_id)
+            if session_id not in self._dirty:
+                self._positions.pop(session_id, None)
+
+    def _cache(self, session_id: str, point: Point) -> None:
+        self._positions[session_id] = point
+        self._positions.move_to_end(session_id)
+        self._trim()
+
+    def _trim(self) -> None:
+        # The most recently used is always kept. So are changes not written yet, which
+        # are forgotten by the flush writing them.
+        excess = len(self._positions) - max(self.max_sessions, 1)
+        for oldest in list(self._positions)[: max(excess, 0)]:
+            if oldest not in self._dirty:
+                del self._positions[oldest]
+                _EVICTED.inc()
+
+    def flush(self, session_id: str = None) -> None:
+        """Writes buffered changes.
+
+        :param session_id: Optionally, the only session to write the change of.
+
+        """
+        with self._lock:
+            session_ids = [session_id] if session_id else list(self._dirty)
+            for dirty_session in session_ids:
+                if dirty_session not in self._dirty:
+                    continue
+                try:
+                    self.store(dirty_session, self._positions[dirty_session])
+                except Exception:  # pylint: disable=broad-except
+                    # Kept dirty, so retried by the next flush
+                    LOGGER.exception(
+                        "Failed to write position: session_id=%s", dirty_session
+                    )
+                    continue
+                self._dirty.discard(dirty_session)
+                _WRITTEN.inc()
+
+            if not session_id:
+                self._flush_timer = None
+            self._trim()
+
+
+def get(session_id: str) -> Point:
+    return _BUFFER.get(session_id)
+
+
+def update(session_id: str, point: Point) -> None:
+    _BUFFER.set(session_id, point)
+
+
+def remember(session_id: str, point: Point) -> None:
+    _BUFFER.remember(session_id, point)
+
+
+def flush(session_id: str = None) -> None:
+    _BUFFER.flush(session_id)
+
+
+def evict(session_id: str) -> None:
+    _BUFFER.evict(session_id)
+
+
+def is_immediate() -> bool:
+    return _BUFFER.is_immediate
+
+
+_WRITTEN = metrics.Counter(
+    "creepy_positions_written_total", "Session positions written to the database"
+)
+_COALESCED = metrics.Counter(
+    "creepy_positions_coalesced_total",
+    "Session position changes superseded before they were written",
+)
+
+_EVICTED = metrics.Counter(
+    "creepy_positions_evicted_total",
+    "Session positions forgotten because too many sessions were cached",
+)
+
+_BUFFER = PositionBuffer(
+    load=database.get_current_position,
+    store=database.update_current_position,
+    flush_secs=settings.POSITION_FLUSH_SECS,
+    is_immediate=settings.POSITION_DURABILITY == DURABILITY_IMMEDIATE,
+    max_sessions=settings.SESSION_CACHE_SIZE,
+)
+
+# Write whatever is still buffered
+atexit.register(_BUFFER.flush)
@@ -0,0 +1,56 @@
+"""
+Derives tile generation randomness from a world seed and coordinates, so the same
+tile is always generated the same way and adjacent tiles agree on their shared edges
+without looking each other up.
+
+"""
+import random
+import hashlib
+import contextlib
+
+from common.point import Point
+from common.enum import Direction
+from game import database
+
+
+def rng(world_seed: int, point: Point, purpose: str) -> random.Random:
+    """Returns a random number generator which is a pure function of its arguments.
+
+    :param world_seed: Seed shared by every tile in the world.
+    :param point: Position of the tile.
+    :param purpose: Distinguishes independent streams for the same tile.
+
+    """
+    return random.Random(_hash(world_seed, point.z, point.x, point.y, purpose))
+
+
+def edge_position(world_seed: int, point: Point, direction: Direction) -> int:
+    """Returns the position of the edge on a side of a tile. Both tiles sharing the edge
+    get the same answer.
+
+    """
+    key = database.edge_key(point, point.translate(direction))
+    edge_rng = random.Random(_hash(world_seed, key))
+    if direction in {Direction.UP, Direction.DOWN}:
+        return edge_rng.randint(1, 4)
+    return edge_rng.randint(1, 3)
+
+
+@contextlib.contextmanager
+def seeded_global_random(seed: int):
+    """Seeds the module-level generator used by the renderers, restoring its previous
+    state afterwards. Rendering never yields to other greenthreads, so they cannot
+    observe the swap.
+
+    """
+    state = random.getstate()
+    random.seed(seed)
+    try:
+        yield
+    finally:
+        random.setstate(state)
+
+
+def _hash(*parts) -> int:
+    data = ":".join(str(p) for p in parts).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
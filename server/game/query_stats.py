@@ -0,0 +1,231 @@
+"""
+Monitors the commands sent to MongoDB. Latency and (sampled) reply size are aggregated
+by query shape, i.e. the command, collection and filter with its values blanked out, so
+that queries which only differ in their values are counted together. Slow queries are
+logged along with the plan MongoDB chose for them.
+
+"""
+import json
+import time
+import random
+import logging
+import threading
+from typing import Callable, Dict, List
+
+import bson
+from pymongo import monitoring
+
+from common import metrics, settings
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Where each command keeps the filter it matches documents with
+_FILTER_FIELDS = {
+    "find": "filter",
+    "count": "query",
+    "distinct": "query",
+    "findAndModify": "query",
+}
+
+# Commands the query planner can explain
+_EXPLAINABLE = {"find", "count", "distinct", "aggregate", "update", "delete"}
+
+# Beyond this, further shapes are counted together, so stats stay bounded
+_MAX_SHAPES = 1000
+
+# A shape is explained at most once in this interval
+_EXPLAIN_INTERVAL_SECS = 60
+
+
+class _ShapeStats:
+    def __init__(self, command: str, collection: str, shape: str) -> None:
+        self.command = command
+        self.collection = collection
+        self.shape = shape
+        self.count = 0
+        self.num_failed = 0
+        self.num_slow = 0
+        self.total_secs = 0.0
+        self.max_secs = 0.0
+        self.reply_bytes = 0
+        self.num_sized = 0
+        self.explained_at = 0.0
+        self.plan: dict = None
+
+    def as_dict(self) -> dict:
+        return {
+            "command": self.command,
+            "collection": self.collection,
+            "shape": self.shape,
+            "count": self.count,
+            "num_failed": self.num_failed,
+            "num_slow": self.num_slow,
+            "total_secs": self.total_secs,
+            "max_secs": self.max_secs,
+            "mean_reply_bytes": (
+                self.reply_bytes / self.num_sized if self.num_sized else 0
+            ),
+            "plan": self.plan,
+        }
+
+
+class QueryStatsListener(monitoring.CommandListener):
+    """
+    :param explain: Optionally, called with a database name and a command to return
+    its query plan, for slow queries.
+
+    """
+
+    def __init__(self, explain: Callable[[str, dict], dict] = None) -> None:
+        self.explain = explain
+        self._stats: Dict[tuple, _ShapeStats] = {}
+        # Shape key and command of each command in flight, by request ID
+        self._started: Dict[int, tuple] = {}
+        self._lock = threading.Lock()
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        key = _shape_key(event.command_name, event.command)
+        with self._lock:
+            self._started[event.request_id] = (key, event.database_name, event.command)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        secs = event.duration_micros / 1e6
+        _COMMAND_SECS.observe(secs, command=event.command_name)
+        # The driver doesn't report reply sizes, so only a sample is encoded again
+        reply_bytes = None
+        if random.random() < settings.SIZE_SAMPLE_RATE:
+            reply_bytes = len(bson.encode(event.reply))
+            _REPLY_BYTES.observe(reply_bytes, command=event.command_name)
+        self._record(event.request_id, secs, reply_bytes=reply_bytes)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        secs = event.duration_micros / 1e6
+        _COMMAND_SECS.observe(secs, command=event.command_name)
+        self._record(event.request_id, secs, is_failed=True)
+
+    def get_stats(self) -> List[dict]:
+        """Returns stats for each query shape, most total time first"""
+        with self._lock:
+            stats = [s.as_dict() for s in self._stats.values()]
+        return sorted(stats, key=lambda s: s["total_secs"], reverse=True)
+
+    def _record(
+        self, request_id: int, secs: float, reply_bytes: int = None, is_failed=False
+    ) -> None:
+        with self._lock:
+            started = self._started.pop(request_id, None)
+            if not started:
+                return
+            key, database_name, command = started
+
+            if key not in self._stats and len(self._stats) >= _MAX_SHAPES:
+                key = (key[0], key[1], "other")
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = _ShapeStats(*key)
+
+            stats.count += 1
+            stats.total_secs += secs
+            stats.max_secs = max(stats.max_secs, secs)
+            if reply_bytes is not None:
+                stats.reply_bytes += reply_bytes
+                stats.num_sized += 1
+            stats.num_failed += int(is_failed)
+
+            is_slow = secs >= settings.SLOW_QUERY_SECS
+            should_explain = (
+                is_slow
+                and self.explain is not None
+                and key[0] in _EXPLAINABLE
+                and time.monotonic() - stats.explained_at >= _EXPLAIN_INTERVAL_SECS
+            )
+            if is_slow:
+                stats.num_slow += 1
+            if should_explain:
+                stats.explained_at = time.monotonic()
+
+        if not is_slow:
+            return
+
+        LOGGER.warning(
+            "Slow query: command=%s, collection=%s, shape=%s, secs=%.3f",
+            *key,
+            secs,
+        )
+        if should_explain:
+            # Explain on another thread, as this one is waiting on the query
+            threading.Thread(
+                target=self._explain,
+                args=(stats, database_name, command),
+                daemon=True,
+            ).start()
+
+    # pylint: disable=broad-except
+    def _explain(self, stats: _ShapeStats, database_name: str, command: dict) -> None:
+        # Drop the session and other fields added by the driver
+        command = {
+            k: v for k, v in command.items() if not k.startswith("$") and k != "lsid"
+        }
+        try:
+            plan = self.explain(database_name, command)
+        except Exception:
+            LOGGER.exception("Failed to explain slow query: shape=%s", stats.shape)
+            return
+
+        stats.plan = plan.get("queryPlanner", plan)
+        LOGGER.warning(
+            "Slow query plan: command=%s, collection=%s, shape=%s, plan=%s",
+            stats.command,
+            stats.collection,
+            stats.shape,
+            json.dumps(stats.plan, default=str),
+        )
+
+
+def _shape_key(command_name: str, command: dict) -> tuple:
+    collection = command.get(command_name)
+    if command_name == "getMore":
+        collection = command.get("collection")
+    if not isinstance(collection, str):
+        collection = None
+
+    query = None
+    if command_name in _FILTER_FIELDS:
+        query = command.get(_FILTER_FIELDS[command_name])
+    elif command_name == "aggregate":
+        query = (command.get("pipeline") or [{}])[0].get("$match")
+    elif command_name == "update":
+        query = [update.get("q") for update in command.get("updates", [])]
+    elif command_name == "delete":
+        query = [delete.get("q") for delete in command.get("deletes", [])]
+
+    shape = json.dumps(_shape(query), sort_keys=True) if query is not None else "-"
+    return command_name, collection, shape
+
+
+def _shape(value):
+    """Replaces the values in a query with "?", keeping field names and operators.
+    Lists are reduced to their distinct shapes.
+
+    """
+    if isinstance(value, dict):
+        return {k: _shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = []
+        for item in value:
+            item_shape = _shape(item)
+            if item_shape not in shapes:
+                shapes.append(item_shape)
+        return shapes
+    return "?"
+
+
+_COMMAND_SECS = metrics.Histogram(
+    "creepy_mongo_command_seconds", "Latency of MongoDB commands, by command"
+)
+_REPLY_BYTES = metrics.Histogram(
+    "creepy_mongo_reply_bytes",
+    "Size of a sample of MongoDB replies, by command",
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304),
+)
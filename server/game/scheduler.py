@@ -0,0 +1,156 @@
+"""
+Applies actions in ticks. Actions submitted to a session within the same tick window
+are applied in the order they arrived against one in-memory `SessionState`, and
+everything they changed is persisted in one batch at the end of the tick.
+
+Each session's ticks run in a worker of their own, so a slow flush in one session
+doesn't hold up the others. Tiles are created before actions are submitted (see
+`actions.prepare_navigate`), so ticks don't wait on rendering either.
+
+"""
+import time
+import queue
+import logging
+import threading
+from concurrent import futures
+from typing import Any, Callable, Dict
+
+from common import metrics, settings, tracing
+from game.state import SessionState
+
+
+LOGGER = logging.getLogger(__name__)
+
+# A session's worker exits once no actions have arrived for this long, and is started
+# again by the next
+_WORKER_IDLE_SECS = 30
+
+
+class TickScheduler:
+    """
+    :param tick_secs: Length of the window in which submitted actions are batched.
+    :param idle_secs: How long a session's worker waits for actions before exiting.
+
+    """
+
+    def __init__(self, tick_secs: float, idle_secs: float) -> None:
+        self.tick_secs = tick_secs
+        self.idle_secs = idle_secs
+        # Dict mapping from session id to the actions queued for its worker
+        self._queues: Dict[str, queue.Queue] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def num_queued(self) -> int:
+        return sum(q.qsize() for q in list(self._queues.values()))
+
+    @property
+    def num_sessions(self) -> int:
+        return len(self._queues)
+
+    def submit(
+        self, session_id: str, action: Callable[[SessionState], Any]
+    ) -> futures.Future:
+        """Queues an action for the session's next tick.
+
+        :param session_id: Session to apply the action to.
+        :param action: Called with the session state. Must raise before changing the
+        state if the action is invalid.
+        :returns: Future resolved with the action's result once it has been persisted.
+
+        """
+        future = futures.Future()
+        with self._lock:
+            session_queue = self._queues.get(session_id)
+            if session_queue is None:
+                session_queue = self._queues[session_id] = queue.Queue()
+                threading.Thread(
+                    target=self._run, args=(session_id, session_queue), daemon=True
+                ).start()
+            # Spans opened by the action are nested under the submitter's
+            session_queue.put((action, future, tracing.current()))
+        return future
+
+    def _run(self, session_id: str, session_queue: queue.Queue):
+        while True:
+            # Block until there's work, then let the rest of the tick's actions arrive
+            try:
+                batch = [session_queue.get(timeout=self.idle_secs)]
+            except queue.Empty:
+                with self._lock:
+                    # Actions are only queued while holding the lock, so none are lost
+                    if session_queue.empty():
+                        del self._queues[session_id]
+                        return
+                continue
+
+            time.sleep(self.tick_secs)
+            while not session_queue.empty():
+                batch.append(session_queue.get_nowait())
+            self._apply(session_id, batch)
+
+    # pylint: disable=no-self-use,broad-except
+    def _apply(self, session_id: str, batch):
+        state = SessionState(session_id)
+        outcomes = []
+        for action, future, parent in batch:
+            try:
+                with tracing.span("scheduler.action", parent=parent):
+                    outcomes.append((future, action(state), None))
+            except Exception as err:
+                outcomes.append((future, None, err))
+
+        try:
+            with tracing.span(
+                "scheduler.flush", parent=None, num_actions=len(batch)
+            ) as flush_span:
+                state.flush()
+        except Exception as err:
+            LOGGER.exception(
+                "Failed to persist tick: session_id=%s, num_actions=%d",
+                session_id,
+                len(batch),
+            )
+            for future, _, _ in outcomes:
+                future.set_exception(err)
+            return
+
+        # The flush persisted every action's changes, so belongs to all their traces
+        for _action, _future, parent in batch:
+            if parent is not None and flush_span is not None:
+                parent.children.append(flush_span)
+
+        for future, result, err in outcomes:
+            if err:
+                future.set_exception(err)
+            else:
+                future.set_result(result)
+
+
+_SCHEDULER = TickScheduler(settings.TICK_SECS, _WORKER_IDLE_SECS)
+
+metrics.Gauge(
+    "creepy_tick_queue_depth",
+    "Actions waiting for the next tick",
+    lambda: _SCHEDULER.num_queued,
+)
+metrics.Gauge(
+    "creepy_tick_active_sessions",
+    "Sessions with a tick worker running",
+    lambda: _SCHEDULER.num_sessions,
+)
+
+
+def run(session_id: str, action: Callable[[SessionState], Any]) -> Any:
+    """Applies an action to a session in the next tick and waits for its result.
+    Applies it immediately if ticks are disabled.
+
+    """
+    if settings.TICK_SECS <= 0:
+        state = SessionState(session_id)
+        result = action(state)
+        with tracing.span("scheduler.flush", num_actions=1):
+            state.flush()
+        return result
+
+    return _SCHEDULER.submit(session_id, action).result()
@@ -0,0 +1,24 @@
+"""
+Identifies the independent games hosted by one server. Each session has its own world,
+position and event log, and every stored document carries its id. Within a session,
+each player (one or more clients) explores tiles of their own.
+
+"""
+import re
+
+
+# Played by clients which don't name a session, and by data stored before sessions
+DEFAULT_SESSION = "default"
+
+# Played by clients which don't name a player, and by data stored before players
+DEFAULT_PLAYER = "default"
+
+# Session and player ids are chosen by clients, so are restricted to URL and key
+# friendly strings
+SESSION_ID_PATTERN = r"^[A-Za-z0-9_-]{1,64}$"
+
+_SESSION_ID_RE = re.compile(SESSION_ID_PATTERN)
+
+
+def is_valid(session_id: str) -> bool:
+    return isinstance(session_id, str) and bool(_SESSION_ID_RE.match(session_id))
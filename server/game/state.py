@@ -0,0 +1,109 @@
+"""
+In-memory view of a session while actions are applied to it. Reads fall through to the
+database the first time, and changes are buffered until `flush` writes them in one
+batch. The process-wide explored and route caches only learn of visited tiles once the
+write has succeeded.
+
+"""
+import datetime
+from typing import Dict, List
+
+from common.point import Point
+from game import creator, database, explored, pathfinder, positions
+
+
+class SessionState:
+    """
+    :param session_id: Session the changes are made to.
+
+    """
+
+    def __init__(self, session_id: str) -> None:
+        self.session_id = session_id
+        self._current_pos: Point = None
+        self._tiles: Dict[str, dict] = {}
+
+        self.is_position_dirty = False
+        self.visited: Dict[tuple, tuple] = {}
+        self.events: List[dict] = []
+
+    def get_current_position(self) -> Point:
+        if self._current_pos is None:
+            self._current_pos = positions.get(self.session_id)
+        if self._current_pos is None:
+            self.set_current_position(Point(0, 0, 0))
+        return self._current_pos
+
+    def set_current_position(self, point: Point) -> None:
+        self._current_pos = point
+        self.is_position_dirty = True
+
+    def get_or_create_tile(self, point: Point) -> dict:
+        key = point.serialize()
+        if key not in self._tiles:
+            self._tiles[key] = creator.get_or_create_tile(self.session_id, point)
+        return self._tiles[key]
+
+    def mark_visited(self, player_id: str, point: Point, tile: dict) -> None:
+        self._tiles[point.serialize()] = tile
+        self.visited[(player_id, point.serialize())] = (player_id, point, tile)
+        self.record("visited", player=player_id, pos=point.serialize())
+
+    def is_explored(self, player_id: str, point: Point) -> bool:
+        """Whether a player has visited a tile, including during this tick"""
+        if (player_id, point.serialize()) in self.visited:
+            return True
+        return explored.contains(self.session_id, player_id, point)
+
+    def shortest_path(
+        self, player_id: str, start: Point, target: Point, extra: List[tuple] = None
+    ) -> List[Point]:
+        """See `pathfinder.shortest_path`, which this extends with the tiles visited
+        during this tick.
+
+        :param extra: Optionally, `(Point, tile)` tuples of more tiles to search.
+
+        """
+        pending = [
+            (point, tile)
+            for visitor, point, tile in self.visited.values()
+            if visitor == player_id
+        ] + (extra or [])
+        return pathfinder.shortest_path(
+            self.session_id, player_id, start, target, pending=pending
+        )
+
+    def record(self, event_type: str, **details) -> None:
+        """Appends an event to be written to the session's event log"""
+        event = {
+            "time": datetime.datetime.utcnow().isoformat() + "Z",
+            "type": event_type,
+        }
+        event.update(details)
+        self.events.append(event)
+
+    def flush(self) -> None:
+        """Writes all buffered changes, then forgets them"""
+        if not (self.is_position_dirty or self.visited or self.events):
+            return
+
+        # Written with the rest of the session, unless it is written behind
+        write_position = positions.is_immediate()
+        database.apply_session_changes(
+            session_id=self.session_id,
+            visited=list(self.visited.values()),
+            current_pos=self._current_pos if self.is_position_dirty else None,
+            events=self.events,
+            write_position=write_position,
+        )
+        if self.is_position_dirty and write_position:
+            positions.remember(self.session_id, self._current_pos)
+        elif self.is_position_dirty:
+            positions.update(self.session_id, self._current_pos)
+        for player_id, point, tile in self.visited.values():
+            explored.add(self.session_id, player_id, point)
+            pathfinder.add_visited_tile(self.session_id, player_id, point, tile)
+
+        self.is_position_dirty = False
+        self.visited = {}
+        self.events = []
@@ -0,0 +1,34 @@
+"""
+Backends which store the world and the session, behind `game.database`. Each
+implements `Storage`, and is selected with `settings.STORAGE_BACKEND`.
+
+"""
+from common import settings
+from game.storage.base import Storage
+
+
+BACKENDS = ["mongo", "memory", "sqlite"]
+
+
+def create(backend: str) -> Storage:
+    """Creates a storage backend, configured by settings.
+
+    :param backend: One of `BACKENDS`.
+
+    """
+    # Imported as needed, so only the selected backend is loaded
+    if backend == "mongo":
+        from game.storage.mongo import MongoStorage
+
+        return MongoStorage(
+            settings.MONGO_HOST, settings.MONGO_PORT, sharded=settings.MONGO_SHARDED
+        )
+    if backend == "memory":
+        from game.storage.memory import MemoryStorage
+
+        return MemoryStorage()
+    if backend == "sqlite":
+        from game.storage.sqlite import SqliteStorage
+
+        return SqliteStorage(settings.SQLITE_PATH)
+    raise ValueError(f"Unsupported storage backend: {backend}")
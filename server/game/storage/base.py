@@ -0,0 +1,206 @@
+import abc
+from typing import Dict, Iterator, List
+
+from common.point import Point
+
+
+class Storage(abc.ABC):
+    """Where the world and the session are stored. `game.database` serializes tiles and
+    numbers events, and leaves storing them to one of these.
+
+    Every method is scoped to one session, named by `session_id` (see `game.sessions`),
+    and never reads or changes what is stored for another. Explored bitmaps are
+    further scoped to one player of the session, named by `player_id`.
+
+    Tiles are passed in and out as documents of the form `{"x", "y", "z", "tile"}`,
+    where `tile` is the serialized tile (see `game.database`) without its position.
+
+    """
+
+    @abc.abstractmethod
+    def ensure_indexes(self) -> None:
+        """Creates whatever the backend needs before it is used. Safe to call again."""
+
+    @abc.abstractmethod
+    def get_current_position(self, session_id: str) -> Point:
+        ...
+
+    @abc.abstractmethod
+    def set_current_position(self, session_id: str, new_pos: Point) -> None:
+        """Sets the current position, creating the session if needed"""
+
+    @abc.abstractmethod
+    def advance_session(
+        self,
+        session_id: str,
+        num_events: int,
+        current_pos: Point = None,
+        num_ticks: int = 1,
+    ) -> dict:
+        """Atomically advances the session, creating it if needed.
+
+        :param num_events: Added to the session's last event sequence number.
+        :param current_pos: Optionally, the new current position.
+        :param num_ticks: Added to the session's current tick.
+        :returns: The session after the update, with `current_position`,
+        `current_tick` and `last_seq` fields.
+
+        """
+
+    @abc.abstractmethod
+    def get_tile(self, session_id: str, point: Point, fields: List[str] = None) -> dict:
+        """Returns the document of the tile at a position, or None.
+
+        :param fields: Optionally, the tile fields to fetch. Defaults to all fields.
+
+        """
+
+    @abc.abstractmethod
+    def get_tiles(
+        self, session_id: str, points: List[Point], fields: List[str] = None
+    ) -> List[dict]:
+        """Returns the documents of the tiles at the given positions which exist, in no
+        particular order.
+
+        """
+
+    @abc.abstractmethod
+    def iter_tiles(self, session_id: str, fields: List[str] = None) -> Iterator[dict]:
+        """Yields the document of every stored tile"""
+
+    @abc.abstractmethod
+    def get_tile_positions_in_range(
+        self, session_id: str, z: int, x0: int, x1: int, y0: int, y1: int
+    ) -> List[Point]:
+        ...
+
+    @abc.abstractmethod
+    def get_tiles_in_range_version(
+        self, session_id: str, z: int, x0: int, x1: int, y0: int, y1: int
+    ):
+        """Returns a tuple of the newest version and the number of tiles in a range"""
+
+    @abc.abstractmethod
+    def set_tile_fields(
+        self,
+        session_id: str,
+        point: Point,
+        fields: dict,
+        version: int,
+        unset: List[str] = (),
+    ) -> None:
+        """Replaces some fields of a stored tile, leaving the rest as they are. Does
+        nothing if there is no tile at the position.
+
+        :param fields: Dict mapping from tile field to its new value.
+        :param unset: Tile fields to remove.
+
+        """
+
+    @abc.abstractmethod
+    def insert_tiles(
+        self, session_id: str, tiles: List[tuple], version: int
+    ) -> List[int]:
+        """Inserts tiles in one batch. Tiles which already exist are left as they are.
+
+        :param tiles: List of `(Point, tile)` tuples.
+        :returns: Indexes into `tiles` of the tiles which were inserted.
+
+        """
+
+    @abc.abstractmethod
+    def get_explored_chunks(
+        self, session_id: str, player_id: str, z: int
+    ) -> Dict[tuple, Dict[int, int]]:
+        """See `game.database.get_explored_chunks`"""
+
+    @abc.abstractmethod
+    def get_explored_floors(self, session_id: str, player_id: str) -> List[int]:
+        ...
+
+    @abc.abstractmethod
+    def mark_explored(
+        self, session_id: str, player_id: str, chunks: Dict[tuple, Dict[int, int]]
+    ) -> None:
+        """ORs bitmasks into a player's explored bitmap.
+
+        :param chunks: Dict mapping from `(z, cx, cy)` to a dict mapping from row to
+        the bits to set.
+
+        """
+
+    @abc.abstractmethod
+    def get_edge_positions(self, session_id: str, keys: List[str]) -> Dict[str, int]:
+        ...
+
+    @abc.abstractmethod
+    def insert_edge_positions(
+        self, session_id: str, positions: Dict[str, int]
+    ) -> List[str]:
+        """Creates edges which do not exist yet, leaving existing ones as they are.
+
+        :returns: Keys of the edges which were created.
+
+        """
+
+    @abc.abstractmethod
+    def append_events(
+        self, session_id: str, events: List[dict], snapshot: dict = None
+    ) -> None:
+        """Appends numbered events to the session's event log, dropping the oldest
+        beyond `settings.HISTORY_MAX_LENGTH`.
+
+        :param snapshot: Optionally, a snapshot of the session to keep as well.
+
+        """
+
+    @abc.abstractmethod
+    def get_oldest_event_seq(self, session_id: str) -> int:
+        """Returns the sequence number of the oldest event still logged, or None"""
+
+    @abc.abstractmethod
+    def get_latest_snapshot(self, session_id: str) -> dict:
+        ...
+
+    @abc.abstractmethod
+    def get_events(self, session_id: str, since: int, limit: int) -> List[dict]:
+        """Returns logged events after a sequence number, ordered by sequence number"""
+
+    def migrate_legacy_sessions(self, session_id: str) -> int:
+        """Assigns everything stored before there were sessions to one. Only stores
+        older versions used have any.
+
+        :returns: Number of documents assigned.
+
+        """
+        return 0
+
+    def pop_legacy_visited(self, session_id: str) -> List[Point]:
+        """Removes the visited flags stored on tiles by older versions, returning the
+        positions of the visited tiles. Only stores older versions used have any.
+
+        """
+        return []
+
+    def pop_legacy_history(self, session_id: str) -> List[dict]:
+        """Removes the history embedded in the session by older versions, returning
+        its entries as events, oldest first. Only stores older versions used have any.
+
+        """
+        return []
+
+    def migrate_legacy_tiles(self, session_id: str) -> int:
+        """Moves tiles nested in the session by older versions into their own
+        documents. Only stores older versions used have any.
+
+        :returns: Number of tiles moved.
+
+        """
+        return 0
+
+    def get_query_stats(self) -> List[dict]:
+        """Returns latency and reply size of queries sent so far, by query shape, if
+        the backend monitors its queries
+
+        """
+        return []
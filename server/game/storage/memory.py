@@ -0,0 +1,225 @@
+import copy
+import threading
+import collections
+from typing import Dict, Iterator, List
+
+from common import settings
+from common.point import Point
+from game.storage.base import Storage
+
+
+class _Session:
+    """Everything stored for one session"""
+
+    def __init__(self) -> None:
+        self.session = {"current_position": None, "current_tick": 0, "last_seq": 0}
+        # Dict mapping from floor, to dict mapping from `(x, y)` to `(tile, version)`
+        self.floors: Dict[int, Dict[tuple, tuple]] = collections.defaultdict(dict)
+        # Dict mapping from player, to dict mapping from floor, to dict mapping from
+        # `(cx, cy)` to dict mapping from row to bitmask
+        self.explored: Dict[str, Dict[int, Dict[tuple, Dict[int, int]]]] = {}
+        self.edges: Dict[str, int] = {}
+
+        max_snapshots = (
+            settings.HISTORY_MAX_LENGTH // settings.HISTORY_SNAPSHOT_INTERVAL
+        )
+        self.events = collections.deque(maxlen=settings.HISTORY_MAX_LENGTH)
+        self.snapshots = collections.deque(maxlen=max_snapshots + 1)
+
+
+class MemoryStorage(Storage):
+    """Stores everything in the server's memory, so nothing outlives the process. Suits
+    benchmarks and tests, and single-node deployments which don't need to keep the
+    world. Documents are copied in and out, so callers can't change what is stored.
+
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, _Session] = {}
+        # Stands in for sessions which don't exist on read paths, so reads don't
+        # create them. Never written to.
+        self._empty = _Session()
+
+    def ensure_indexes(self) -> None:
+        pass
+
+    def get_current_position(self, session_id: str) -> Point:
+        pos = self._find(session_id).session["current_position"]
+        return Point.deserialize(pos) if pos else None
+
+    def set_current_position(self, session_id: str, new_pos: Point) -> None:
+        self._session(session_id).session["current_position"] = new_pos.serialize()
+
+    def advance_session(
+        self,
+        session_id: str,
+        num_events: int,
+        current_pos: Point = None,
+        num_ticks: int = 1,
+    ) -> dict:
+        stored = self._session(session_id)
+        with self._lock:
+            stored.session["current_tick"] += num_ticks
+            stored.session["last_seq"] += num_events
+            if current_pos:
+                stored.session["current_position"] = current_pos.serialize()
+            return dict(stored.session)
+
+    def get_tile(self, session_id: str, point: Point, fields: List[str] = None) -> dict:
+        floors = self._find(session_id).floors
+        stored = floors.get(point.z, {}).get((point.x, point.y))
+        if stored is None:
+            return None
+        return _doc(point.x, point.y, point.z, stored[0], fields)
+
+    def get_tiles(
+        self, session_id: str, points: List[Point], fields: List[str] = None
+    ) -> List[dict]:
+        docs = []
+        for point in points:
+            doc = self.get_tile(session_id, point, fields)
+            if doc:
+                docs.append(doc)
+        return docs
+
+    def iter_tiles(self, session_id: str, fields: List[str] = None) -> Iterator[dict]:
+        for z, tiles in list(self._find(session_id).floors.items()):
+            for (x, y), (tile, _version) in list(tiles.items()):
+                yield _doc(x, y, z, tile, fields)
+
+    def get_tile_positions_in_range(
+        self, session_id: str, z: int, x0: int, x1: int, y0: int, y1: int
+    ) -> List[Point]:
+        return [
+            Point(x, y, z)
+            for x, y in list(self._find(session_id).floors.get(z, {}))
+            if x0 <= x <= x1 and y0 <= y <= y1
+        ]
+
+    def get_tiles_in_range_version(
+        self, session_id: str, z: int, x0: int, x1: int, y0: int, y1: int
+    ):
+        versions = [
+            version
+            for (x, y), (_tile, version) in list(
+                self._find(session_id).floors.get(z, {}).items()
+            )
+            if x0 <= x <= x1 and y0 <= y <= y1
+        ]
+        if not versions:
+            return None, 0
+        return max(versions), len(versions)
+
+    def set_tile_fields(
+        self,
+        session_id: str,
+        point: Point,
+        fields: dict,
+        version: int,
+        unset: List[str] = (),
+    ) -> None:
+        floor = self._find(session_id).floors.get(point.z, {})
+        with self._lock:
+            stored = floor.get((point.x, point.y))
+            if stored is None:
+                return
+            tile = dict(stored[0])
+            tile.update(copy.deepcopy(fields))
+            for field in unset:
+                tile.pop(field, None)
+            floor[(point.x, point.y)] = (tile, version)
+
+    def insert_tiles(
+        self, session_id: str, tiles: List[tuple], version: int
+    ) -> List[int]:
+        floors = self._session(session_id).floors
+        inserted = []
+        with self._lock:
+            for index, (point, tile) in enumerate(tiles):
+                floor = floors[point.z]
+                if (point.x, point.y) not in floor:
+                    floor[(point.x, point.y)] = (copy.deepcopy(tile), version)
+                    inserted.append(index)
+        return inserted
+
+    def get_explored_chunks(
+        self, session_id: str, player_id: str, z: int
+    ) -> Dict[tuple, Dict[int, int]]:
+        floors = self._find(session_id).explored.get(player_id, {})
+        chunks = floors.get(z, {})
+        return {chunk: dict(rows) for chunk, rows in list(chunks.items())}
+
+    def get_explored_floors(self, session_id: str, player_id: str) -> List[int]:
+        return sorted(self._find(session_id).explored.get(player_id, {}))
+
+    def mark_explored(
+        self, session_id: str, player_id: str, chunks: Dict[tuple, Dict[int, int]]
+    ) -> None:
+        with self._lock:
+            explored = self._session(session_id).explored.setdefault(player_id, {})
+            for (z, cx, cy), rows in chunks.items():
+                stored = explored.setdefault(z, {}).setdefault((cx, cy), {})
+                for row, mask in rows.items():
+                    stored[row] = stored.get(row, 0) | mask
+
+    def get_edge_positions(self, session_id: str, keys: List[str]) -> Dict[str, int]:
+        edges = self._find(session_id).edges
+        return {key: edges[key] for key in keys if key in edges}
+
+    def insert_edge_positions(
+        self, session_id: str, positions: Dict[str, int]
+    ) -> List[str]:
+        edges = self._session(session_id).edges
+        inserted = []
+        with self._lock:
+            for key, position in positions.items():
+                if key not in edges:
+                    edges[key] = position
+                    inserted.append(key)
+        return inserted
+
+    def append_events(
+        self, session_id: str, events: List[dict], snapshot: dict = None
+    ) -> None:
+        stored = self._session(session_id)
+        with self._lock:
+            stored.events.extend(copy.deepcopy(events))
+            if snapshot:
+                stored.snapshots.append(copy.deepcopy(snapshot))
+
+    def get_oldest_event_seq(self, session_id: str) -> int:
+        events = self._find(session_id).events
+        return events[0]["seq"] if events else None
+
+    def get_latest_snapshot(self, session_id: str) -> dict:
+        snapshots = self._find(session_id).snapshots
+        return copy.deepcopy(snapshots[-1]) if snapshots else None
+
+    def get_events(self, session_id: str, since: int, limit: int) -> List[dict]:
+        events = [
+            event
+            for event in list(self._find(session_id).events)
+            if event["seq"] > since
+        ]
+        return copy.deepcopy(events[:limit])
+
+    def _find(self, session_id: str) -> _Session:
+        """Returns what is stored for a session, or an empty session without creating
+        it if there is none
+
+        """
+        return self._sessions.get(session_id, self._empty)
+
+    def _session(self, session_id: str) -> _Session:
+        stored = self._sessions.get(session_id)
+        if stored is None:
+            with self._lock:
+                stored = self._sessions.setdefault(session_id, _Session())
+        return stored
+
+
+def _doc(x: int, y: int, z: int, tile: dict, fields: List[str] = None) -> dict:
+    if fields is not None:
+        tile = {field: tile[field] for field in fields if field in tile}
+    return {"x": x, "y": y, "z": z, "tile": copy.deepcopy(tile)}
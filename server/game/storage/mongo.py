@@ -0,0 +1,563 @@
+import time
+import logging
+from typing import Dict, Iterator, List
+
+import pymongo
+from bson.son import SON
+
+from common import settings
+from common.point import Point
+from game import query_stats
+from game.storage.base import Storage
+
+LOGGER = logging.getLogger(__name__)
+
+# Maximum number of positions looked up per query
+_BATCH_SIZE = 500
+
+# Unique index of each collection, which is also its shard key. Each starts with the
+# session id, so a session's queries are routed to the shard(s) holding it.
+_KEYS = {
+    "tiles": [("_id", pymongo.ASCENDING)],
+    "floor_tiles": [
+        ("session_id", pymongo.ASCENDING),
+        ("z", pymongo.ASCENDING),
+        ("x", pymongo.ASCENDING),
+        ("y", pymongo.ASCENDING),
+    ],
+    "explored": [
+        ("session_id", pymongo.ASCENDING),
+        ("player", pymongo.ASCENDING),
+        ("z", pymongo.ASCENDING),
+        ("cx", pymongo.ASCENDING),
+        ("cy", pymongo.ASCENDING),
+    ],
+    "edges": [("session_id", pymongo.ASCENDING), ("key", pymongo.ASCENDING)],
+    "session_events": [("session_id", pymongo.ASCENDING), ("seq", pymongo.ASCENDING)],
+    "session_snapshots": [
+        ("session_id", pymongo.ASCENDING),
+        ("seq", pymongo.ASCENDING),
+    ],
+}
+
+# Unique indexes of versions before sessions, which would stop sessions sharing
+# positions or sequence numbers
+_LEGACY_INDEXES = {
+    "floor_tiles": "z_1_x_1_y_1",
+    "explored": "player_1_z_1_cx_1_cy_1",
+    "session_events": "seq_1",
+    "session_snapshots": "seq_1",
+}
+
+# Returned by `shardCollection` and `enableSharding` when already done, by older servers
+_ALREADY_SHARDED_CODES = {20, 23}
+
+
+class MongoStorage(Storage):
+    """Stores everything in MongoDB. Each session is a document in `tiles` (named for
+    when it held the tiles too), with the session id as its `_id`. Every other document
+    has a `session_id` field, e.g. each tile is a document in `floor_tiles`.
+
+    :param sharded: Whether `host` is a `mongos` router, so collections are sharded
+    by session.
+
+    """
+
+    def __init__(self, host: str, port: int, sharded: bool = False) -> None:
+        self.sharded = sharded
+        self._query_stats = query_stats.QueryStatsListener(explain=self._explain)
+        self._client = pymongo.MongoClient(
+            host, port, event_listeners=[self._query_stats]
+        )
+
+    def ensure_indexes(self) -> None:
+        creepy_db = self._client["creepy"]
+
+        existing = creepy_db.list_collection_names()
+        for name, index in _LEGACY_INDEXES.items():
+            if name in existing and index in creepy_db[name].index_information():
+                creepy_db[name].drop_index(index)
+
+        for name in ["session_events", "session_snapshots"]:
+            if name in existing and creepy_db[name].options().get("capped"):
+                # Can neither be sharded nor trimmed per session
+                LOGGER.warning(
+                    "Event log is a capped collection, run the migrations: name=%s",
+                    name,
+                )
+
+        for name, keys in _KEYS.items():
+            if keys[0][0] != "_id":
+                creepy_db[name].create_index(keys, unique=True)
+
+        if self.sharded:
+            self._shard_collections()
+
+    def get_current_position(self, session_id: str) -> Point:
+        creepy_db = self._client["creepy"]
+        collection = creepy_db["tiles"]
+
+        doc = collection.find_one({"_id": session_id}, {"session.current_position": 1})
+
+        pos = doc and doc["session"].get("current_position")
+        if pos:
+            return Point.deserialize(pos)
+        return None
+
+    def set_current_position(self, session_id: str, new_pos: Point) -> None:
+        creepy_db = self._client["creepy"]
+        collection = creepy_db["tiles"]
+
+        updates = {"session.current_position": new_pos.serialize()}
+        collection.update_one({"_id": session_id}, {"$set": updates}, upsert=True)
+
+    def advance_session(
+        self,
+        session_id: str,
+        num_events: int,
+        current_pos: Point = None,
+        num_ticks: int = 1,
+    ) -> dict:
+        creepy_db = self._client["creepy"]
+        collection = creepy_db["tiles"]
+
+        updates = {
+            "$inc": {"session.current_tick": num_ticks, "session.last_seq": num_events}
+        }
+        if current_pos:
+            updates["$set"] = {"session.current_position": current_pos.serialize()}
+        doc = collection.find_one_and_update(
+            {"_id": session_id},
+            updates,
+            projection={"session.floors": 0, "session.history": 0},
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
+        return doc["session"]
+
+    def get_tile(self, session_id: str, point: Point, fields: List[str] = None) -> dict:
+        creepy_db = self._client["creepy"]
+        collection = creepy_db["floor_tiles"]
+
+        return collection.find_one(_tile_query(session_id, point), _projection(fields))
+
+    def get_tiles(
+        self, session_id: str, points: List[Point], fields: List[str] = None
+    ) -> List[dict]:
+        creepy_db = self._client["creepy"]
+        collection = creepy_db["floor_tiles"]
+
+        docs = []
+        for index in range(0, len(points), _BATCH_SIZE):
+            batch = points[index : index + _BATCH_SIZE]
+            query = {
+                "session_id": session_id,
+                "$or": [{"z": p.z, "x": p.x, "y": p.y} for p in batch],
+            }
+            docs.extend(collection.find(query, _projection(fields)))
+        return docs
+
+    def iter_tiles(self, session_id: str, fields: List[str] = None) -> Iterator[dict]:
+        creepy_db = self._client["creepy"]
+        collection = creepy_db["floor_tiles"]
+
+        return collection.find({"session_id": session_id}, _projection(fields))
+
+    def get_tile_positions_in_range(
+        self, session_id: str, z: int, x0: int, x1: int, y0: int, y1: int
+    ) -> List[Point]:
+        creepy_db = self._client["creepy"]
+        collection = creepy_db["floor_tiles"]
+
+        query = _range_query(session_id, z, x0, x1, y0, y1)
+        docs = collection.find(query, {"_id": 0, "x": 1, "y": 1, "z": 1})
+        return [Point(doc["x"], doc["y"], doc["z"]) for doc in docs]
+
+    def get_tiles_in_range_version(
+        self, session_id: str, z: int, x0: int, x1: int, y0: int, y1: int
+    ):
+        creepy_db = self._client["creepy"]
+        collection = creepy_db["floor_tiles"]
+
+        pipeline = [
+            {"$match": _range_query(session_id, z, x0, x1, y0, y1)},
+            {
+                "$group": {
+                    "_id": None,
+                    "version": {"$max": "$version"},
+                    "count": {"$sum": 1},
+                }
+            },
+        ]
+        for doc in collection.aggregate(pipeline):
+            return doc["version"], doc["count"]
+        return None, 0
+
+    def set_tile(self, session_id: str, point: Point, tile: dict, version: int) -> None:
+        """Stores a tile, replacing any already at its position. Only used to migrate
+        tiles stored by older versions, see `migrate_legacy_tiles`.
+
+        """
+        creepy_db = self._client["creepy"]
+        collection = creepy_db["floor_tiles"]
+
+        collection.update_one(
+            _tile_query(session_id, point),
+            {"$set": {"tile": tile, "version": version}},
+            upsert=True,
+        )
+
+    def set_tile_fields(
+        self,
+        session_id: str,
+        point: Point,
+        fields: dict,
+        version: int,
+        unset: List[str] = (),
+    ) -> None:
+        creepy_db = self._client["creepy"]
+        collection = creepy_db["floor_tiles"]
+
+        updates = {"$set": {f"tile.{k}": v for k, v in fields.items()}}
+        updates["$set"]["version"] = version
+        if unset:
+            updates["$unset"] = {f"tile.{field}": "" for field in unset}
+        collection.update_one(_tile_query(session_id, point), updates)
+
+    def insert_tiles(
+        self, session_id: str, tiles: List[tuple], version: int
+    ) -> List[int]:
+        creepy_db = self._client["creepy"]
+        collection = creepy_db["floor_tiles"]
+
+        if not tiles:
+            return []
+        result = collection.bulk_write(
+            [
+                pymongo.UpdateOne(
+                    _tile_query(session_id, point),
+                    {"$setOnInsert": {"tile": tile, "version": version}},
+                    upsert=True,
+                )
+                for point, tile in tiles
+            ],
+            ordered=False,
+        )
+        return sorted(result.upserted_ids)
+
+    def get_explored_chunks(
+        self, session_id: str, player_id: str, z: int
+    ) -> Dict[tuple, Dict[int, int]]:
+        creepy_db = self._client["creepy"]
+        collection = creepy_db["explored"]
+
+        docs = collection.find(
+            {"session_id": session_id, "player": player_id, "z": z},
+            {"cx": 1, "cy": 1, "rows": 1},
+        )
+        return {
+            (doc["cx"], doc["cy"]): {
+                int(row): mask for row, mask in doc["rows"].items()
+            }
+            for doc in docs
+        }
+
+    def get_explored_floors(self, session_id: str, player_id: str) -> List[int]:
+        creepy_db = self._client["creepy"]
+        collection = creepy_db["explored"]
+
+        query = {"session_id": session_id, "player": player_id}
+        return sorted(collection.distinct("z", query))
+
+    def mark_explored(
+        self, session_id: str, player_id: str, chunks: Dict[tuple, Dict[int, int]]
+    ) -> None:
+        creepy_db = self._client["creepy"]
+        collection = creepy_db["explored"]
+
+        requests = [
+            pymongo.UpdateOne(
+                {
+                    "session_id": session_id,
+                    "player": player_id,
+                    "z": z,
+                    "cx": cx,
+                    "cy": cy,
+                },
+                {"$bit": {f"rows.{row}": {"or": mask} for row, mask in rows.items()}},
+                upsert=True,
+            )
+            for (z, cx, cy), rows in chunks.items()
+        ]
+        if requests:
+            collection.bulk_write(requests, ordered=False)
+
+    def get_edge_positions(self, session_id: str, keys: List[str]) -> Dict[str, int]:
+        creepy_db = self._client["creepy"]
+        collection = creepy_db["edges"]
+
+        docs = collection.find(
+            {"session_id": session_id, "key": {"$in": keys}},
+            {"_id": 0, "key": 1, "edge_position": 1},
+        )
+        return {doc["key"]: doc["edge_position"] for doc in docs}
+
+    def insert_edge_positions(
+        self, session_id: str, positions: Dict[str, int]
+    ) -> List[str]:
+        creepy_db = self._client["creepy"]
+        collection = creepy_db["edges"]
+
+        keys = list(positions)
+        if not keys:
+            return []
+        result = collection.bulk_write(
+            [
+                pymongo.UpdateOne(
+                    {"session_id": session_id, "key": key},
+                    {"$setOnInsert": {"edge_position": positions[key]}},
+                    upsert=True,
+                )
+                for key in keys
+            ],
+            ordered=False,
+        )
+        return [keys[index] for index in result.upserted_ids]
+
+    def append_events(
+        self, session_id: str, events: List[dict], snapshot: dict = None
+    ) -> None:
+        creepy_db = self._client["creepy"]
+
+        # Copied, as inserting adds an `_id` to each
+        creepy_db["session_events"].insert_many(
+            [{"session_id": session_id, **event} for event in events]
+        )
+        creepy_db["session_events"].delete_many(
+            {
+                "session_id": session_id,
+                "seq": {"$lte": events[-1]["seq"] - settings.HISTORY_MAX_LENGTH},
+            }
+        )
+        if not snapshot:
+            return
+
+        collection = creepy_db["session_snapshots"]
+        collection.insert_one({"session_id": session_id, **snapshot})
+        max_snapshots = (
+            settings.HISTORY_MAX_LENGTH // settings.HISTORY_SNAPSHOT_INTERVAL
+        )
+        oldest_kept = collection.find_one(
+            {"session_id": session_id},
+            {"seq": 1},
+            sort=[("seq", pymongo.DESCENDING)],
+            skip=max_snapshots,
+        )
+        if oldest_kept:
+            collection.delete_many(
+                {"session_id": session_id, "seq": {"$lt": oldest_kept["seq"]}}
+            )
+
+    def get_oldest_event_seq(self, session_id: str) -> int:
+        creepy_db = self._client["creepy"]
+        collection = creepy_db["session_events"]
+
+        oldest = collection.find_one(
+            {"session_id": session_id}, {"seq": 1}, sort=[("seq", pymongo.ASCENDING)]
+        )
+        return oldest["seq"] if oldest else None
+
+    def get_latest_snapshot(self, session_id: str) -> dict:
+        creepy_db = self._client["creepy"]
+        collection = creepy_db["session_snapshots"]
+
+        return collection.find_one(
+            {"session_id": session_id},
+            {"_id": 0, "session_id": 0},
+            sort=[("seq", pymongo.DESCENDING)],
+        )
+
+    def get_events(self, session_id: str, since: int, limit: int) -> List[dict]:
+        creepy_db = self._client["creepy"]
+        collection = creepy_db["session_events"]
+
+        return list(
+            collection.find(
+                {"session_id": session_id, "seq": {"$gt": since}},
+                {"_id": 0, "session_id": 0},
+            )
+            .sort("seq", pymongo.ASCENDING)
+            .limit(limit)
+        )
+
+    def migrate_legacy_sessions(self, session_id: str) -> int:
+        creepy_db = self._client["creepy"]
+        num_assigned = 0
+
+        # The session document was the only one, so its `_id` was generated
+        sessions = creepy_db["tiles"]
+        for doc in sessions.find({"_id": {"$type": "objectId"}}):
+            legacy_id = doc.pop("_id")
+            sessions.replace_one({"_id": session_id}, doc, upsert=True)
+            sessions.delete_one({"_id": legacy_id})
+            num_assigned += 1
+
+        unassigned = {"session_id": {"$exists": False}}
+        num_assigned += (
+            creepy_db["floor_tiles"]
+            .update_many(unassigned, {"$set": {"session_id": session_id}})
+            .modified_count
+        )
+        # Explored bitmaps keep the player they belong to
+        num_assigned += (
+            creepy_db["explored"]
+            .update_many(unassigned, {"$set": {"session_id": session_id}})
+            .modified_count
+        )
+
+        # Edges were identified by their key alone
+        edges = creepy_db["edges"]
+        requests = [
+            pymongo.UpdateOne(
+                {"_id": doc["_id"]},
+                {"$set": {"session_id": session_id, "key": doc["_id"]}},
+            )
+            for doc in edges.find(unassigned, {"_id": 1})
+        ]
+        if requests:
+            num_assigned += edges.bulk_write(requests, ordered=False).modified_count
+
+        for name in ["session_events", "session_snapshots"]:
+            num_assigned += self._migrate_legacy_log(name, session_id)
+
+        return num_assigned
+
+    def pop_legacy_visited(self, session_id: str) -> List[Point]:
+        creepy_db = self._client["creepy"]
+        collection = creepy_db["floor_tiles"]
+
+        docs = collection.find(
+            {"session_id": session_id, "tile.is_visited": True},
+            {"x": 1, "y": 1, "z": 1},
+        )
+        points = [Point(doc["x"], doc["y"], doc["z"]) for doc in docs]
+
+        collection.update_many(
+            {"session_id": session_id, "tile.is_visited": {"$exists": True}},
+            {"$unset": {"tile.is_visited": ""}},
+        )
+        return points
+
+    def pop_legacy_history(self, session_id: str) -> List[dict]:
+        creepy_db = self._client["creepy"]
+        sessions = creepy_db["tiles"]
+
+        events = []
+        doc = sessions.find_one(
+            {"_id": session_id, "session.history": {"$exists": True}}
+        )
+        if doc:
+            events.extend(
+                {"time": entry.pop("time"), "type": entry.pop("action"), **entry}
+                for entry in doc["session"]["history"]
+            )
+            sessions.update_one(
+                {"_id": session_id}, {"$unset": {"session.history": ""}}
+            )
+        return events
+
+    def migrate_legacy_tiles(self, session_id: str) -> int:
+        creepy_db = self._client["creepy"]
+        sessions = creepy_db["tiles"]
+
+        num_moved = 0
+        doc = sessions.find_one(
+            {"_id": session_id, "session.floors": {"$exists": True}}
+        )
+        if doc:
+            for floor, val in doc["session"]["floors"].items():
+                for pos, tile in val["tiles"].items():
+                    point = Point.deserialize(pos)
+                    tile.pop("position", None)
+                    point = Point(point.x, point.y, int(floor))
+                    self.set_tile(session_id, point, tile, time.time_ns())
+                    num_moved += 1
+
+            sessions.update_one({"_id": session_id}, {"$unset": {"session.floors": ""}})
+
+        return num_moved
+
+    def get_query_stats(self) -> List[dict]:
+        return self._query_stats.get_stats()
+
+    def _migrate_legacy_log(self, name: str, session_id: str) -> int:
+        """Assigns a log's entries to a session, first moving them out of the capped
+        collection older versions used, which could be neither sharded nor trimmed per
+        session
+
+        """
+        creepy_db = self._client["creepy"]
+        unassigned = {"session_id": {"$exists": False}}
+
+        if name not in creepy_db.list_collection_names():
+            return 0
+        if not creepy_db[name].options().get("capped"):
+            return (
+                creepy_db[name]
+                .update_many(unassigned, {"$set": {"session_id": session_id}})
+                .modified_count
+            )
+
+        legacy = creepy_db[f"{name}_legacy"]
+        creepy_db[name].rename(legacy.name)
+        docs = [
+            {"session_id": session_id, **doc}
+            for doc in legacy.find({}, {"_id": 0}).sort("seq", pymongo.ASCENDING)
+        ]
+        if docs:
+            creepy_db[name].insert_many(docs)
+        creepy_db[name].create_index(_KEYS[name], unique=True)
+        legacy.drop()
+        return len(docs)
+
+    def _shard_collections(self) -> None:
+        admin_db = self._client.admin
+        try:
+            admin_db.command("enableSharding", "creepy")
+        except pymongo.errors.OperationFailure as err:
+            if err.code not in _ALREADY_SHARDED_CODES:
+                raise
+
+        for name, keys in _KEYS.items():
+            try:
+                admin_db.command("shardCollection", f"creepy.{name}", key=SON(keys))
+            except pymongo.errors.OperationFailure as err:
+                if err.code not in _ALREADY_SHARDED_CODES:
+                    raise
+        LOGGER.info("Sharded collections by session: num_collections=%d", len(_KEYS))
+
+    def _explain(self, database_name: str, command: dict) -> dict:
+        return self._client[database_name].command(
+            "explain", command, verbosity="queryPlanner"
+        )
+
+
+def _tile_query(session_id: str, point: Point) -> dict:
+    return {"session_id": session_id, "z": point.z, "x": point.x, "y": point.y}
+
+
+def _range_query(session_id: str, z: int, x0: int, x1: int, y0: int, y1: int) -> dict:
+    return {
+        "session_id": session_id,
+        "z": z,
+        "x": {"$gte": x0, "$lte": x1},
+        "y": {"$gte": y0, "$lte": y1},
+    }
+
+
+def _projection(fields: List[str] = None) -> dict:
+    if fields is None:
+        return None
+    projection = {"x": 1, "y": 1, "z": 1}
+    projection.update({f"tile.{field}": 1 for field in fields})
+    return projection
@@ -0,0 +1,342 @@
+import json
+import sqlite3
+import threading
+from typing import Dict, Iterator, List
+
+import bson
+
+from common import settings
+from common.point import Point
+from game.storage.base import Storage
+
+
+# Tiles are stored BSON encoded, as they contain binary (compressed) backgrounds. Every
+# table is keyed by session first, so a session's rows are stored together.
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS session (
+    session_id TEXT PRIMARY KEY,
+    current_position TEXT,
+    current_tick INTEGER NOT NULL DEFAULT 0,
+    last_seq INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS tiles (
+    session_id TEXT NOT NULL,
+    z INTEGER NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    tile BLOB NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (session_id, z, x, y)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS explored (
+    session_id TEXT NOT NULL,
+    player TEXT NOT NULL,
+    z INTEGER NOT NULL,
+    cx INTEGER NOT NULL,
+    cy INTEGER NOT NULL,
+    row INTEGER NOT NULL,
+    mask INTEGER NOT NULL,
+    PRIMARY KEY (session_id, player, z, cx, cy, row)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS edges (
+    session_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    edge_position INTEGER NOT NULL,
+    PRIMARY KEY (session_id, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS session_events (
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    event TEXT NOT NULL,
+    PRIMARY KEY (session_id, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS session_snapshots (
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    snapshot TEXT NOT NULL,
+    PRIMARY KEY (session_id, seq)
+) WITHOUT ROWID;
+"""
+
+_TILE_WHERE = "session_id = ? AND z = ? AND x = ? AND y = ?"
+_RANGE_WHERE = "session_id = ? AND z = ? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?"
+
+
+class SqliteStorage(Storage):
+    """Stores everything in an SQLite database file, in the server's process. Suits
+    single-node deployments and benchmarks, as there is no network hop, and the world
+    is kept between restarts.
+
+    :param path: Path to the database file, which is created if needed.
+
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # Shared between threads, so serialized by the lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._lock = threading.Lock()
+
+    def ensure_indexes(self) -> None:
+        with self._lock, self._conn:
+            self._conn.executescript(_SCHEMA)
+
+    def get_current_position(self, session_id: str) -> Point:
+        row = self._query_one(
+            "SELECT current_position FROM session WHERE session_id = ?", (session_id,)
+        )
+        if row and row[0]:
+            return Point.deserialize(row[0])
+        return None
+
+    def set_current_position(self, session_id: str, new_pos: Point) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO session (session_id, current_position) VALUES (?, ?) "
+                "ON CONFLICT (session_id) "
+                "DO UPDATE SET current_position = excluded.current_position",
+                (session_id, new_pos.serialize()),
+            )
+
+    def advance_session(
+        self,
+        session_id: str,
+        num_events: int,
+        current_pos: Point = None,
+        num_ticks: int = 1,
+    ) -> dict:
+        pos = current_pos.serialize() if current_pos else None
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO session (session_id) VALUES (?)", (session_id,)
+            )
+            self._conn.execute(
+                "UPDATE session SET current_tick = current_tick + ?, "
+                "last_seq = last_seq + ?, "
+                "current_position = COALESCE(?, current_position) "
+                "WHERE session_id = ?",
+                (num_ticks, num_events, pos, session_id),
+            )
+            row = self._conn.execute(
+                "SELECT current_position, current_tick, last_seq FROM session "
+                "WHERE session_id = ?",
+                (session_id,),
+            ).fetchone()
+        return {"current_position": row[0], "current_tick": row[1], "last_seq": row[2]}
+
+    def get_tile(self, session_id: str, point: Point, fields: List[str] = None) -> dict:
+        row = self._query_one(
+            f"SELECT x, y, z, tile FROM tiles WHERE {_TILE_WHERE}",
+            (session_id, point.z, point.x, point.y),
+        )
+        return _doc(row, fields) if row else None
+
+    def get_tiles(
+        self, session_id: str, points: List[Point], fields: List[str] = None
+    ) -> List[dict]:
+        docs = []
+        with self._lock:
+            for point in points:
+                row = self._conn.execute(
+                    f"SELECT x, y, z, tile FROM tiles WHERE {_TILE_WHERE}",
+                    (session_id, point.z, point.x, point.y),
+                ).fetchone()
+                if row:
+                    docs.append(_doc(row, fields))
+        return docs
+
+    def iter_tiles(self, session_id: str, fields: List[str] = None) -> Iterator[dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT x, y, z, tile FROM tiles WHERE session_id = ?", (session_id,)
+            ).fetchall()
+        for row in rows:
+            yield _doc(row, fields)
+
+    def get_tile_positions_in_range(
+        self, session_id: str, z: int, x0: int, x1: int, y0: int, y1: int
+    ) -> List[Point]:
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT x, y FROM tiles WHERE {_RANGE_WHERE}",
+                (session_id, z, x0, x1, y0, y1),
+            ).fetchall()
+        return [Point(x, y, z) for x, y in rows]
+
+    def get_tiles_in_range_version(
+        self, session_id: str, z: int, x0: int, x1: int, y0: int, y1: int
+    ):
+        return self._query_one(
+            f"SELECT MAX(version), COUNT(*) FROM tiles WHERE {_RANGE_WHERE}",
+            (session_id, z, x0, x1, y0, y1),
+        )
+
+    def set_tile_fields(
+        self,
+        session_id: str,
+        point: Point,
+        fields: dict,
+        version: int,
+        unset: List[str] = (),
+    ) -> None:
+        key = (session_id, point.z, point.x, point.y)
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                f"SELECT tile FROM tiles WHERE {_TILE_WHERE}", key
+            ).fetchone()
+            if not row:
+                return
+            tile = bson.decode(row[0])
+            tile.update(fields)
+            for field in unset:
+                tile.pop(field, None)
+            self._conn.execute(
+                f"UPDATE tiles SET tile = ?, version = ? WHERE {_TILE_WHERE}",
+                (bson.encode(tile), version, *key),
+            )
+
+    def insert_tiles(
+        self, session_id: str, tiles: List[tuple], version: int
+    ) -> List[int]:
+        inserted = []
+        with self._lock, self._conn:
+            for index, (point, tile) in enumerate(tiles):
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO tiles (session_id, z, x, y, tile, version) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (session_id, point.z, point.x, point.y, bson.encode(tile), version),
+                )
+                if cursor.rowcount:
+                    inserted.append(index)
+        return inserted
+
+    def get_explored_chunks(
+        self, session_id: str, player_id: str, z: int
+    ) -> Dict[tuple, Dict[int, int]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT cx, cy, row, mask FROM explored "
+                "WHERE session_id = ? AND player = ? AND z = ?",
+                (session_id, player_id, z),
+            ).fetchall()
+
+        chunks = {}
+        for cx, cy, row, mask in rows:
+            chunks.setdefault((cx, cy), {})[row] = mask
+        return chunks
+
+    def get_explored_floors(self, session_id: str, player_id: str) -> List[int]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT z FROM explored "
+                "WHERE session_id = ? AND player = ? ORDER BY z",
+                (session_id, player_id),
+            ).fetchall()
+        return [z for (z,) in rows]
+
+    def mark_explored(
+        self, session_id: str, player_id: str, chunks: Dict[tuple, Dict[int, int]]
+    ) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO explored (session_id, player, z, cx, cy, row, mask) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (session_id, player, z, cx, cy, row) "
+                "DO UPDATE SET mask = mask | excluded.mask",
+                [
+                    (session_id, player_id, z, cx, cy, row, mask)
+                    for (z, cx, cy), rows in chunks.items()
+                    for row, mask in rows.items()
+                ],
+            )
+
+    def get_edge_positions(self, session_id: str, keys: List[str]) -> Dict[str, int]:
+        with self._lock:
+            rows = [
+                self._conn.execute(
+                    "SELECT key, edge_position FROM edges "
+                    "WHERE session_id = ? AND key = ?",
+                    (session_id, key),
+                ).fetchone()
+                for key in keys
+            ]
+        return dict(row for row in rows if row)
+
+    def insert_edge_positions(
+        self, session_id: str, positions: Dict[str, int]
+    ) -> List[str]:
+        inserted = []
+        with self._lock, self._conn:
+            for key, position in positions.items():
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO edges (session_id, key, edge_position) "
+                    "VALUES (?, ?, ?)",
+                    (session_id, key, position),
+                )
+                if cursor.rowcount:
+                    inserted.append(key)
+        return inserted
+
+    def append_events(
+        self, session_id: str, events: List[dict], snapshot: dict = None
+    ) -> None:
+        max_snapshots = (
+            settings.HISTORY_MAX_LENGTH // settings.HISTORY_SNAPSHOT_INTERVAL
+        )
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO session_events (session_id, seq, event) VALUES (?, ?, ?)",
+                [(session_id, event["seq"], json.dumps(event)) for event in events],
+            )
+            self._conn.execute(
+                "DELETE FROM session_events WHERE session_id = ? AND seq <= ?",
+                (session_id, events[-1]["seq"] - settings.HISTORY_MAX_LENGTH),
+            )
+            if snapshot:
+                self._conn.execute(
+                    "INSERT INTO session_snapshots (session_id, seq, snapshot) "
+                    "VALUES (?, ?, ?)",
+                    (session_id, snapshot["seq"], json.dumps(snapshot)),
+                )
+                self._conn.execute(
+                    "DELETE FROM session_snapshots WHERE session_id = ? AND seq NOT IN "
+                    "(SELECT seq FROM session_snapshots WHERE session_id = ? "
+                    "ORDER BY seq DESC LIMIT ?)",
+                    (session_id, session_id, max_snapshots + 1),
+                )
+
+    def get_oldest_event_seq(self, session_id: str) -> int:
+        return self._query_one(
+            "SELECT MIN(seq) FROM session_events WHERE session_id = ?", (session_id,)
+        )[0]
+
+    def get_latest_snapshot(self, session_id: str) -> dict:
+        row = self._query_one(
+            "SELECT snapshot FROM session_snapshots WHERE session_id = ? "
+            "ORDER BY seq DESC LIMIT 1",
+            (session_id,),
+        )
+        return json.loads(row[0]) if row else None
+
+    def get_events(self, session_id: str, since: int, limit: int) -> List[dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT event FROM session_events WHERE session_id = ? AND seq > ? "
+                "ORDER BY seq LIMIT ?",
+                (session_id, since, limit),
+            ).fetchall()
+        return [json.loads(event) for (event,) in rows]
+
+    def _query_one(self, sql: str, params: tuple = ()) -> tuple:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+
+def _doc(row: tuple, fields: List[str] = None) -> dict:
+    x, y, z, encoded = row
+    tile = bson.decode(encoded)
+    if fields is not None:
+        tile = {field: tile[field] for field in fields if field in tile}
+    return {"x": x, "y": y, "z": z, "tile": tile}
@@ -0,0 +1,309 @@
+"""Generates synthetic load against a running server, and reports how it copes.
+
+Each simulated client connects over Socket.IO, and in a closed loop random-walks with
+`navigate`, refreshes everything with `refresh_all` now and then, and polls `/current`
+over HTTP. The number of clients follows the stages of a scenario file, e.g.
+
+    {
+        "stages": [
+            {"clients": 10, "ramp_secs": 10, "secs": 30},
+            {"clients": 50, "ramp_secs": 30, "secs": 60}
+        ],
+        "navigate_interval_secs": 0.5,
+        "refresh_all_interval_secs": 10,
+        "poll_current_interval_secs": 2,
+        "timeout_secs": 10,
+        "sessions": 1
+    }
+
+Clients are spread evenly over `sessions` independent sessions, each playing as a
+player of its own.
+
+After each stage, reports throughput, latency percentiles and error statuses per action,
+and the server's CPU use (read from `/metrics`). Requires the packages in
+requirements-dev.txt.
+
+"""
+# Clients are greenthreads, so many can run in one process
+import eventlet
+
+eventlet.monkey_patch()
+
+# pylint: disable=wrong-import-position
+import json
+import time
+import random
+import logging
+import argparse
+import collections
+from typing import Dict, List
+
+import requests
+import socketio
+from eventlet.event import Event
+
+from common import settings
+
+settings.configure_logger()
+
+LOGGER = logging.getLogger(__name__)
+
+_DEFAULT_SCENARIO = {
+    "stages": [{"clients": 10, "ramp_secs": 10, "secs": 30}],
+    "navigate_interval_secs": 0.5,
+    "refresh_all_interval_secs": 10,
+    "poll_current_interval_secs": 2,
+    "timeout_secs": 10,
+    "sessions": 1,
+}
+
+_DIRECTIONS = [(0, 1), (1, 0), (0, -1), (-1, 0)]
+
+# Statuses which answer each action, and those which count as successes. Shared with
+# replay.py.
+RESPONSES = {
+    "navigate": {"NAVIGATE_SUCCESS", "NAVIGATE_ERROR", "NAVIGATE_BUSY"},
+    "travel": {"TRAVEL_SUCCESS", "TRAVEL_ERROR", "TRAVEL_BUSY"},
+    "refresh_all": {"REFRESH_ALL_SUCCESS", "REFRESH_ALL_BUSY"},
+    "refresh_current": {"REFRESH_CURRENT_SUCCESS", "REFRESH_CURRENT_BUSY"},
+    "refresh_floor": {"REFRESH_FLOOR_SUCCESS"},
+    "subscribe_viewport": {"SUBSCRIBE_VIEWPORT_SUCCESS"},
+}
+SUCCESSES = {
+    "NAVIGATE_SUCCESS",
+    "TRAVEL_SUCCESS",
+    "REFRESH_ALL_SUCCESS",
+    "REFRESH_CURRENT_SUCCESS",
+    "REFRESH_FLOOR_SUCCESS",
+    "SUBSCRIBE_VIEWPORT_SUCCESS",
+}
+
+
+class Stats:
+    """Latencies and error statuses of completed actions, by action"""
+
+    def __init__(self) -> None:
+        self.latencies: Dict[str, List[float]] = collections.defaultdict(list)
+        self.errors: Dict[str, collections.Counter] = collections.defaultdict(
+            collections.Counter
+        )
+
+    def record(self, action: str, secs: float, error: str = None) -> None:
+        self.latencies[action].append(secs)
+        if error:
+            self.errors[action][error] += 1
+
+    def report(self, elapsed_secs: float) -> dict:
+        report = {}
+        for action, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            report[action] = {
+                "count": len(latencies),
+                "per_sec": round(len(latencies) / elapsed_secs, 2),
+                "p50_ms": _percentile_ms(latencies, 0.5),
+                "p95_ms": _percentile_ms(latencies, 0.95),
+                "p99_ms": _percentile_ms(latencies, 0.99),
+                "errors": dict(self.errors[action]),
+            }
+        return report
+
+
+def _percentile_ms(latencies: List[float], fraction: float) -> float:
+    index = min(len(latencies) - 1, int(len(latencies) * fraction))
+    return round(latencies[index] * 1000, 1)
+
+
+class SimulatedClient:
+    """
+    :param url: Base URL of the server.
+    :param scenario: Intervals and timeouts, as in the scenario file.
+    :param stats: Where to record completed actions. Replaced between stages.
+    :param session_id: Session to play in.
+    :param player_id: Player to play as.
+
+    """
+
+    def __init__(
+        self, url: str, scenario: dict, stats: Stats, session_id: str, player_id: str
+    ) -> None:
+        self.url = url
+        self.scenario = scenario
+        self.stats = stats
+        self.session_id = session_id
+        self.player_id = player_id
+        self.is_stopped = False
+
+        self._sio = socketio.Client(reconnection=False)
+        self._sio.on("json", self._on_json)
+        self._http = requests.Session()
+        self._pos = {"x": 0, "y": 0, "z": 0}
+        self._waiting_for: set = set()
+        self._response = Event()
+
+    def run(self) -> None:
+        try:
+            self._sio.connect(
+                f"{self.url}?session={self.session_id}&player={self.player_id}",
+                transports=["websocket"],
+            )
+        except socketio.exceptions.ConnectionError as err:
+            self.stats.record("connect", 0, error=type(err).__name__)
+            return
+
+        self._send("refresh_all", {})
+        next_refresh = time.monotonic() + self.scenario["refresh_all_interval_secs"]
+        next_poll = time.monotonic()
+        while not self.is_stopped:
+            now = time.monotonic()
+            if now >= next_refresh:
+                self._send("refresh_all", {})
+                next_refresh = now + self.scenario["refresh_all_interval_secs"]
+            elif now >= next_poll:
+                self._poll_current()
+                next_poll = now + self.scenario["poll_current_interval_secs"]
+            else:
+                d_x, d_y = random.choice(_DIRECTIONS)
+                target = dict(self._pos, x=self._pos["x"] + d_x, y=self._pos["y"] + d_y)
+                self._send("navigate", {"target_pos": target})
+            eventlet.sleep(self.scenario["navigate_interval_secs"])
+
+        self._sio.disconnect()
+
+    def _send(self, name: str, action: dict) -> None:
+        self._waiting_for = RESPONSES[name]
+        self._response = Event()
+
+        start = time.perf_counter()
+        self._sio.emit("json", {"action": dict(action, name=name)})
+        with eventlet.Timeout(self.scenario["timeout_secs"], False):
+            status = self._response.wait()
+            secs = time.perf_counter() - start
+            self.stats.record(name, secs, None if status in SUCCESSES else status)
+            return
+        self.stats.record(name, self.scenario["timeout_secs"], error="TIMEOUT")
+
+    def _poll_current(self) -> None:
+        start = time.perf_counter()
+        try:
+            resp = self._http.get(
+                f"{self.url}/current",
+                params={"session": self.session_id},
+                timeout=self.scenario["timeout_secs"],
+            )
+            error = None if resp.status_code == 200 else f"HTTP_{resp.status_code}"
+        except requests.RequestException as err:
+            error = type(err).__name__
+        self.stats.record("current", time.perf_counter() - start, error)
+
+    def _on_json(self, frame: dict) -> None:
+        events = frame["events"] if frame["status"] == "BATCH" else [frame]
+        for event in events:
+            status = event["status"]
+            message = json.loads(event["message"]) if event.get("message") else {}
+            pos = message.get("new_pos") or message.get("current_pos")
+            if pos:
+                self._pos = pos
+            if status == "ERROR_INVALID_INPUT" or status in self._waiting_for:
+                if not self._response.ready():
+                    self._response.send(status)
+
+
+def server_cpu_secs(url: str) -> float:
+    """Returns the CPU time the server has used, or None if it couldn't be read"""
+    try:
+        resp = requests.get(f"{url}/metrics", timeout=5)
+    except requests.RequestException:
+        return None
+    for line in resp.text.splitlines():
+        if line.startswith("creepy_process_cpu_seconds "):
+            return float(line.split()[1])
+    return None
+
+
+def _run_stage(url: str, scenario: dict, stage: dict, clients: list, stats: Stats):
+    def spawn():
+        session_id = f"loadtest-{len(clients) % scenario['sessions']}"
+        player_id = f"loadtest-{len(clients)}"
+        client = SimulatedClient(url, scenario, stats, session_id, player_id)
+        clients.append((client, eventlet.spawn(client.run)))
+
+    def stop():
+        client, thread = clients.pop()
+        client.is_stopped = True
+        thread.wait()
+
+    for client, _thread in clients:
+        client.stats = stats
+
+    # Ramp linearly from the current number of clients to the stage's
+    start_count = len(clients)
+    ramp_secs = stage.get("ramp_secs", 0)
+    ramp_start = time.monotonic()
+    while len(clients) != stage["clients"]:
+        progress = 1
+        if ramp_secs:
+            progress = min(1, (time.monotonic() - ramp_start) / ramp_secs)
+        target = round(start_count + (stage["clients"] - start_count) * progress)
+        while len(clients) < target:
+            spawn()
+        while len(clients) > target:
+            stop()
+        eventlet.sleep(0.1)
+
+    eventlet.sleep(stage["secs"])
+
+
+def run(url: str, scenario: dict) -> List[dict]:
+    """Runs each stage of a scenario in turn.
+
+    :returns: Report for each stage.
+
+    """
+    clients = []
+    reports = []
+    for index, stage in enumerate(scenario["stages"]):
+        stats = Stats()
+        cpu_start = server_cpu_secs(url)
+        start = time.monotonic()
+
+        LOGGER.info("Starting stage: index=%d, stage=%s", index, stage)
+        _run_stage(url, scenario, stage, clients, stats)
+
+        elapsed = time.monotonic() - start
+        cpu_end = server_cpu_secs(url)
+        report = {
+            "stage": index,
+            "clients": stage["clients"],
+            "secs": round(elapsed, 1),
+            "server_cpu_percent": round((cpu_end - cpu_start) / elapsed * 100, 1)
+            if cpu_start is not None and cpu_end is not None
+            else None,
+            "actions": stats.report(elapsed),
+        }
+        LOGGER.info("Finished stage: report=%s", json.dumps(report))
+        reports.append(report)
+
+    for client, thread in clients:
+        client.is_stopped = True
+        thread.wait()
+    return reports
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--scenario", help="path to a scenario file")
+    parser.add_argument("--seed", type=int, help="seed for the random walks")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    ARGS = _parse_args()
+    random.seed(ARGS.seed)
+
+    SCENARIO = dict(_DEFAULT_SCENARIO)
+    if ARGS.scenario:
+        with open(ARGS.scenario) as scenario_file:
+            SCENARIO.update(json.load(scenario_file))
+
+    print(json.dumps(run(ARGS.url, SCENARIO), indent=2))
@@ -0,0 +1,38 @@
+"""Migrates data stored by older versions of the server"""
+import logging
+
+from common import settings
+from game import database, sessions
+
+settings.configure_logger()
+
+LOGGER = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+    database.ensure_indexes()
+
+    # Data stored before sessions belongs to the one every client used to play in
+    SESSION_ID = sessions.DEFAULT_SESSION
+    NUM_ASSIGNED = database.migrate_legacy_sessions(SESSION_ID)
+    LOGGER.info("Assigned %d documents to session %s", NUM_ASSIGNED, SESSION_ID)
+
+    NUM_MOVED = database.migrate_legacy_tiles(SESSION_ID)
+    LOGGER.info("Moved %d tiles into their own documents", NUM_MOVED)
+
+    NUM_EDGES = database.migrate_legacy_edges(SESSION_ID)
+    LOGGER.info("Registered %d edges", NUM_EDGES)
+
+    # Visited flags predate players too, so belong to the one every client played as
+    NUM_VISITED = database.migrate_legacy_visited(SESSION_ID, sessions.DEFAULT_PLAYER)
+    LOGGER.info("Moved %d visited flags into explored bitmaps", NUM_VISITED)
+
+    NUM_HISTORY = database.migrate_legacy_history(SESSION_ID)
+    LOGGER.info("Moved %d history entries into the event log", NUM_HISTORY)
+
+    NUM_COMPRESSED = database.compress_all_backgrounds(SESSION_ID)
+    LOGGER.info(
+        "Compressed %d backgrounds: stats=%s",
+        NUM_COMPRESSED,
+        database.get_background_stats(),
+    )
@@ -0,0 +1,112 @@
+"""Pre-generates tiles around a position, so new sessions don't start cold.
+
+Safe to interrupt and re-run: tiles which already exist are skipped. Edges shared
+between tiles built by different workers are kept consistent by the edge registry,
+where the first worker to create an edge decides its position.
+
+"""
+import time
+import logging
+import argparse
+import functools
+import multiprocessing
+
+from common import settings
+from common.point import Point
+from game import creator, database, sessions
+
+settings.configure_logger()
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--session", default=sessions.DEFAULT_SESSION, help="session to generate for"
+    )
+    parser.add_argument("--min-floor", type=int, default=0)
+    parser.add_argument("--max-floor", type=int, default=0)
+    parser.add_argument("--x", type=int, default=0, help="x-coordinate of centre")
+    parser.add_argument("--y", type=int, default=0, help="y-coordinate of centre")
+    parser.add_argument("--radius", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--batch-size", type=int, default=100)
+    return parser.parse_args()
+
+
+def _missing_targets(args):
+    x0, x1 = args.x - args.radius, args.x + args.radius
+    y0, y1 = args.y - args.radius, args.y + args.radius
+
+    targets = []
+    for z in range(args.min_floor, args.max_floor + 1):
+        existing = {
+            (p.x, p.y)
+            for p in database.get_tile_positions_in_range(
+                args.session, z, x0, x1, y0, y1
+            )
+        }
+        targets += [
+            (x, y, z)
+            for x in range(x0, x1 + 1)
+            for y in range(y0, y1 + 1)
+            if (x, y) not in existing
+        ]
+    return targets
+
+
+def _build(session_id: str, target: tuple):
+    point = Point(*target)
+    return point, creator.build_tile(session_id, point)
+
+
+def pregenerate(args):
+    if not sessions.is_valid(args.session):
+        raise ValueError(f"Invalid session id: {args.session}")
+    database.ensure_indexes()
+
+    targets = _missing_targets(args)
+    LOGGER.info("Pre-generating %d tiles with %d workers", len(targets), args.workers)
+
+    start = time.perf_counter()
+    num_inserted = 0
+    batch = []
+
+    # Spawn rather than fork, so each worker opens its own database connection
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(args.workers) as pool:
+        build = functools.partial(_build, args.session)
+        for result in pool.imap_unordered(build, targets, chunksize=4):
+            batch.append(result)
+            if len(batch) < args.batch_size:
+                continue
+
+            num_inserted += database.insert_tiles(args.session, batch)
+            batch = []
+            LOGGER.info(
+                "Inserted %d/%d tiles: tiles_per_sec=%.1f",
+                num_inserted,
+                len(targets),
+                num_inserted / (time.perf_counter() - start),
+            )
+
+    if batch:
+        num_inserted += database.insert_tiles(args.session, batch)
+
+    elapsed = time.perf_counter() - start
+    LOGGER.info(
+        "Finished pre-generating: num_inserted=%d, secs=%.1f, tiles_per_sec=%.1f",
+        num_inserted,
+        elapsed,
+        num_inserted / elapsed if elapsed else 0,
+    )
+
+
+if __name__ == "__main__":
+    if settings.WORLD_SEED is not None:
+        LOGGER.error("Nothing to do: tiles are not stored when WORLD_SEED is set")
+    elif settings.STORAGE_BACKEND == "memory":
+        LOGGER.error("Nothing to do: the memory backend doesn't outlive this process")
+    else:
+        pregenerate(_parse_args())
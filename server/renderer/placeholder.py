@@ -0,0 +1,62 @@
+"""Cheap stand-in background, drawn from the exits alone while the real one renders"""
+import typing
+
+from common.point import Point
+from common.enum import Direction as Dir
+from renderer.common import exit_config, tile
+
+
+TILE = tile.Tile(width=600, height=400)
+
+_TEMPLATE = (
+    '<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}">'
+    '<g stroke-linecap="round">{walls}{floor}</g></svg>'
+)
+_CORRIDOR = '<path d="M{cx} {cy}L{x} {y}" stroke="{colour}" stroke-width="{width}"/>'
+
+
+def exit_position(config: exit_config.ExitConfig) -> Point:
+    """Position of an exit in `Tile` coordinates, matching the full renderers"""
+    if config.direction == Dir.UP:
+        return Point(config.edge_position * 100, TILE.height)
+    if config.direction == Dir.DOWN:
+        return Point(config.edge_position * 100, 0)
+    if config.direction == Dir.LEFT:
+        return Point(0, config.edge_position * 100)
+    if config.direction == Dir.RIGHT:
+        return Point(TILE.width, config.edge_position * 100)
+    raise ValueError(f"{config.direction} is not a supported {Dir.__name__}")
+
+
+def render_tile(
+    exit_configs: typing.List[exit_config.ExitConfig],
+) -> (typing.Dict[Dir, Point], str):
+    """Draws a straight corridor from the centre to each open exit.
+
+    :returns: Tuple of the exit positions and the SVG background.
+
+    """
+    exits_pos = {c.direction: exit_position(c) for c in exit_configs}
+    open_exits = [exits_pos[c.direction] for c in exit_configs if not c.is_blocked]
+
+    walls, floor = [], []
+    for point in open_exits:
+        walls.append(_corridor(point, "#000000", 112))
+        floor.append(_corridor(point, "#f7faff", 100))
+
+    background = _TEMPLATE.format(
+        width=TILE.width, height=TILE.height, walls="".join(walls), floor="".join(floor)
+    )
+    return exits_pos, background
+
+
+def _corridor(point: Point, colour: str, width: int) -> str:
+    # SVG's y-axis points down
+    return _CORRIDOR.format(
+        cx=TILE.width // 2,
+        cy=TILE.height // 2,
+        x=point.x,
+        y=TILE.height - point.y,
+        colour=colour,
+        width=width,
+    )
@@ -4,7 +4,7 @@ import typing
 import svgwrite
 from scour import scour
 
-from common import settings
+from common import tracing
 from common.point import Point
 from common.enum import Direction as Dir
 
@@ -640,12 +640,11 @@ def load_configs(
     return exits
 
 
-def scour_tile(name) -> str:
-    input_path = settings.TILE_OUTPUT_DIR + name + ".svg"
-    output_path = settings.TILE_OUTPUT_DIR + name + "_scoured.svg"
-    options = scour.parse_args(args=[input_path, output_path])
-    scour.start(options, *scour.getInOut(options))
-    return name + "_scoured.svg"
+@tracing.traced()
+def scour_tile(svg: str) -> str:
+    """Optimises a rendered SVG, returning it without newlines"""
+    options = scour.parse_args(args=[])
+    return scour.scourString(svg, options).replace("\n", "")
 
 
 def render_tile(exit_configs: typing.List[exit_config.ExitConfig]):
@@ -663,19 +662,17 @@ def render_tile(exit_configs: typing.List[exit_config.ExitConfig]):
     ]
     exits_pos = {d: Point(e.point.x * 100, e.point.y * 100) for d, e in exits.items()}
 
-    name = "tunnel"
-    dwg = svgwrite.Drawing(
-        profile="tiny",
-        filename=settings.TILE_OUTPUT_DIR + name + ".svg",
-        size=(tile_.width, tile_.height),
-    )
+    dwg = svgwrite.Drawing(profile="tiny", size=(tile_.width, tile_.height))
     draw_walls(dwg, elbows)
     # draw_debug(dwg, path, grid, elbows, entities)
-    dwg.save()
+    # Serialized in memory, so renders leave no files behind and concurrent renders
+    # can't overwrite each other's
+    with tracing.span("renderer.serialize_svg"):
+        svg = dwg.tostring()
 
-    filename = scour_tile(name)
+    background = scour_tile(svg)
 
-    return settings.TILE_OUTPUT_DIR, entities, exits_pos, filename
+    return entities, exits_pos, background
 
 
 if __name__ == "__main__":
@@ -685,4 +682,4 @@ if __name__ == "__main__":
         exit_config.ExitConfig(Dir.LEFT, 1, False),
         exit_config.ExitConfig(Dir.RIGHT, 1, False),
     ]
-    render_tile(EXIT_CONFIGS)
+    print(render_tile(EXIT_CONFIGS)[2])
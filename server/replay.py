@@ -0,0 +1,287 @@
+"""Replays recorded socket traffic, and compares latency between builds.
+
+Traffic is recorded by a server started with RECORD_PATH set (see
+web/socket/recorder.py). Each recorded client is replayed by its own client, which
+connects, sends its `json` actions and disconnects at the recorded times, optionally
+sped up or slowed down. Actions are sent on schedule, whether or not earlier ones have
+been answered, as the original clients did. Each is sent with a `request_id`, which the
+server echoes in its reply, so replies are told apart even once the server has
+coalesced them. Recorded payloads which aren't actions can't carry one, so are sent
+but not timed.
+
+To compare two builds, start each from the same initial state, e.g. by snapshotting the
+database with scripts/snapshot-db.sh before recording and restoring it with
+scripts/restore-db.sh before each replay, then
+
+    python replay.py run --recording traffic.jsonl --output before.json
+    python replay.py run --recording traffic.jsonl --output after.json
+    python replay.py compare before.json after.json
+
+Requires the packages in requirements-dev.txt.
+
+"""
+# Clients are greenthreads, so many can run in one process
+import eventlet
+
+eventlet.monkey_patch()
+
+# pylint: disable=wrong-import-position
+import json
+import time
+import logging
+import argparse
+import collections
+from typing import Dict, List
+from urllib.parse import urlencode
+
+import socketio
+
+from common import settings
+from loadtest import Stats, RESPONSES, SUCCESSES, server_cpu_secs
+
+settings.configure_logger()
+
+LOGGER = logging.getLogger(__name__)
+
+
+def load_recording(path: str) -> Dict[str, List[tuple]]:
+    """Reads a recording.
+
+    :returns: Dict mapping from each client's sid to its `(offset_secs, event,
+    payload)` records in order, where offsets are from the start of the recording.
+
+    """
+    records = []
+    with open(path) as recording:
+        for line_num, line in enumerate(recording, 1):
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # e.g. the last line, if the server stopped while writing it
+                LOGGER.warning("Skipped invalid record: line=%d", line_num)
+
+    sessions = collections.defaultdict(list)
+    if not records:
+        return sessions
+
+    start = min(record[0] for record in records)
+    for recorded_at, sid, event, payload in sorted(records, key=lambda r: r[0]):
+        sessions[sid].append((recorded_at - start, event, payload))
+    return sessions
+
+
+class ReplayClient:
+    """
+    :param url: Base URL of the server.
+    :param records: The client's records, as returned by `load_recording`.
+    :param stats: Where to record answered actions.
+    :param timeout_secs: How long to wait for an answer before counting a timeout.
+
+    """
+
+    def __init__(
+        self, url: str, records: List[tuple], stats: Stats, timeout_secs: float
+    ) -> None:
+        self.url = url
+        self.records = records
+        self.stats = stats
+        self.timeout_secs = timeout_secs
+        # Furthest behind schedule an action was sent
+        self.max_lag_secs = 0.0
+
+        self._sio = socketio.Client(reconnection=False)
+        self._sio.on("json", self._on_json)
+        # Dict mapping from the request id of each unanswered action to a
+        # `(name, sent_at)` tuple
+        self._pending: Dict[str, tuple] = {}
+        self._num_sent = 0
+
+    def run(self, start: float, speed: float) -> None:
+        """
+        :param start: `time.monotonic` time at which the recording starts.
+        :param speed: Multiple of the recorded speed to replay at.
+
+        """
+        for offset_secs, event, payload in self.records:
+            lag_secs = time.monotonic() - (start + offset_secs / speed)
+            if lag_secs < 0:
+                eventlet.sleep(-lag_secs)
+            else:
+                self.max_lag_secs = max(self.max_lag_secs, lag_secs)
+
+            if event == "disconnect":
+                break
+            if not self._sio.connected and not self._connect(
+                payload if event == "connect" else None
+            ):
+                return
+            if event == "json":
+                self._send(payload)
+
+        self._wait_for_answers()
+        if self._sio.connected:
+            self._sio.disconnect()
+
+    def _connect(self, details: dict = None) -> bool:
+        """
+        :param details: Optionally, the recorded connect event, naming the session the
+        client played in and the player it played as.
+
+        """
+        url = self.url
+        details = details or {}
+        args = {k: details[k] for k in ["session", "player"] if details.get(k)}
+        if args:
+            url = f"{url}?{urlencode(args)}"
+        try:
+            self._sio.connect(url, transports=["websocket"])
+        except socketio.exceptions.ConnectionError as err:
+            self.stats.record("connect", 0, error=type(err).__name__)
+            return False
+        return True
+
+    def _send(self, payload: dict) -> None:
+        action = payload.get("action") if isinstance(payload, dict) else None
+        if not isinstance(action, dict):
+            self._sio.emit("json", payload)
+            return
+
+        name = str(action.get("name", "invalid")).lower()
+        if name not in RESPONSES:
+            name = "invalid"
+        self._num_sent += 1
+        # Unique across clients, as other clients' replies may be pushed to this one
+        request_id = f"{id(self)}-{self._num_sent}"
+        self._pending[request_id] = (name, time.perf_counter())
+        action = dict(action, request_id=request_id)
+        self._sio.emit("json", dict(payload, action=action))
+
+    def _wait_for_answers(self) -> None:
+        deadline = time.monotonic() + self.timeout_secs
+        while self._pending and time.monotonic() < deadline:
+            eventlet.sleep(0.05)
+
+        for name, _sent_at in self._pending.values():
+            self.stats.record(name, self.timeout_secs, error="TIMEOUT")
+        self._pending = {}
+
+    def _on_json(self, frame: dict) -> None:
+        events = frame["events"] if frame["status"] == "BATCH" else [frame]
+        for event in events:
+            status = event["status"]
+            message = json.loads(event["message"]) if event.get("message") else {}
+            pending = self._pending.pop(message.get("request_id"), None)
+            if pending is None:
+                # Not a reply to this client, e.g. a tile pushed to its viewport
+                continue
+            name, sent_at = pending
+            # A superseded move is still answered, by the tile it moved to
+            is_success = status in SUCCESSES or status == "TILE_UPDATED"
+            self.stats.record(
+                name, time.perf_counter() - sent_at, None if is_success else status
+            )
+
+
+def run(url: str, sessions: Dict[str, List[tuple]], speed: float, timeout_secs: float):
+    """Replays every recorded client at once.
+
+    :returns: Report of latencies and errors by action.
+
+    """
+    stats = Stats()
+    clients = [
+        ReplayClient(url, records, stats, timeout_secs)
+        for records in sessions.values()
+    ]
+
+    LOGGER.info("Starting replay: clients=%d, speed=%s", len(clients), speed)
+    cpu_start = server_cpu_secs(url)
+    start = time.monotonic()
+    threads = [eventlet.spawn(client.run, start, speed) for client in clients]
+    for thread in threads:
+        thread.wait()
+    elapsed = time.monotonic() - start
+    cpu_end = server_cpu_secs(url)
+
+    return {
+        "url": url,
+        "speed": speed,
+        "clients": len(clients),
+        "secs": round(elapsed, 1),
+        "max_lag_ms": round(max((c.max_lag_secs for c in clients), default=0) * 1000),
+        "server_cpu_percent": round((cpu_end - cpu_start) / elapsed * 100, 1)
+        if cpu_start is not None and cpu_end is not None
+        else None,
+        "actions": stats.report(elapsed),
+    }
+
+
+def compare(baseline: dict, candidate: dict) -> dict:
+    """Compares the latencies of two replays of the same recording, by action.
+
+    :returns: Dict mapping from action to each percentile of both replays, and the
+    difference between them.
+
+    """
+    deltas = {}
+    for action in sorted(set(baseline["actions"]) | set(candidate["actions"])):
+        before = baseline["actions"].get(action)
+        after = candidate["actions"].get(action)
+        if not before or not after:
+            deltas[action] = {"baseline": before, "candidate": after}
+            continue
+
+        deltas[action] = {
+            "count": [before["count"], after["count"]],
+            "errors": [before["errors"], after["errors"]],
+        }
+        for percentile in ["p50_ms", "p95_ms", "p99_ms"]:
+            delta_ms = after[percentile] - before[percentile]
+            deltas[action][percentile] = {
+                "baseline": before[percentile],
+                "candidate": after[percentile],
+                "delta": round(delta_ms, 1),
+                "delta_percent": round(delta_ms / before[percentile] * 100, 1)
+                if before[percentile]
+                else None,
+            }
+    return deltas
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="replay a recording")
+    run_parser.add_argument("--recording", required=True, help="path to a recording")
+    run_parser.add_argument("--url", default="http://localhost:5000")
+    run_parser.add_argument(
+        "--speed", type=float, default=1, help="multiple of the recorded speed"
+    )
+    run_parser.add_argument("--timeout-secs", type=float, default=10)
+    run_parser.add_argument("--output", help="path to write the report to")
+
+    compare_parser = commands.add_parser("compare", help="compare two reports")
+    compare_parser.add_argument("baseline", help="path to the report of the old build")
+    compare_parser.add_argument("candidate", help="path to the report of the new build")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    ARGS = _parse_args()
+
+    if ARGS.command == "run":
+        REPORT = run(
+            ARGS.url, load_recording(ARGS.recording), ARGS.speed, ARGS.timeout_secs
+        )
+        if ARGS.output:
+            with open(ARGS.output, "w") as output_file:
+                json.dump(REPORT, output_file, indent=2)
+        print(json.dumps(REPORT, indent=2))
+    else:
+        with open(ARGS.baseline) as baseline_file:
+            BASELINE = json.load(baseline_file)
+        with open(ARGS.candidate) as candidate_file:
+            CANDIDATE = json.load(candidate_file)
+        REPORT = compare(BASELINE, CANDIDATE)
+        print(json.dumps(REPORT, indent=2))
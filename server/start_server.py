@@ -1,4 +1,10 @@
 """Executes a Flask app"""
+# Must happen before anything else is imported, so database calls and waits on
+# locks (e.g. for tile generation slots) yield to other greenthreads
+import eventlet
+
+eventlet.monkey_patch()
+
 from web import app
 from common import settings
 
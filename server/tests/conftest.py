@@ -0,0 +1,23 @@
+"""Runs the game against the in-memory backend, applying actions as they arrive, in the
+default mode where tiles are stored as they are created"""
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+os.environ.setdefault("TICK_SECS", "0")
+
+# Imports are rooted at the server directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from common import settings  # noqa: E402
+from game import creator  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def default_mode(monkeypatch):
+    monkeypatch.setattr(settings, "WORLD_SEED", None)
+    # Every side open, so any adjacent tile can be navigated to
+    monkeypatch.setattr(creator, "_prob_blockage", lambda: 0.0)
@@ -0,0 +1,74 @@
+"""Per-session state cached in memory is bounded, and dropped when a session ends"""
+import functools
+
+from common import settings
+from common.point import Point
+from game import actions, explored, pathfinder, positions, sessions
+
+
+PLAYER = sessions.DEFAULT_PLAYER
+
+
+def _buffer(stored: dict, max_sessions: int) -> positions.PositionBuffer:
+    return positions.PositionBuffer(
+        load=stored.get,
+        store=stored.__setitem__,
+        flush_secs=60,
+        is_immediate=False,
+        max_sessions=max_sessions,
+    )
+
+
+def test_least_recently_used_positions_are_forgotten_once_written():
+    stored = {}
+    buffer = _buffer(stored, max_sessions=2)
+    buffer.set("a", Point(1, 0, 0))
+    buffer.set("b", Point(2, 0, 0))
+    buffer.set("c", Point(3, 0, 0))
+    # Nothing has been written, so nothing can be forgotten
+    assert list(buffer._positions) == ["a", "b", "c"]
+
+    buffer.flush()
+    buffer.get("c")
+    assert list(buffer._positions) == ["b", "c"]
+    assert buffer.get("a") == Point(1, 0, 0)
+
+
+def test_evicted_position_is_written_first():
+    stored = {}
+    buffer = _buffer(stored, max_sessions=10)
+    buffer.set("a", Point(1, 0, 0))
+    buffer.evict("a")
+
+    assert stored == {"a": Point(1, 0, 0)}
+    assert "a" not in buffer._positions
+
+
+def test_evicted_session_is_reloaded_from_the_database():
+    actions.create_initial_tile("eviction", PLAYER)
+    target_pos = Point(1, 0, 0)
+    target_tile = actions.prepare_navigate("eviction", target_pos)
+    navigate = functools.partial(
+        actions.navigate, PLAYER, target_pos, target_tile=target_tile
+    )
+    actions.scheduler.run("eviction", navigate)
+    assert explored.contains("eviction", PLAYER, target_pos)
+
+    actions.evict_session("eviction")
+    assert not any(key[0] == "eviction" for key in explored._SETS)
+    assert not any(key[0] == "eviction" for key in pathfinder._INDEXES)
+
+    assert actions.get_or_update_current_position("eviction") == target_pos
+    assert explored.contains("eviction", PLAYER, target_pos)
+    assert pathfinder.shortest_path("eviction", PLAYER, target_pos, Point(0, 0, 0))
+
+
+def test_explored_sets_are_bounded(monkeypatch):
+    monkeypatch.setattr(settings, "SESSION_CACHE_SIZE", 2)
+    for player_id in ["a", "b", "c"]:
+        explored.contains("eviction-bounded", player_id, Point(0, 0, 0))
+
+    assert [key for key in explored._SETS if key[0] == "eviction-bounded"] == [
+        ("eviction-bounded", "b"),
+        ("eviction-bounded", "c"),
+    ]
@@ -0,0 +1,49 @@
+"""Session event log"""
+from common.point import Point
+from game import actions, sessions
+
+
+ORIGIN = Point(0, 0, 0).serialize()
+TARGET = Point(1, 0, 0).serialize()
+PLAYER = sessions.DEFAULT_PLAYER
+
+
+def _events(session_id: str):
+    _snapshot, events = actions.get_session_log(session_id, since=0, limit=100)
+    return [(event["type"], event.get("pos")) for event in events]
+
+
+def test_initial_tile_creation_is_logged():
+    actions.create_initial_tile("history-initial", PLAYER)
+
+    assert _events("history-initial") == [
+        ("tile_created", ORIGIN),
+        ("visited", ORIGIN),
+    ]
+
+
+def test_navigate_logs_creation_of_target_tile():
+    actions.create_initial_tile("history-navigate", PLAYER)
+    target_pos = Point.deserialize(TARGET)
+
+    target_tile = actions.prepare_navigate("history-navigate", target_pos)
+    actions.scheduler.run(
+        "history-navigate",
+        lambda state: actions.navigate(
+            PLAYER, target_pos, state, target_tile=target_tile
+        ),
+    )
+
+    assert _events("history-navigate")[2:] == [
+        ("tile_created", TARGET),
+        ("visited", TARGET),
+        ("navigate", None),
+    ]
+
+
+def test_existing_tile_is_not_logged_again():
+    actions.create_initial_tile("history-existing", PLAYER)
+    actions.create_initial_tile("history-existing", PLAYER)
+
+    created = [e for e in _events("history-existing") if e[0] == "tile_created"]
+    assert created == [("tile_created", ORIGIN)]
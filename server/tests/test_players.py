@@ -0,0 +1,65 @@
+"""Exploration is tracked per player, while the position is shared by the session"""
+import functools
+
+import pytest
+
+from common.point import Point
+from game import actions, errors
+
+
+ORIGIN = Point(0, 0, 0)
+TARGET = Point(1, 0, 0)
+
+
+def _navigate(session_id: str, player_id: str, target_pos: Point):
+    target_tile = actions.prepare_navigate(session_id, target_pos)
+    navigate = functools.partial(
+        actions.navigate, player_id, target_pos, target_tile=target_tile
+    )
+    return actions.scheduler.run(session_id, navigate)
+
+
+def _visited(session_id: str, player_id: str):
+    tiles = actions.get_visited_tiles_on_floor(session_id, player_id, 0)
+    return sorted(t["position"].serialize() for t in tiles)
+
+
+def test_players_only_see_tiles_they_visited():
+    actions.create_initial_tile("players-visited", "alice")
+    actions.create_initial_tile("players-visited", "bob")
+    _navigate("players-visited", "alice", TARGET)
+
+    assert _visited("players-visited", "alice") == sorted(
+        [ORIGIN.serialize(), TARGET.serialize()]
+    )
+    assert _visited("players-visited", "bob") == [ORIGIN.serialize()]
+
+
+def test_players_cannot_travel_where_only_others_have_been():
+    actions.create_initial_tile("players-travel", "alice")
+    actions.create_initial_tile("players-travel", "bob")
+    _navigate("players-travel", "alice", TARGET)
+    _navigate("players-travel", "alice", ORIGIN)
+
+    travel = functools.partial(actions.travel, "bob", TARGET)
+    with pytest.raises(errors.InvalidAction):
+        actions.scheduler.run("players-travel", travel)
+
+    travel = functools.partial(actions.travel, "alice", TARGET)
+    tile, path = actions.scheduler.run("players-travel", travel)
+    assert path == [ORIGIN, TARGET]
+
+
+def test_players_can_travel_from_where_others_moved_the_party():
+    actions.create_initial_tile("players-party", "alice")
+    actions.create_initial_tile("players-party", "bob")
+    # Moves the party onto a tile only alice has visited
+    _navigate("players-party", "alice", TARGET)
+
+    travel = functools.partial(actions.travel, "bob", ORIGIN)
+    _tile, path = actions.scheduler.run("players-party", travel)
+
+    assert path == [TARGET, ORIGIN]
+    assert _visited("players-party", "bob") == sorted(
+        [ORIGIN.serialize(), TARGET.serialize()]
+    )
@@ -0,0 +1,24 @@
+"""Parsing of settings which are more than a single value"""
+import pytest
+
+from common import settings
+
+
+def test_sample_rates_are_parsed():
+    rates = settings._parse_sample_rates("socket.message=0.01,game.actions=1,")
+    assert rates == {"socket.message": 0.01, "game.actions": 1.0}
+
+
+@pytest.mark.parametrize("value", ["foo", "=0.5", "foo=", "foo=bar", "foo=1.5"])
+def test_malformed_sample_rates_are_rejected(value):
+    with pytest.raises(ValueError, match="LOG_SAMPLE_RATES"):
+        settings._parse_sample_rates(value)
+
+
+def test_compression_levels_are_checked_per_codec(monkeypatch):
+    monkeypatch.setenv("BROTLI_QUALITY", "11")
+    assert settings._parse_level("BROTLI_QUALITY", 6, 0, 11) == 11
+
+    monkeypatch.setenv("GZIP_LEVEL", "11")
+    with pytest.raises(ValueError, match="GZIP_LEVEL"):
+        settings._parse_level("GZIP_LEVEL", 6, 1, 9)
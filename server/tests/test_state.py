@@ -0,0 +1,40 @@
+"""Changes buffered by a tick only reach the process-wide caches once persisted"""
+import pytest
+
+from common.point import Point
+from game import actions, database, explored, pathfinder, sessions
+from game.state import SessionState
+
+
+PLAYER = sessions.DEFAULT_PLAYER
+ORIGIN = Point(0, 0, 0)
+TARGET = Point(1, 0, 0)
+
+
+def test_failed_flush_leaves_caches_unchanged(monkeypatch):
+    actions.create_initial_tile("state-failed", PLAYER)
+    state = SessionState("state-failed")
+    actions.navigate(PLAYER, TARGET, state)
+
+    def fail(**_kwargs):
+        raise RuntimeError("Write failed")
+
+    monkeypatch.setattr(database, "apply_session_changes", fail)
+    with pytest.raises(RuntimeError):
+        state.flush()
+
+    assert not explored.contains("state-failed", PLAYER, TARGET)
+    assert not pathfinder.shortest_path("state-failed", PLAYER, ORIGIN, TARGET)
+
+
+def test_tiles_visited_earlier_in_the_tick_can_be_travelled_to():
+    actions.create_initial_tile("state-tick", PLAYER)
+    state = SessionState("state-tick")
+    actions.navigate(PLAYER, TARGET, state)
+    actions.navigate(PLAYER, ORIGIN, state)
+
+    _tile, path = actions.travel(PLAYER, TARGET, state)
+    assert path == [ORIGIN, TARGET]
+
+    state.flush()
+    assert explored.contains("state-tick", PLAYER, TARGET)
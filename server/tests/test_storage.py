@@ -0,0 +1,27 @@
+"""Storage backends keep to the `Storage` contract"""
+import pytest
+
+from common.point import Point
+from game.storage.base import Storage
+from game.storage.memory import MemoryStorage
+
+
+def test_incomplete_backends_cannot_be_constructed():
+    class Incomplete(Storage):
+        def ensure_indexes(self) -> None:
+            pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_memory_reads_do_not_create_sessions():
+    storage = MemoryStorage()
+    storage.get_current_position("probe")
+    storage.get_tile("probe", Point(0, 0, 0))
+    storage.get_tile_positions_in_range("probe", 3, -1, 1, -1, 1)
+    storage.get_tiles_in_range_version("probe", 3, -1, 1, -1, 1)
+    storage.get_events("probe", 0, 10)
+
+    assert "probe" not in storage._sessions
+    assert not storage._empty.floors
@@ -12,12 +12,13 @@ def create_app():
     app = Flask(__name__)
 
     _configure_settings(app)
+    _configure_database()
 
     _configure_http_handlers(app)
     _configure_http_error_handlers(app)
     _configure_http_response(app)
 
-    socketio = SocketIO(app, engineio_logger=True, cors_allowed_origins=[])
+    socketio = _create_socketio(app)
     _configure_socket_handlers(socketio)
 
     return lambda *args, **kwargs: socketio.run(app, *args, **kwargs)
@@ -30,10 +31,18 @@ def _configure_settings(app):
     return app
 
 
+def _configure_database():
+    from game import database
+
+    database.ensure_indexes()
+
+
 def _configure_http_handlers(app):
     from web.http.handlers import HTTP_API
+    from web.http.debug import DEBUG_API
 
     app.register_blueprint(HTTP_API)
+    app.register_blueprint(DEBUG_API, url_prefix="/debug")
     return app
 
 
@@ -45,12 +54,51 @@ def _configure_http_error_handlers(app):
 
 
 def _configure_http_response(app):
+    from flask import request
+    from common import settings
+    from web import compression
+
     @app.after_request
     def _after_request(resp):
-        resp.headers["Content-Type"] = "application/json"
+        if resp.mimetype == app.response_class.default_mimetype:
+            # Not set explicitly by the handler
+            resp.headers["Content-Type"] = "application/json"
+        resp.headers.add("Vary", "Accept-Encoding")
+
+        if (
+            resp.direct_passthrough
+            or resp.status_code != 200
+            or "Content-Encoding" in resp.headers
+        ):
+            return resp
+
+        data = resp.get_data()
+        if len(data) < settings.COMPRESSION_MIN_SIZE:
+            return resp
+
+        encoding = compression.negotiate(request.headers.get("Accept-Encoding"))
+        if not encoding:
+            return resp
+
+        resp.set_data(compression.compress(data, encoding))
+        resp.headers["Content-Encoding"] = encoding
         return resp
 
 
+def _create_socketio(app) -> SocketIO:
+    from common import settings
+
+    # Polling transport payloads are compressed by engineio. Websocket frames are
+    # compressed by eventlet, which negotiates permessage-deflate with the client.
+    return SocketIO(
+        app,
+        engineio_logger=settings.ENGINEIO_LOGGER,
+        cors_allowed_origins=[],
+        http_compression=True,
+        compression_threshold=settings.COMPRESSION_MIN_SIZE,
+    )
+
+
 def _configure_socket_handlers(socketio: SocketIO):
     from web.socket.handlers import configure_handlers
 
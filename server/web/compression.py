@@ -0,0 +1,56 @@
+"""Negotiates and applies HTTP response compression"""
+import gzip
+
+import brotli
+
+from common import settings
+
+
+# Ordered by preference
+_ENCODINGS = ["br", "gzip"]
+
+
+def negotiate(accept_encoding: str) -> str:
+    """Picks the preferred encoding the client accepts. An encoding named with `q=0` is
+    never picked, even if `*` is accepted.
+
+    :param accept_encoding: Value of the request's `Accept-Encoding` header.
+    :returns: An encoding name, or None if no supported encoding is acceptable.
+
+    """
+    # Dict mapping from encoding name (or "*") to its quality
+    qualities = {}
+    for token in (accept_encoding or "").split(","):
+        parts = token.strip().split(";")
+        name = parts[0].strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name] = quality
+
+    for encoding in _ENCODINGS:
+        if qualities.get(encoding, qualities.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """Compresses a payload.
+
+    :param data: Uncompressed payload.
+    :param encoding: One of the encodings returned by `negotiate`.
+    :returns: Compressed payload.
+
+    """
+    if encoding == "br":
+        return brotli.compress(data, quality=settings.BROTLI_QUALITY)
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=settings.GZIP_LEVEL)
+    raise ValueError(f"Unsupported encoding: {encoding}")
@@ -0,0 +1,101 @@
+"""Configures diagnostic routes, which require the debug token"""
+import hmac
+import logging
+
+import flask
+from marshmallow import fields, Schema, ValidationError
+from marshmallow.validate import Range
+
+from common import profiling, settings, tracing
+from web.http import errors
+from game import actions
+
+LOGGER = logging.getLogger(__name__)
+
+DEBUG_API = flask.Blueprint("debug_api", __name__)
+
+_PROFILER = profiling.SamplingProfiler()
+_MEMORY_SNAPSHOTS = profiling.MemorySnapshots(settings.MEMORY_MAX_SNAPSHOTS)
+
+
+@DEBUG_API.before_request
+def _authenticate():
+    if not settings.DEBUG_TOKEN:
+        raise errors.ApiNotFound()
+
+    scheme, _, token = flask.request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(
+        token.encode(), settings.DEBUG_TOKEN.encode()
+    ):
+        raise errors.ApiInvalidToken()
+
+
+def _load_args(schema: Schema) -> dict:
+    try:
+        return schema.load(flask.request.args)
+    except ValidationError as err:
+        raise errors.ApiValidationError(errors=err.messages)
+
+
+@DEBUG_API.route("/traces")
+def traces():
+    return flask.jsonify(tracing.get_slow_traces()), 200
+
+
+@DEBUG_API.route("/queries")
+def queries():
+    return flask.jsonify(actions.get_query_stats()), 200
+
+
+class ProfileArgsSchema(Schema):
+    secs = fields.Float(missing=10, validate=Range(min=0.1))
+    interval_ms = fields.Float(missing=5, validate=Range(min=1, max=1000))
+
+
+@DEBUG_API.route("/profile", methods=["POST"])
+def profile():
+    args = _load_args(ProfileArgsSchema())
+    duration_secs = min(args["secs"], settings.PROFILE_MAX_SECS)
+
+    LOGGER.info("Starting CPU profile: secs=%s", duration_secs)
+    try:
+        stacks = _PROFILER.profile(duration_secs, args["interval_ms"] / 1000)
+    except profiling.ProfilerBusy:
+        raise errors.ApiConflict(message="A profile is already running.")
+
+    return flask.Response(stacks, mimetype="text/plain"), 200
+
+
+class MemoryArgsSchema(Schema):
+    limit = fields.Integer(missing=25, validate=Range(min=1, max=500))
+
+
+class MemoryDiffArgsSchema(MemoryArgsSchema):
+    to = fields.Integer(required=True)
+
+
+@DEBUG_API.route("/memory/snapshots", methods=["POST"])
+def take_memory_snapshot():
+    args = _load_args(MemoryArgsSchema())
+
+    snapshot_id = _MEMORY_SNAPSHOTS.take()
+    resp = {"id": snapshot_id, "top": _MEMORY_SNAPSHOTS.top(snapshot_id, args["limit"])}
+    return flask.jsonify(resp), 201
+
+
+@DEBUG_API.route("/memory/snapshots/<int:snapshot_id>/diff")
+def diff_memory_snapshots(snapshot_id: int):
+    args = _load_args(MemoryDiffArgsSchema())
+
+    try:
+        stats = _MEMORY_SNAPSHOTS.diff(snapshot_id, args["to"], args["limit"])
+    except KeyError:
+        raise errors.ApiNotFound(message="No such snapshot.")
+
+    return flask.jsonify({"from": snapshot_id, "to": args["to"], "diff": stats}), 200
+
+
+@DEBUG_API.route("/memory/snapshots", methods=["DELETE"])
+def stop_memory_tracing():
+    _MEMORY_SNAPSHOTS.stop()
+    return "", 204
@@ -9,6 +9,8 @@ class ApiErrorCode:
     FORBIDDEN = "forbidden"
     NOT_FOUND = "not_found"
     METHOD_NOT_ALLOWED = "method_not_allowed"
+    CONFLICT = "conflict"
+    SERVICE_UNAVAILABLE = "service_unavailable"
 
 
 class ApiException(Exception):
@@ -66,3 +68,15 @@ class ApiNotFound(ApiException):
     status = 404
     code = ApiErrorCode.NOT_FOUND
     message = "This is not the cave you're looking for."
+
+
+class ApiConflict(ApiException):
+    status = 409
+    code = ApiErrorCode.CONFLICT
+    message = "Someone else is already doing that."
+
+
+class ApiServiceUnavailable(ApiException):
+    status = 503
+    code = ApiErrorCode.SERVICE_UNAVAILABLE
+    message = "The cave is busy, try again shortly."
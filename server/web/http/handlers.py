@@ -2,16 +2,36 @@
 import logging
 
 import flask
-from marshmallow import fields, Schema
+from marshmallow import fields, Schema, ValidationError, validates_schema
+from marshmallow.validate import Range, Regexp
+from werkzeug.http import quote_etag
 
-from web import marshal
-from game import builder, actions
+from common import metrics, settings
+from common.point import Point
+from web import compression, marshal, schemas
+from web.schemas import TileSchema
+from web.http import errors
+from game import creator, actions, sessions, errors as game_errors
 
 LOGGER = logging.getLogger(__name__)
 
 HTTP_API = flask.Blueprint("http_api", __name__)
 
 
+class SessionArgsSchema(Schema):
+    session = fields.String(
+        missing=sessions.DEFAULT_SESSION,
+        validate=Regexp(sessions.SESSION_ID_PATTERN),
+    )
+
+
+def _load_args(schema: Schema) -> dict:
+    try:
+        return schema.load(flask.request.args)
+    except ValidationError as err:
+        raise errors.ApiValidationError(errors=err.messages)
+
+
 class PositionSchema(Schema):
     x = fields.Integer()
     y = fields.Integer()
@@ -20,21 +40,184 @@ class PositionSchema(Schema):
 
 class NavigateSchema(Schema):
     background = fields.String()
+    background_url = fields.String()
     current_position = fields.Nested(PositionSchema)
     available_actions = fields.String(many=True)
 
 
 @HTTP_API.route("/current")
 def current():
-    current_pos = actions.get_or_update_current_position()
+    session_id = _load_args(SessionArgsSchema())["session"]
+    current_pos = actions.get_or_update_current_position(session_id)
 
-    tile = builder.get_or_create_tile(current_pos)
-    background = tile["background"]
+    try:
+        tile = creator.get_or_create_tile(session_id, current_pos)
+        available_actions = actions.get_available_actions(session_id)
+    except game_errors.GenerationBusy:
+        raise errors.ApiServiceUnavailable()
 
-    # Build response
+    # Build response. The background is served by its own URL, compressed as stored.
     resp = {
-        "background": background,
+        "background_url": schemas.background_url(
+            session_id, current_pos, is_placeholder=tile.get("is_placeholder", False)
+        ),
         "current_position": current_pos,
-        "available_actions": actions.get_available_actions(),
+        "available_actions": available_actions,
     }
+    if settings.INLINE_BACKGROUNDS:
+        resp["background"] = tile["background"]
     return marshal.marshal(resp, schema=NavigateSchema()), 200
+
+
+@HTTP_API.route("/current/background")
+def current_background():
+    session_id = _load_args(SessionArgsSchema())["session"]
+    current_pos = actions.get_or_update_current_position(session_id)
+    return _background_response(session_id, current_pos, create=True)
+
+
+class TileBackgroundArgsSchema(SessionArgsSchema):
+    x = fields.Integer(required=True)
+    y = fields.Integer(required=True)
+    z = fields.Integer(required=True)
+    # Only distinguishes the URL of a placeholder from that of the completed tile
+    placeholder = fields.Boolean()
+
+
+@HTTP_API.route("/tiles/background")
+def tile_background():
+    args = _load_args(TileBackgroundArgsSchema())
+    point = Point(args["x"], args["y"], args["z"])
+    return _background_response(args["session"], point, create=False)
+
+
+def _background_response(session_id: str, point: Point, create: bool):
+    """
+    :param create: Whether to create the tile if there isn't one, rather than raising
+    `ApiNotFound`.
+
+    """
+    # Serve the copy compressed when the tile was stored, if the client accepts it
+    encoding = compression.negotiate(flask.request.headers.get("Accept-Encoding"))
+    if encoding:
+        encoded = actions.get_encoded_background(session_id, point, encoding)
+        if encoded is not None:
+            return flask.Response(
+                encoded,
+                mimetype="image/svg+xml",
+                headers={"Content-Encoding": encoding},
+            )
+
+    if create:
+        try:
+            tile = creator.get_or_create_tile(session_id, point)
+        except game_errors.GenerationBusy:
+            raise errors.ApiServiceUnavailable()
+    else:
+        tile = actions.get_tile(session_id, point, fields=["background"])
+        if not tile:
+            raise errors.ApiNotFound()
+    return flask.Response(tile["background"], mimetype="image/svg+xml")
+
+
+@HTTP_API.route("/metrics")
+def metrics_():
+    return flask.Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+class TileRangeArgsSchema(SessionArgsSchema):
+    player = fields.String(
+        missing=sessions.DEFAULT_PLAYER,
+        validate=Regexp(sessions.SESSION_ID_PATTERN),
+    )
+    z = fields.Integer(required=True)
+    x0 = fields.Integer(required=True)
+    x1 = fields.Integer(required=True)
+    y0 = fields.Integer(required=True)
+    y1 = fields.Integer(required=True)
+    cursor = fields.String()
+    limit = fields.Integer(missing=100, validate=Range(min=1, max=500))
+
+    @validates_schema
+    def _validate_bounds(self, data, **_kwargs):
+        if data["x0"] > data["x1"]:
+            raise ValidationError("x0 must not be greater than x1", "x0")
+        if data["y0"] > data["y1"]:
+            raise ValidationError("y0 must not be greater than y1", "y0")
+
+
+class TileRangeSchema(Schema):
+    tiles = fields.Nested(TileSchema, many=True)
+    next_cursor = fields.String(allow_none=True)
+
+
+@HTTP_API.route("/tiles")
+def tiles_in_range():
+    args = _load_args(TileRangeArgsSchema())
+
+    try:
+        after = Point.deserialize(args["cursor"]) if "cursor" in args else None
+    except ValueError:
+        raise errors.ApiValidationError(errors={"cursor": ["Invalid cursor."]})
+
+    bounds = {k: args[k] for k in ["z", "x0", "x1", "y0", "y1"]}
+
+    version, count = actions.get_visited_tiles_in_range_version(
+        args["session"], args["player"], **bounds
+    )
+    etag = f"{version}-{count}"
+    # Weak, since the same tiles are served with different content codings
+    headers = {"ETag": quote_etag(etag, weak=True)}
+    if flask.request.if_none_match.contains_weak(etag):
+        return "", 304, headers
+
+    tiles, next_after = actions.get_visited_tiles_in_range(
+        args["session"], args["player"], **bounds, after=after, limit=args["limit"]
+    )
+
+    # Build response
+    resp = {
+        "tiles": tiles,
+        "next_cursor": next_after.serialize(strip_z=True) if next_after else None,
+    }
+    schema = TileRangeSchema(context={"session_id": args["session"]})
+    return marshal.marshal(resp, schema=schema), 200, headers
+
+
+class HistoryArgsSchema(SessionArgsSchema):
+    since = fields.Integer(validate=Range(min=0))
+    limit = fields.Integer(missing=100, validate=Range(min=1, max=500))
+
+
+class SnapshotSchema(Schema):
+    seq = fields.Integer()
+    time = fields.String()
+    current_position = fields.String(allow_none=True)
+    current_tick = fields.Integer()
+
+
+class HistoryEventSchema(Schema):
+    seq = fields.Integer()
+    time = fields.String()
+    type = fields.String()
+    player = fields.String()
+    pos = fields.String()
+    target_pos = fields.String()
+
+
+class HistorySchema(Schema):
+    snapshot = fields.Nested(SnapshotSchema, allow_none=True)
+    events = fields.Nested(HistoryEventSchema, many=True)
+
+
+@HTTP_API.route("/history")
+def history():
+    args = _load_args(HistoryArgsSchema())
+
+    snapshot, events = actions.get_session_log(
+        args["session"], args.get("since"), args["limit"]
+    )
+
+    # Build response
+    resp = {"snapshot": snapshot, "events": events}
+    return marshal.marshal(resp, schema=HistorySchema()), 200
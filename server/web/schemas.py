@@ -0,0 +1,66 @@
+"""Schemas shared between HTTP and websocket responses"""
+from urllib.parse import urlencode
+
+from marshmallow.validate import OneOf
+from marshmallow import fields, missing, post_dump, Schema
+
+from common import settings
+from common.point import Point
+from common.enum import EntityType, Direction
+
+
+def background_url(session_id: str, point: Point, is_placeholder=False) -> str:
+    """Returns the URL serving the background of a tile. Placeholders have a URL of
+    their own, so clients fetch the background again once it is completed.
+
+    """
+    query = {"session": session_id, "x": point.x, "y": point.y, "z": point.z}
+    if is_placeholder:
+        query["placeholder"] = "true"
+    return f"/tiles/background?{urlencode(query)}"
+
+
+class PositionSchema(Schema):
+    x = fields.Integer(required=True)
+    y = fields.Integer(required=True)
+    z = fields.Integer(required=True)
+
+
+class EntitySchema(Schema):
+    pos = fields.Nested(PositionSchema, required=True)
+
+
+class TileSchema(Schema):
+    """Tiles reference their background by URL, which needs the session id as
+    `session_id` in the schema's context. The background itself is only embedded with
+    `settings.INLINE_BACKGROUNDS`.
+
+    """
+
+    background = fields.String()
+    background_url = fields.Method("get_background_url")
+    is_placeholder = fields.Boolean()
+    pos = fields.Nested(PositionSchema, attribute="position")
+    exits_pos = fields.Dict(
+        keys=fields.String(validate=OneOf(Direction.values())),
+        values=fields.Nested(PositionSchema, required=True),
+    )
+    entities = fields.Dict(
+        keys=fields.String(validate=OneOf(EntityType.values())),
+        values=fields.Nested(EntitySchema, required=True),
+    )
+
+    def get_background_url(self, tile: dict):
+        if tile.get("position") is None or "session_id" not in self.context:
+            return missing
+        return background_url(
+            self.context["session_id"],
+            tile["position"],
+            is_placeholder=tile.get("is_placeholder", False),
+        )
+
+    @post_dump
+    def _drop_background(self, data: dict, **_kwargs) -> dict:
+        if not settings.INLINE_BACKGROUNDS:
+            data.pop("background", None)
+        return data
@@ -1,40 +1,34 @@
 """Configure websocket event handlers"""
+import typing
 import logging
+import functools
+import collections
 
+from flask import g, has_request_context, request
 from marshmallow.validate import OneOf
-from marshmallow import fields, Schema, ValidationError, INCLUDE
-from flask_socketio import SocketIO, emit
+from marshmallow import fields, Schema, ValidationError, validates_schema, INCLUDE
+from flask_socketio import SocketIO
 
+from common import metrics, settings, tracing
 from common.point import Point
-from common.enum import ClientAction, EntityType, Direction
+from common.enum import ClientAction
 from web import marshal
-from game import actions, errors
+from web.schemas import PositionSchema, TileSchema
+from web.socket.outbox import Outbox
+from web.socket.recorder import Recorder
+from web.socket.viewports import Viewport, ViewportIndex
+from game import actions, errors, scheduler, sessions
 
 
 LOGGER = logging.getLogger(__name__)
 
+# Longest request id echoed back to a client
+_MAX_REQUEST_ID_LENGTH = 64
 
-class PositionSchema(Schema):
-    x = fields.Integer(required=True)
-    y = fields.Integer(required=True)
-    z = fields.Integer(required=True)
-
-
-class EntitySchema(Schema):
-    pos = fields.Nested(PositionSchema, required=True)
-
-
-class TileSchema(Schema):
-    background = fields.String(required=True)
-    pos = fields.Nested(PositionSchema, attribute="position")
-    exits_pos = fields.Dict(
-        keys=fields.String(validate=OneOf(Direction.values())),
-        values=fields.Nested(PositionSchema, required=True),
-    )
-    entities = fields.Dict(
-        keys=fields.String(validate=OneOf(EntityType.values())),
-        values=fields.Nested(EntitySchema, required=True),
-    )
+# Tile fields read by `TileSchema`, so refreshes fetch nothing else
+_TILE_FIELDS = ["is_placeholder", "exits_pos", "entities"] + (
+    ["background"] if settings.INLINE_BACKGROUNDS else []
+)
 
 
 class ClientActionSchema(Schema):
@@ -48,11 +42,76 @@ class ActionNavigateSchema(ClientActionSchema):
     target_pos = fields.Nested(PositionSchema, required=True)
 
 
+class ActionTravelSchema(ClientActionSchema):
+    target_pos = fields.Nested(PositionSchema, required=True)
+
+
+class ActionRefreshFloorSchema(ClientActionSchema):
+    z = fields.Integer()
+
+
+class ActionSubscribeViewportSchema(ClientActionSchema):
+    z = fields.Integer(required=True)
+    x0 = fields.Integer(required=True)
+    x1 = fields.Integer(required=True)
+    y0 = fields.Integer(required=True)
+    y1 = fields.Integer(required=True)
+
+    @validates_schema
+    def _validate_bounds(self, data, **_kwargs):
+        for lower, upper in [("x0", "x1"), ("y0", "y1")]:
+            span = data[upper] - data[lower]
+            if span < 0:
+                raise ValidationError(
+                    f"{lower} must not be greater than {upper}", lower
+                )
+            if span >= settings.VIEWPORT_MAX_SPAN:
+                raise ValidationError(
+                    f"Viewport may span at most {settings.VIEWPORT_MAX_SPAN} tiles",
+                    upper,
+                )
+
+
 class JsonSchema(Schema):
     action = fields.Nested(ClientActionSchema, required=True)
 
 
 def configure_handlers(socketio: SocketIO):
+    # Dict mapping from session id to the viewports of the session's clients. Removed
+    # once its last viewer disconnects.
+    viewports: typing.Dict[str, ViewportIndex] = collections.defaultdict(
+        lambda: ViewportIndex(settings.VIEWPORT_BUCKET_SIZE)
+    )
+    outbox = Outbox(socketio, settings.OUTBOX_WINDOW_SECS)
+    recorder = Recorder(settings.RECORD_PATH) if settings.RECORD_PATH else None
+
+    def _emit_response(
+        status: str, message: dict, to: typing.Iterable[str], session_id: str = None
+    ):
+        """Queues a response for the given clients. Nothing is sent to a whole session,
+        so fan-out only grows with the clients interested in a response.
+
+        :param session_id: Session the response is about. Defaults to the requesting
+        client's.
+
+        """
+        session_id = session_id or _session_id()
+        data = _marshal_response(message, session_id)
+        request_id = g.get("request_id") if has_request_context() else None
+        for sid in to:
+            if request_id is not None and sid == request.sid:
+                # Only the requester's copy names the request it answers
+                reply = dict(message, request_id=request_id)
+                outbox.send(sid, status, reply, _marshal_response(reply, session_id))
+            else:
+                outbox.send(sid, status, message, data)
+
+    def _viewers(session_id: str, point: Point) -> typing.Set[str]:
+        """Returns the clients of a session whose viewport contains a tile"""
+        if session_id not in viewports:
+            return set()
+        return viewports[session_id].subscribers_of(point)
+
     @socketio.on_error()
     def _error_handler(err):
         # Log all socketio errors, with stack trace
@@ -60,19 +119,62 @@ def configure_handlers(socketio: SocketIO):
 
     @socketio.on("connect")
     def _handle_connect():
-        LOGGER.info("Client connected")
+        session_id = request.args.get("session", sessions.DEFAULT_SESSION)
+        if not sessions.is_valid(session_id):
+            LOGGER.info("Rejected client with invalid session id")
+            return False
+        player_id = request.args.get("player", sessions.DEFAULT_PLAYER)
+        if not sessions.is_valid(player_id):
+            LOGGER.info("Rejected client with invalid player id")
+            return False
+
+        LOGGER.info(
+            "Client connected: session_id=%s, player_id=%s", session_id, player_id
+        )
+        _CONNECTED[request.sid] = (session_id, player_id)
+        if recorder:
+            recorder.record(
+                request.sid, "connect", {"session": session_id, "player": player_id}
+            )
+        return None
 
     @socketio.on("disconnect")
     def _handle_disconnect():
-        LOGGER.info("Client disconnected")
+        session_id, _player_id = _CONNECTED.pop(request.sid, (None, None))
+        if session_id is None:
+            return
+
+        LOGGER.info("Client disconnected: session_id=%s", session_id)
+        if session_id in viewports:
+            viewports[session_id].unsubscribe(request.sid)
+            if not viewports[session_id]:
+                del viewports[session_id]
+        if any(other == session_id for other, _ in _CONNECTED.values()):
+            actions.flush_current_position(session_id)
+        else:
+            actions.evict_session(session_id)
+        if recorder:
+            recorder.record(request.sid, "disconnect")
 
     @socketio.on("message")
     def _handle_message(message):
-        LOGGER.info("Received plain message: %s", str(message))
+        LOGGER.debug(
+            "Received plain message: %s", message, extra={"event": "socket.message"}
+        )
 
     @socketio.on("json")
     def _handle_json(payload):
-        LOGGER.info("Received json message: %s", str(payload))
+        LOGGER.debug(
+            "Received json message: %s", payload, extra={"event": "socket.message"}
+        )
+        if recorder:
+            recorder.record(request.sid, "json", payload)
+
+        # Optionally set by the client, and echoed in the replies to it
+        action = payload.get("action") if isinstance(payload, dict) else None
+        request_id = action.get("request_id") if isinstance(action, dict) else None
+        if isinstance(request_id, str) and len(request_id) <= _MAX_REQUEST_ID_LENGTH:
+            g.request_id = request_id
 
         try:
             target_pos = Point(**payload["action"]["target_pos"])
@@ -85,12 +187,27 @@ def configure_handlers(socketio: SocketIO):
             return _emit_response(
                 status="ERROR_INVALID_INPUT",
                 message={"errors": err.messages, "target_pos": target_pos},
+                to=[request.sid],
             )
 
+        with _ACTION_SECS.time(action=action_name), tracing.span(
+            "socket.action", action=action_name
+        ):
+            return _dispatch(action_name, payload, target_pos)
+
+    def _dispatch(action_name: str, payload: dict, target_pos: Point):
         if action_name == ClientAction.NAVIGATE.value:
             return _handle_navigate(payload, target_pos)
+        if action_name == ClientAction.TRAVEL.value:
+            return _handle_travel(payload, target_pos)
         if action_name == ClientAction.REFRESH_ALL.value:
             return _handle_refresh_all()
+        if action_name == ClientAction.REFRESH_CURRENT.value:
+            return _handle_refresh_current()
+        if action_name == ClientAction.REFRESH_FLOOR.value:
+            return _handle_refresh_floor(payload)
+        if action_name == ClientAction.SUBSCRIBE_VIEWPORT.value:
+            return _handle_subscribe_viewport(payload)
         return None
 
     def _handle_navigate(payload: dict, target_pos: Point):
@@ -100,54 +217,256 @@ def configure_handlers(socketio: SocketIO):
             return _emit_response(
                 status="ERROR_INVALID_INPUT",
                 message={"errors": err.messages, "target_pos": target_pos},
+                to=[request.sid],
             )
 
+        session_id = _session_id()
         try:
-            tile = actions.navigate(target_pos)
+            # Rendered outside the tick, so the session's other actions don't wait
+            target_tile = actions.prepare_navigate(session_id, target_pos)
+            navigate = functools.partial(
+                actions.navigate, _player_id(), target_pos, target_tile=target_tile
+            )
+            tile = scheduler.run(session_id, navigate)
         except errors.InvalidAction as err:
             return _emit_response(
                 status="NAVIGATE_ERROR",
                 message={"errors": [str(err)], "target_pos": target_pos},
+                to=[request.sid],
+            )
+        except errors.GenerationBusy as err:
+            return _emit_response(
+                status="NAVIGATE_BUSY",
+                message={"errors": [str(err)], "target_pos": target_pos},
+                to=[request.sid],
             )
 
-        return _emit_response(
+        # Only push the new tile to clients who can see it
+        _emit_response(
             status="NAVIGATE_SUCCESS",
-            message={"new_pos": target_pos, "new_tile": tile},
+            message={
+                "new_pos": target_pos,
+                "new_tile": dict(tile, position=target_pos),
+            },
+            to={request.sid} | _viewers(session_id, target_pos),
+        )
+        return _complete_placeholders([(target_pos, tile)])
+
+    def _handle_travel(payload: dict, target_pos: Point):
+        try:
+            ActionTravelSchema().load(payload["action"])
+        except ValidationError as err:
+            return _emit_response(
+                status="ERROR_INVALID_INPUT",
+                message={"errors": err.messages, "target_pos": target_pos},
+                to=[request.sid],
+            )
+
+        try:
+            travel = functools.partial(actions.travel, _player_id(), target_pos)
+            tile, path = scheduler.run(_session_id(), travel)
+        except errors.InvalidAction as err:
+            return _emit_response(
+                status="TRAVEL_ERROR",
+                message={"errors": [str(err)], "target_pos": target_pos},
+                to=[request.sid],
+            )
+        except errors.GenerationBusy as err:
+            return _emit_response(
+                status="TRAVEL_BUSY",
+                message={"errors": [str(err)], "target_pos": target_pos},
+                to=[request.sid],
+            )
+
+        _emit_response(
+            status="TRAVEL_SUCCESS",
+            message={
+                "new_pos": target_pos,
+                "new_tile": dict(tile, position=target_pos),
+                "path": path,
+            },
+            to={request.sid} | _viewers(_session_id(), target_pos),
         )
+        return _complete_placeholders([(target_pos, tile)])
 
     def _handle_refresh_all():
-        current_pos = actions.get_or_update_current_position()
-        all_tiles = actions.get_all_visited_tiles()
+        session_id = _session_id()
+        current_pos = actions.get_or_update_current_position(session_id)
+        all_tiles = actions.get_all_visited_tiles(
+            session_id, _player_id(), fields=_TILE_FIELDS
+        )
 
         if not all_tiles:
             # Generate starting tile
-            actions.create_initial_tile()
-            all_tiles = actions.get_all_visited_tiles()
+            try:
+                actions.create_initial_tile(session_id, _player_id())
+            except errors.GenerationBusy as err:
+                return _emit_response(
+                    status="REFRESH_ALL_BUSY",
+                    message={"errors": [str(err)]},
+                    to=[request.sid],
+                )
+            all_tiles = actions.get_all_visited_tiles(
+                session_id, _player_id(), fields=_TILE_FIELDS
+            )
 
-        return _emit_response(
+        _emit_response(
             status="REFRESH_ALL_SUCCESS",
             message={"current_pos": current_pos, "all_tiles": all_tiles},
+            to=[request.sid],
+        )
+        return _complete_placeholders(
+            [(t["position"], t) for tiles in all_tiles.values() for t in tiles]
         )
 
+    def _handle_refresh_current():
+        session_id = _session_id()
+        current_pos = actions.get_or_update_current_position(session_id)
+        current_tile = actions.get_current_tile(session_id, fields=_TILE_FIELDS)
 
-def _emit_response(status: str, message: dict):
-    emit(
-        "json",
-        {"status": status, "message": _marshal_response(message)},
-        broadcast=True,
-    )
+        if not current_tile:
+            # Generate starting tile
+            try:
+                actions.create_initial_tile(session_id, _player_id())
+            except errors.GenerationBusy as err:
+                return _emit_response(
+                    status="REFRESH_CURRENT_BUSY",
+                    message={"errors": [str(err)]},
+                    to=[request.sid],
+                )
+            current_tile = actions.get_current_tile(session_id, fields=_TILE_FIELDS)
+
+        _emit_response(
+            status="REFRESH_CURRENT_SUCCESS",
+            message={"current_pos": current_pos, "current_tile": current_tile},
+            to=[request.sid],
+        )
+        return _complete_placeholders([(current_pos, current_tile)])
 
+    def _handle_refresh_floor(payload: dict):
+        try:
+            floor = ActionRefreshFloorSchema().load(payload["action"]).get("z")
+        except ValidationError as err:
+            return _emit_response(
+                status="ERROR_INVALID_INPUT",
+                message={"errors": err.messages},
+                to=[request.sid],
+            )
 
-def _marshal_response(message: dict):
+        session_id = _session_id()
+        current_pos = actions.get_or_update_current_position(session_id)
+        if floor is None:
+            floor = current_pos.z
+        floor_tiles = actions.get_visited_tiles_on_floor(
+            session_id, _player_id(), floor, fields=_TILE_FIELDS
+        )
+
+        _emit_response(
+            status="REFRESH_FLOOR_SUCCESS",
+            message={
+                "current_pos": current_pos,
+                "floor": floor,
+                "floor_tiles": floor_tiles,
+            },
+            to=[request.sid],
+        )
+        return _complete_placeholders([(t["position"], t) for t in floor_tiles])
+
+    def _handle_subscribe_viewport(payload: dict):
+        try:
+            args = ActionSubscribeViewportSchema().load(payload["action"])
+        except ValidationError as err:
+            return _emit_response(
+                status="ERROR_INVALID_INPUT",
+                message={"errors": err.messages},
+                to=[request.sid],
+            )
+
+        viewport = Viewport(**{k: args[k] for k in Viewport._fields})
+        viewports[_session_id()].subscribe(request.sid, viewport)
+        LOGGER.info("Client subscribed to viewport: viewport=%s", viewport)
+
+        return _emit_response(
+            status="SUBSCRIBE_VIEWPORT_SUCCESS", message={}, to=[request.sid]
+        )
+
+    def _complete_placeholders(tiles: typing.List[tuple]):
+        """Renders the full background of any placeholder tiles in the background, then
+        pushes them to the requester and to clients who can see them.
+
+        :param tiles: List of `(Point, tile)` tuples.
+
+        """
+        sid = request.sid
+        session_id = _session_id()
+        for point, tile in tiles:
+            if tile.get("is_placeholder"):
+                socketio.start_background_task(
+                    _complete_placeholder, session_id, point, sid
+                )
+
+    def _complete_placeholder(session_id: str, point: Point, sid: str):
+        try:
+            tile = actions.complete_placeholder(session_id, point)
+        except errors.GenerationBusy as err:
+            LOGGER.warning(
+                "Failed to complete placeholder: point=%s, err=%s", point, err
+            )
+            return
+        if not tile:
+            return
+
+        _emit_response(
+            status="TILE_UPDATED",
+            message={"new_tile": tile},
+            to={sid} | _viewers(session_id, point),
+            session_id=session_id,
+        )
+
+
+def _session_id() -> str:
+    """Returns the session the requesting client is playing in"""
+    return _CONNECTED[request.sid][0]
+
+
+def _player_id() -> str:
+    """Returns the player the requesting client plays as"""
+    return _CONNECTED[request.sid][1]
+
+
+def _marshal_response(message: dict, session_id: str):
     class ResponseSerializer(Schema):
         new_tile = fields.Nested(TileSchema)
+        current_tile = fields.Nested(TileSchema)
         errors = fields.List(fields.String())
         new_pos = fields.Nested(PositionSchema)
+        path = fields.List(fields.Nested(PositionSchema))
         current_pos = fields.Nested(PositionSchema)
         target_pos = fields.Nested(PositionSchema)
         all_tiles = fields.Dict(
             keys=fields.Integer(),  # Floor
             values=fields.Nested(TileSchema, many=True),  # List of tiles
         )
-
-    return marshal.marshal(message, schema=ResponseSerializer())
+        floor = fields.Integer()
+        floor_tiles = fields.Nested(TileSchema, many=True)
+        request_id = fields.String()
+
+    schema = ResponseSerializer(context={"session_id": session_id})
+    return marshal.marshal(message, schema=schema)
+
+
+# Dict mapping from the sid of each connected client to a `(session_id, player_id)`
+# tuple of the session it is playing in and the player it plays as
+_CONNECTED: typing.Dict[str, tuple] = {}
+
+_ACTION_SECS = metrics.Histogram(
+    "creepy_socket_action_seconds", "Time taken to handle client actions, by action"
+)
+metrics.Gauge(
+    "creepy_socket_connected_clients", "Clients connected", lambda: len(_CONNECTED)
+)
+metrics.Gauge(
+    "creepy_socket_active_sessions",
+    "Sessions with at least one client connected",
+    lambda: len({session_id for session_id, _ in _CONNECTED.values()}),
+)
@@ -0,0 +1,178 @@
+"""
+Buffers outbound events per room for a short window, then sends them as one frame.
+While buffered, position updates superseded by a later one are reduced to the tile they
+carried, and repeated payloads are sent once. Replies naming the request they answer
+are never dropped, so every request a client identified gets an answer.
+
+Every response goes through here, each to the rooms of the clients it is for (every
+client has a room of its own, named by its sid), so frames for a room are never
+overtaken by events sent around the buffer.
+
+"""
+import json
+import time
+import logging
+import threading
+from typing import Dict, List
+
+from flask_socketio import SocketIO
+
+from common import metrics
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Statuses whose message moves the player to `new_pos`
+_POSITION_STATUSES = {"NAVIGATE_SUCCESS", "TRAVEL_SUCCESS"}
+
+
+class _Event:
+    def __init__(self, status: str, message: dict, data: str) -> None:
+        self.status = status
+        self.message = message
+        self.data = data
+        # Serialized position of the tile the event delivers, if any
+        self.tile_pos = _tile_pos(message)
+        # Set by the client on its request, if this is the reply to it
+        self.request_id = message.get("request_id")
+
+
+class Outbox:
+    """
+    :param socketio: Used to emit frames.
+    :param window_secs: How long to buffer events for. Zero sends them immediately.
+
+    """
+
+    def __init__(self, socketio: SocketIO, window_secs: float) -> None:
+        self.socketio = socketio
+        self.window_secs = window_secs
+
+        self._pending: Dict[str, List[_Event]] = {}
+        self._first_queued_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def send(self, room: str, status: str, message: dict, data: str) -> None:
+        """Queues an event for a room.
+
+        :param room: Room to send to, e.g. a client's sid.
+        :param status: Status of the event.
+        :param message: The unserialized message.
+        :param data: The serialized message.
+
+        """
+        if self.window_secs <= 0:
+            self._emit(room, [_Event(status, message, data)], time.monotonic())
+            return
+
+        with self._lock:
+            is_first = room not in self._pending
+            self._pending.setdefault(room, []).append(_Event(status, message, data))
+            if is_first:
+                self._first_queued_at[room] = time.monotonic()
+
+        if is_first:
+            self.socketio.start_background_task(self._flush_later, room)
+
+    def _flush_later(self, room: str) -> None:
+        self.socketio.sleep(self.window_secs)
+        with self._lock:
+            events = self._pending.pop(room, [])
+            first_queued_at = self._first_queued_at.pop(room, None)
+
+        if not events:
+            return
+
+        num_queued = len(events)
+        events = self._coalesce(events)
+        self._emit(room, events, first_queued_at)
+
+        _COALESCED.inc(num_queued - len(events))
+
+    def _coalesce(self, events: List[_Event]) -> List[_Event]:
+        last_move = max(
+            (i for i, e in enumerate(events) if e.status in _POSITION_STATUSES),
+            default=None,
+        )
+
+        coalesced = []
+        for index, event in enumerate(events):
+            if event.status in _POSITION_STATUSES and index != last_move:
+                # Superseded move, but the client still needs the tile
+                if "new_tile" not in event.message:
+                    continue
+                new_tile, new_pos = event.message["new_tile"], event.message["new_pos"]
+                # Positioned, as the client no longer gets the move it belonged to.
+                # Rewritten from the serialized tile, which is sent as it was.
+                data = json.loads(event.data)
+                data = {"new_tile": dict(data["new_tile"], pos=data["new_pos"])}
+                message = {"new_tile": dict(new_tile, position=new_pos)}
+                if event.request_id is not None:
+                    data["request_id"] = message["request_id"] = event.request_id
+                event = _Event("TILE_UPDATED", message, json.dumps(data))
+            coalesced.append(event)
+
+        # Drop repeated payloads and tiles a later event delivers, keeping the latest.
+        # Tiles are told apart by position, so their payloads needn't be compared.
+        seen = set()
+        seen_tiles = set()
+        deduped = []
+        for event in reversed(coalesced):
+            key = (event.status, event.tile_pos or event.data)
+            is_reply = event.request_id is not None
+            if key in seen and not is_reply:
+                continue
+            if (
+                event.status == "TILE_UPDATED"
+                and event.tile_pos in seen_tiles
+                and not is_reply
+            ):
+                continue
+            seen.add(key)
+            if event.tile_pos:
+                seen_tiles.add(event.tile_pos)
+            deduped.append(event)
+
+        return list(reversed(deduped))
+
+    def _emit(self, room: str, events: List[_Event], first_queued_at: float) -> None:
+        if len(events) == 1:
+            frame = {"status": events[0].status, "message": events[0].data}
+        else:
+            frame = {
+                "status": "BATCH",
+                "events": [{"status": e.status, "message": e.data} for e in events],
+            }
+
+        self.socketio.emit("json", frame, room=room)
+        _FRAME_EVENTS.observe(len(events))
+        _FRAME_BYTES.observe(sum(len(e.data) for e in events))
+        _FRAME_DELAY_SECS.observe(time.monotonic() - first_queued_at)
+
+
+def _tile_pos(message: dict) -> str:
+    tile = message.get("new_tile")
+    if not tile:
+        return None
+    pos = message.get("new_pos") or tile.get("position")
+    return pos.serialize() if pos else None
+
+
+_FRAME_EVENTS = metrics.Histogram(
+    "creepy_outbox_frame_events",
+    "Events in each frame sent to a client",
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+_FRAME_BYTES = metrics.Histogram(
+    "creepy_outbox_frame_bytes",
+    "Bytes of messages in each frame sent to a client",
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576),
+)
+_FRAME_DELAY_SECS = metrics.Histogram(
+    "creepy_outbox_frame_delay_seconds",
+    "Time the first event of each frame waited to be sent",
+)
+_COALESCED = metrics.Counter(
+    "creepy_outbox_events_coalesced_total",
+    "Events dropped because they were superseded or duplicated",
+)
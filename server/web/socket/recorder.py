@@ -0,0 +1,59 @@
+"""
+Records incoming socket traffic, so it can be replayed against another build with
+replay.py. Each line of the recording is a compact JSON array:
+
+    [time, sid, event, payload]
+
+where `time` is the Unix time in seconds and `event` is "connect", "json" or
+"disconnect". For "json", `payload` is the message as received. For "connect", it is
+`{"session", "player"}`, the session and player the client connected as, which replay.py
+reconnects to. For "disconnect", it is null. Lines are only ever appended, so recording
+can be stopped and resumed.
+
+"""
+import json
+import time
+import logging
+import threading
+
+from common import metrics
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Recorder:
+    """
+    :param path: File to append the recording to.
+
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # Line buffered, so a crash loses at most the line being written
+        self._file = open(path, "a", buffering=1)
+        self._lock = threading.Lock()
+        LOGGER.info("Recording socket traffic: path=%s", path)
+
+    def record(self, sid: str, event: str, payload: dict = None) -> None:
+        line = json.dumps(
+            [round(time.time(), 3), sid, event, payload],
+            separators=(",", ":"),
+            default=str,
+        )
+        try:
+            with self._lock:
+                self._file.write(line + "\n")
+        except OSError:
+            LOGGER.exception("Failed to record socket traffic: path=%s", self.path)
+            return
+        _RECORDED.inc()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+_RECORDED = metrics.Counter(
+    "creepy_socket_messages_recorded_total", "Socket messages appended to the recording"
+)
@@ -0,0 +1,80 @@
+"""Tracks which area of the map each client is looking at"""
+import typing
+import collections
+
+from common.point import Point
+
+
+class Viewport(typing.NamedTuple):
+    z: int
+    x0: int
+    x1: int
+    y0: int
+    y1: int
+
+    def contains(self, point: Point) -> bool:
+        return (
+            point.z == self.z
+            and self.x0 <= point.x <= self.x1
+            and self.y0 <= point.y <= self.y1
+        )
+
+
+class ViewportIndex:
+    """Per-floor spatial index of client viewports. Each floor is divided into square
+    buckets, and a viewport is registered against every bucket it overlaps, so
+    finding the clients interested in a tile only inspects a single bucket.
+
+    :param bucket_size: Width and height of each bucket, in tiles.
+
+    """
+
+    def __init__(self, bucket_size: int) -> None:
+        self.bucket_size = bucket_size
+        self._viewports: typing.Dict[str, Viewport] = {}
+        self._buckets: typing.Dict[tuple, typing.Set[str]] = collections.defaultdict(
+            set
+        )
+
+    def subscribe(self, sid: str, viewport: Viewport) -> None:
+        """Replaces any viewport previously declared by the client"""
+        self.unsubscribe(sid)
+
+        self._viewports[sid] = viewport
+        for bucket in self._buckets_of(viewport):
+            self._buckets[bucket].add(sid)
+
+    def unsubscribe(self, sid: str) -> None:
+        viewport = self._viewports.pop(sid, None)
+        if not viewport:
+            return
+
+        for bucket in self._buckets_of(viewport):
+            sids = self._buckets[bucket]
+            sids.discard(sid)
+            if not sids:
+                del self._buckets[bucket]
+
+    def subscribers_of(self, point: Point) -> typing.Set[str]:
+        """Returns the clients whose viewport contains a tile"""
+        bucket = self._bucket_of(point.z, point.x, point.y)
+        return {
+            sid
+            for sid in self._buckets.get(bucket, ())
+            if self._viewports[sid].contains(point)
+        }
+
+    def __len__(self):
+        return len(self._viewports)
+
+    def _buckets_of(self, viewport: Viewport) -> typing.List[tuple]:
+        _, bx0, by0 = self._bucket_of(viewport.z, viewport.x0, viewport.y0)
+        _, bx1, by1 = self._bucket_of(viewport.z, viewport.x1, viewport.y1)
+        return [
+            (viewport.z, bx, by)
+            for bx in range(bx0, bx1 + 1)
+            for by in range(by0, by1 + 1)
+        ]
+
+    def _bucket_of(self, z: int, x: int, y: int) -> tuple:
+        return z, x // self.bucket_size, y // self.bucket_size